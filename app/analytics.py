@@ -0,0 +1,210 @@
+""" Aggregate statistics over the whole game history
+
+Games are kept in memory as NumPy columns (one array per field, one element per game), so aggregates over
+millions of games are a handful of vectorized operations instead of SQL scans over the plays table.
+Plays and results are stored as their `rps.RPS_ORDER`/`rps.RESULT_ORDER` codes, players as indices into
+`History.player_ids`.
+"""
+
+import threading
+import numpy as np
+import database
+import rps
+
+from typing import Dict, Iterable, List, Optional, Tuple
+from apityping import GameResult, PlayerId, PlayerName, Timestamp
+
+
+ANALYTICS_INITIAL_CAPACITY = 1 << 16
+
+WIN, LOSS, TIE = (rps.RESULT_ORDER.index(r) for r in (rps.Result.WIN, rps.Result.LOSS, rps.Result.TIE))
+
+# character (as its code point) -> play/result code, for decoding game_rows.packed in bulk
+_CHAR_CODES = np.full(128, -1, dtype=np.int8)
+for _code, _play in enumerate(rps.RPS_ORDER):
+    _CHAR_CODES[ord(_play.value)] = _code
+_RESULT_CHAR_CODES = np.full(128, -1, dtype=np.int8)
+for _code, _result in enumerate(rps.RESULT_ORDER):
+    _RESULT_CHAR_CODES[ord(_result.value)] = _code
+
+
+class History:
+    """ All finished games, as columns
+
+    Built with `load()` from the database, then kept up to date with `add()` as new results are saved.
+    Safe to query from several threads while games are being added.
+    """
+
+    _COLUMNS = (
+        ('time', np.int64),
+        ('p1', np.int32), ('p2', np.int32),
+        ('p1_play', np.int8), ('p2_play', np.int8),
+        ('p1_result', np.int8), ('p2_result', np.int8),
+    )
+
+    def __init__(self, capacity: int = ANALYTICS_INITIAL_CAPACITY):
+        self._n = 0
+        self._arrays = {name: np.empty(capacity, dtype=dtype) for name, dtype in self._COLUMNS}
+        self.player_ids: List[PlayerId] = []
+        self.player_names: List[PlayerName] = []
+        self._player_index: Dict[PlayerId, int] = {}
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return self._n
+
+    def _columns(self) -> Dict[str, np.ndarray]:
+        """ Views of the filled part of each column. Must hold the lock. """
+        return {name: array[:self._n] for name, array in self._arrays.items()}
+
+    def _reserve(self, count: int) -> None:
+        """ Make room for `count` more games, doubling the capacity as needed. Must hold the lock. """
+        capacity = len(self._arrays['time'])
+        needed = self._n + count
+        if needed <= capacity:
+            return
+        while capacity < needed:
+            capacity *= 2
+        for name, array in self._arrays.items():
+            grown = np.empty(capacity, dtype=array.dtype)
+            grown[:self._n] = array[:self._n]
+            self._arrays[name] = grown
+
+    def _player(self, pid: PlayerId, name: PlayerName) -> int:
+        """ Index of a player, adding them if necessary. Must hold the lock. """
+        index = self._player_index.get(pid)
+        if index is None:
+            index = self._player_index[pid] = len(self.player_ids)
+            self.player_ids.append(pid)
+            self.player_names.append(name)
+        return index
+
+    def _append(self, time: np.ndarray, p1: np.ndarray, p2: np.ndarray, packed: np.ndarray) -> None:
+        """ Append games, with plays and results given as an (n, 4) array of characters. Must hold the lock. """
+        count = len(time)
+        self._reserve(count)
+        codes = packed.view(np.uint32).reshape(count, 4)
+        new = slice(self._n, self._n + count)
+        self._arrays['time'][new] = time
+        self._arrays['p1'][new] = p1
+        self._arrays['p2'][new] = p2
+        self._arrays['p1_play'][new] = _CHAR_CODES[codes[:, 0]]
+        self._arrays['p2_play'][new] = _CHAR_CODES[codes[:, 1]]
+        self._arrays['p1_result'][new] = _RESULT_CHAR_CODES[codes[:, 2]]
+        self._arrays['p2_result'][new] = _RESULT_CHAR_CODES[codes[:, 3]]
+        self._n += count
+
+    def load(self, max_row: Optional[int] = None) -> int:
+        """ Load all games from the database, or those up to a `database.get_players_and_last_game_row` mark.
+        Returns the number of games loaded. """
+        for rows in database.iter_game_rows(max_row=max_row):
+            with self._lock:
+                p1 = np.fromiter((self._player(row[2], row[3]) for row in rows), dtype=np.int32, count=len(rows))
+                p2 = np.fromiter((self._player(row[4], row[5]) for row in rows), dtype=np.int32, count=len(rows))
+                self._append(
+                    np.fromiter((row[1] for row in rows), dtype=np.int64, count=len(rows)),
+                    p1, p2,
+                    np.array([row[6] for row in rows], dtype='<U4'),
+                )
+        return self._n
+
+    def add(self, games: Iterable[GameResult]) -> None:
+        """ Add newly finished games """
+        games = list(games)
+        if not games:
+            return
+        with self._lock:
+            self._append(
+                np.array([game.t for game in games], dtype=np.int64),
+                np.array([self._player(game.player1.pid, game.player1.name) for game in games], dtype=np.int32),
+                np.array([self._player(game.player2.pid, game.player2.name) for game in games], dtype=np.int32),
+                np.array([database.pack_plays(game) for game in games], dtype='<U4'),
+            )
+
+    def _per_player(self, cols: Dict[str, np.ndarray], result: int) -> np.ndarray:
+        """ Number of games with the given result, per player index """
+        players = len(self.player_ids)
+        return (np.bincount(cols['p1'][cols['p1_result'] == result], minlength=players)
+            + np.bincount(cols['p2'][cols['p2_result'] == result], minlength=players))
+
+    def top_players(self, n: int = 10, by: str = "wins", min_games: int = 0) -> List[dict]:
+        """ The top `n` players, ordered by number of wins (by="wins") or win rate (by="win_rate"),
+        among players with at least `min_games` games. """
+        with self._lock:
+            cols = self._columns()
+            wins = self._per_player(cols, WIN)
+            losses = self._per_player(cols, LOSS)
+            ties = self._per_player(cols, TIE)
+            ids, names = list(self.player_ids), list(self.player_names)
+
+        games = wins + losses + ties
+        win_rate = np.divide(wins, games, out=np.zeros(len(games)), where=games > 0)
+        key = win_rate if by == "win_rate" else wins
+        eligible = np.flatnonzero(games >= max(min_games, 1))
+        # sort descending by key, then by number of games
+        order = eligible[np.lexsort((-games[eligible], -key[eligible]))][:n]
+
+        return [{
+            'pid': ids[i], 'name': names[i],
+            'games': int(games[i]), 'wins': int(wins[i]), 'losses': int(losses[i]), 'ties': int(ties[i]),
+            'win_rate': float(win_rate[i]),
+        } for i in order]
+
+    def head_to_head(self, a: PlayerId, b: PlayerId) -> Optional[dict]:
+        """ Record of player `a` against player `b`, or None if either player is unknown """
+        with self._lock:
+            ia, ib = self._player_index.get(a), self._player_index.get(b)
+            if ia is None or ib is None:
+                return None
+            cols = self._columns()
+
+        a_first = (cols['p1'] == ia) & (cols['p2'] == ib)
+        b_first = (cols['p1'] == ib) & (cols['p2'] == ia)
+        # with a == b, games against oneself match both; count them once, with a as player 1
+        b_first &= ~a_first
+        # a's results, whichever side they played on
+        results = np.concatenate((cols['p1_result'][a_first], cols['p2_result'][b_first]))
+        counts = np.bincount(results, minlength=3)
+        times = cols['time'][a_first | b_first]
+        return {
+            'games': int(len(results)),
+            'wins': int(counts[WIN]), 'losses': int(counts[LOSS]), 'ties': int(counts[TIE]),
+            'last_played': int(times.max()) if len(times) else None,
+        }
+
+    def win_rate_by_play(self, pid: Optional[PlayerId] = None) -> Dict[str, dict]:
+        """ Number of times each play was played, and how often it won, overall or for one player """
+        with self._lock:
+            cols = self._columns()
+            index = self._player_index.get(pid) if pid is not None else None
+            if pid is not None and index is None:
+                return {}
+
+        sides = []
+        for side in ("p1", "p2"):
+            mask = cols[side] == index if index is not None else slice(None)
+            sides.append((cols[f'{side}_play'][mask], cols[f'{side}_result'][mask]))
+        plays = np.concatenate([p for p, _ in sides])
+        results = np.concatenate([r for _, r in sides])
+
+        played = np.bincount(plays, minlength=3)
+        won = np.bincount(plays[results == WIN], minlength=3)
+        return {
+            play.name.lower(): {
+                'played': int(played[code]), 'wins': int(won[code]),
+                'win_rate': float(won[code] / played[code]) if played[code] else 0.0,
+            }
+            for code, play in enumerate(rps.RPS_ORDER)
+        }
+
+    def activity(self, bucket: int = 3600_000, since: Optional[Timestamp] = None) -> List[Tuple[Timestamp, int]]:
+        """ Number of games per time bucket (in milliseconds, default one hour), as (bucket start, count) """
+        with self._lock:
+            times = self._columns()['time']
+        if since is not None:
+            times = times[times >= since]
+        if not len(times):
+            return []
+        start = times.min() // bucket * bucket
+        counts = np.bincount((times - start) // bucket)
+        return [(int(start + i * bucket), int(c)) for i, c in enumerate(counts) if c]
@@ -1,25 +1,70 @@
 """ Connects to the API and fetches game data. """
 
 import database
+import metrics
 import requests
 import websocket
 import json
+import os
+import queue
+import threading
+import time
+from cache import LRUCache
+from writer import BatchWriter
 
 from typing import Optional, Callable, Tuple, List
 from apityping import *
 
 
-API_BASE = "https://bad-api-assignment.reaktor.com/rps"
-WS_BASE = "wss://bad-api-assignment.reaktor.com/rps"
+# overridable, e.g. to run against a local stand-in of the API
+API_BASE = os.environ.get("RPS_API_BASE", "https://bad-api-assignment.reaktor.com/rps")
+WS_BASE = os.environ.get("RPS_WS_BASE", "wss://bad-api-assignment.reaktor.com/rps")
 
+# number of history pages saved to the database in one transaction
+HISTORY_PAGES_PER_COMMIT = 5
+# number of history pages downloaded ahead of the database writes
+HISTORY_PREFETCH_PAGES = 10
+HISTORY_TIMEOUT = 30            # seconds, per request
+HISTORY_RETRIES = 5
+HISTORY_RETRY_BACKOFF = 1.0     # seconds, doubled after every failed attempt...
+HISTORY_RETRY_BACKOFF_MAX = 30.0  # ...up to this
 
-def _fetch_history_page(key: Optional[str] = None) -> Tuple[Optional[str], List[APIGameResult]]:
+LIVE_RECV_TIMEOUT = 1.0         # seconds; how often the receive loop checks whether it should stop
+LIVE_RECONNECT_BACKOFF = 1.0    # seconds, doubled after every failed connection attempt...
+LIVE_RECONNECT_BACKOFF_MAX = 60.0 # ...up to this
+LIVE_DEDUPE_SIZE = 10_000       # number of recent events remembered for dropping duplicates
+LIVE_COVERAGE_HEARTBEAT = 10.0  # seconds between updates of the live feed's covered period while connected
+_COVERAGE = "COVERAGE"          # type of the covered period notes the live feed queues along with its events
+
+# both overridable, e.g. to see gaps filled quickly in a local test cluster
+RECONCILE_INTERVAL = float(os.environ.get("RPS_RECONCILE_INTERVAL", 300.0))  # seconds between checks for gaps in the live feed's coverage
+RECONCILE_SETTLE = int(os.environ.get("RPS_RECONCILE_SETTLE", 60_000))      # ms a gap must have been over for, before its games are expected in the history
+RECONCILE_MARGIN = 30_000       # ms added on both sides of a gap, for games finishing around a disconnect
+
+_HISTORY_PAGE_SECONDS = metrics.histogram("rps_history_page_fetch_seconds", "Duration of history page downloads, including retries")
+_LIVE_EVENTS = metrics.counter("rps_live_events_total", "Live feed events received, by type; duplicates are counted separately", ["type"])
+_LIVE_DUPLICATES = metrics.counter("rps_live_duplicate_events_total", "Live feed events dropped as duplicates")
+_LIVE_EVENT_SECONDS = metrics.histogram("rps_live_event_seconds", "Processing time of live events, by type; results are saved after this", ["type"])
+_RECONCILED_PAGES = metrics.counter("rps_reconciled_history_pages_total", "History pages fetched again to fill gaps in the live feed")
+_LIVE_RESULT_LAG = metrics.histogram("rps_live_result_lag_seconds", "Time from a game's API timestamp to its result being saved",
+    buckets=(0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0))
+
+
+@_HISTORY_PAGE_SECONDS.timed()
+def _fetch_history_page(key: Optional[str] = None,
+        session: Optional[requests.Session] = None, base: str = API_BASE) -> Tuple[Optional[str], List[APIGameResult]]:
     """ Fetch single page from the API
-    
+
     key:
         Either string of the "cursor" address from last API access,
         or None if this is the first time accessing the API.
-    
+    session:
+        HTTP session to reuse (keeping the connection alive between pages), or None for a one-off request.
+    base:
+        API address, overridable for testing against a local server.
+
+    Failed requests are retried HISTORY_RETRIES times, with exponential backoff.
+
     returns (nextpage, data)
     nextpage:
         string of the next "cursor" address, or None if this was the last page.
@@ -35,57 +80,357 @@ def _fetch_history_page(key: Optional[str] = None) -> Tuple[Optional[str], List[
         RpsText is one of "ROCK", "PAPER", "SCISSORS".
     """
     if key:
-        url = API_BASE + "/history?cursor=" + key
+        url = base + "/history?cursor=" + key
     else:
-        url = API_BASE + "/history"
+        url = base + "/history"
+
+    get = session.get if session else requests.get
+    for attempt in range(HISTORY_RETRIES + 1):
+        try:
+            resp = get(url, timeout=HISTORY_TIMEOUT)
+            resp.raise_for_status()
+            res = resp.json()
+            page, data = res['cursor'], res['data']
+            break
+        except (requests.RequestException, ValueError, KeyError) as e:
+            if attempt == HISTORY_RETRIES:
+                raise
+            delay = min(HISTORY_RETRY_BACKOFF * 2**attempt, HISTORY_RETRY_BACKOFF_MAX)
+            print(f"Error fetching history page {key} ({e}), retrying in {delay:.1f}s")
+            time.sleep(delay)
 
-    res = requests.get(url).json()
-    page, data = res['cursor'], res['data']
     if page:
         page = page.split("=")[1]
     return page, data
 
-def fetch_new_history() -> None:
+def _download_history(key: Optional[str], pages: "queue.Queue", stop: threading.Event, base: str) -> None:
+    """ Download stage of the history pipeline: follows the cursor chain starting from `key`,
+    putting each (page, nextpage, data) into `pages`. Ends with the last page, or with the exception that stopped it. """
+
+    def put(item) -> bool:
+        # the queue is bounded, so this blocks while the writer is behind; give up if the writer has stopped
+        while not stop.is_set():
+            try:
+                pages.put(item, timeout=0.5)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    try:
+        with requests.Session() as session:
+            while True:
+                nextkey, data = _fetch_history_page(key, session, base)
+                if not put((key, nextkey, data)) or not nextkey:
+                    return
+                key = nextkey
+    except Exception as e:
+        put(e)
+
+def _now() -> Timestamp:
+    """ Current time in ms, comparable with the API's timestamps """
+    return int(time.time() * 1000)
+
+def _history_page(key: Optional[str], data: List[APIGameResult]) -> database.HistoryPage:
+    times = [game['t'] for game in data]
+    return database.HistoryPage(key or '', min(times, default=None), max(times, default=None), len(data), _now())
+
+def fetch_new_history(base: str = API_BASE, on_saved: Optional[Callable[[List[GameResult]], None]] = None) -> bool:
+    """ Fetch and save all history pages we haven't seen yet
+
+    Pages are downloaded by a separate thread, up to HISTORY_PREFETCH_PAGES ahead of the database writes,
+    which happen here every HISTORY_PAGES_PER_COMMIT pages. The stored cursor is only moved along with the
+    games of the pages before it, so an interrupted fetch resumes where it left off.
+    The time range of each page is stored too, for `reconcile_history`.
+
+    on_saved: called with the games that turned out to be new, after each commit
+
+    Returns True if the last page was reached, False if the fetch stopped on an error.
+    """
     key = database.get_last_history_page()
+    pages: queue.Queue = queue.Queue(maxsize=HISTORY_PREFETCH_PAGES)
+    stop = threading.Event()
+    downloader = threading.Thread(target=_download_history, args=(key, pages, stop, base), daemon=True)
+    downloader.start()
+
+    batch: List[APIGameResult] = []
+    batch_pages: List[database.HistoryPage] = []
+    total_pages = total_games = 0
+    started = time.monotonic()
+    try:
+        while True:
+            item = pages.get()
+            if isinstance(item, Exception):
+                print(f"!! could not fetch history ({item}), stopping at page: {key}")
+                return False
+            page, nextkey, data = item
+            # Either `nextkey` has the cursor for the next history page, or we've reached the last page.
+            # In the latter case, `data` will also be empty.
+            if nextkey:
+                key = nextkey
+                batch += data
+                batch_pages.append(_history_page(page, data))
+
+            # save games, along with the newest "page" URL, every few pages and once we've reached the end
+            if batch_pages and (len(batch_pages) >= HISTORY_PAGES_PER_COMMIT or not nextkey):
+                games = database.add_history_games(batch, key, batch_pages)
+                if games is None:
+                    print(f"!! could not save history, stopping at page: {key}")
+                    return False
+                if games and on_saved is not None:
+                    on_saved(games)
+                total_pages += len(batch_pages)
+                total_games += len(batch)
+                elapsed = time.monotonic() - started
+                print(f"!! done page: {key} ({total_pages} pages, {total_games} games, "
+                      f"{total_pages / elapsed:.1f} pages/s, {total_games / elapsed:.0f} games/s)")
+                batch, batch_pages = [], []
+
+            if not nextkey:
+                return True
+    finally:
+        stop.set()
+        downloader.join()
+
+def _walk_history_head(session: requests.Session, base: str, until: Timestamp,
+        on_saved: Optional[Callable[[List[GameResult]], None]]) -> Tuple[Optional[Timestamp], Optional[Timestamp], int]:
+    """ Fetch and save history pages from the newest one, until a page reaching back to `until`, or the oldest page.
+
+    Returns (oldest, newest, pages): the time range spanned by the pages fetched (oldest is 0 if the whole history
+    was), or None for both if a page couldn't be fetched or saved; and the number of pages fetched.
+    """
+    key = None
+    oldest = newest = None
+    pages = 0
     while True:
-        nextkey, data = _fetch_history_page(key)
-        # Either `nextkey` has the cursor for the next history page, or we've reached the last page.
-        # In the latter case, `data` will also be empty.
-        if nextkey:
-            key = nextkey
-            database.add_history_games(data)
-
-            # save newest "page" URL to DB whenever we finish processing the page
-            print(f"!! done page: {key}")
-            database.update_history_page(key)
-        else:
-            break
+        try:
+            nextkey, data = _fetch_history_page(key, session, base)
+        except Exception as e:
+            print(f"!! could not fetch history page {key} ({e})")
+            return None, None, pages
+        pages += 1
+        _RECONCILED_PAGES.inc()
+        games = database.add_history_games(data, pages=[_history_page(key, data)])
+        if games is None:
+            print(f"!! could not save history page {key}")
+            return None, None, pages
+        if games and on_saved is not None:
+            on_saved(games)
+
+        times = [game['t'] for game in data]
+        if times:
+            newest = max(times) if newest is None else max(newest, max(times))
+            oldest = min(times)
+        if not nextkey:
+            return 0, newest, pages
+        if oldest is not None and oldest <= until:
+            return oldest, newest, pages
+        key = nextkey
+
+def reconcile_history(base: str = API_BASE, on_saved: Optional[Callable[[List[GameResult]], None]] = None) -> int:
+    """ Fill gaps in the live feed's coverage (e.g. while disconnected or restarting) from the history API
+
+    The history lists the newest games first. A gap within the time range of stored history pages is filled by
+    fetching again only the pages overlapping it; those fetched after the gap was over hold its games already.
+    Gaps newer than that are filled by walking the history from its newest page back to their start, recording
+    the pages on the way for later gaps. A gap is recorded as covered only once it is spanned by pages fetched
+    after it was over. Gaps are only filled once they have been over for RECONCILE_SETTLE, to give the history
+    time to catch up.
 
-def create_websocket_listener(result_callback: ResultCallback, begin_callback: BeginCallback):
-    """ Creates a listener to the API live websocket
+    on_saved: called with the games that turned out to be new
 
-    result_callback: a callback for GAME_RESULT events
-    begin_callback: a callback for GAME_BEGIN events
+    Returns the number of pages fetched.
     """
+    gaps = database.get_coverage_gaps(_now() - RECONCILE_SETTLE)
+    if not gaps:
+        return 0
+
+    fetched = 0
+    recent = []
+    with requests.Session() as session:
+        for start, end in gaps:
+            pages = database.get_history_pages_between(start - RECONCILE_MARGIN, end + RECONCILE_MARGIN)
+            if not pages or pages[0].min_time > start or max(page.max_time for page in pages) < end:
+                recent.append((start, end))
+                continue
+            for page in pages:
+                if page.fetched_at >= end + RECONCILE_SETTLE:
+                    continue
+                try:
+                    _, data = _fetch_history_page(page.cursor, session, base)
+                except Exception as e:
+                    print(f"!! could not fetch history page {page.cursor} ({e}), leaving gap {start}-{end} for later")
+                    break
+                games = database.add_history_games(data, pages=[_history_page(page.cursor, data)])
+                if games is None:
+                    print(f"!! could not save history page {page.cursor}, leaving gap {start}-{end} for later")
+                    break
+                fetched += 1
+                _RECONCILED_PAGES.inc()
+                if games and on_saved is not None:
+                    on_saved(games)
+            else:
+                print(f"!! filled live feed gap {start}-{end} ({(end - start) / 1000:.0f}s) from {len(pages)} history pages")
+                database.add_coverage(start, end, "history")
+
+        if recent:
+            oldest, newest, pages = _walk_history_head(session, base,
+                min(start for start, _ in recent) - RECONCILE_MARGIN, on_saved)
+            fetched += pages
+            for start, end in recent:
+                if oldest is not None and newest is not None and oldest <= start and newest >= end:
+                    print(f"!! filled live feed gap {start}-{end} ({(end - start) / 1000:.0f}s) from the newest {pages} history pages")
+                    database.add_coverage(start, end, "history")
+                else:
+                    print(f"!! history doesn't reach over live feed gap {start}-{end} yet, leaving it for later")
+    return fetched
+
+def _spawn_thread(target: Callable[[], None]) -> threading.Thread:
+    thread = threading.Thread(target=target, daemon=True)
+    thread.start()
+    return thread
+
+class LiveFeed:
+    """ Listener for the API live websocket
+
+    on_result: a callback for GAME_RESULT events, called once the result has been saved to the database
+    on_begin: a callback for GAME_BEGIN events
+    url: websocket address, overridable for testing against a local server
+    on_known: a callback for GAME_RESULT events of games that turned out to be stored already, e.g. from the history
+
+    Receiving and processing run as two separate tasks: the receive loop only decodes messages, drops duplicates
+    (the API sends some events twice) and queues them, so database work never holds up reading the socket.
+    That includes recording the covered periods, which are queued along with the events.
+    Results are saved in batches by a BatchWriter (see `writer`).
+    The connection is re-established with exponential backoff whenever it drops. The periods during which it was
+    connected are recorded in the database, so that `reconcile_history` can fill the gaps between them.
+    """
+
+    def __init__(self, on_result: ResultCallback, on_begin: BeginCallback, url: str = WS_BASE + "/live",
+            on_known: Optional[ResultCallback] = None):
+        self.on_begin = on_begin
+        self.on_result = on_result
+        self.url = url
+        self.writer = BatchWriter(self._saved, on_known=on_known)
+        self.events: "queue.Queue[Optional[dict]]" = queue.Queue()
+        # recently seen (type, gameId) pairs
+        self._seen = LRUCache(LIVE_DEDUPE_SIZE)
+        self._stopping = threading.Event()
+        # (connection time, live_coverage id) of the period being recorded
+        self._period: Optional[Tuple[Timestamp, Optional[int]]] = None
+        self._tasks: list = []
+        self.received = 0
+        self.duplicates = 0
+        self.reconnects = 0
+
+    def start(self, spawn: Callable[[Callable[[], None]], object] = _spawn_thread) -> None:
+        """ Start listening. `spawn` starts a background task; pass e.g. `socketio.start_background_task`
+        to run the tasks the same way as the rest of the server. """
+        self.writer.start(spawn)
+        self._tasks = [spawn(self._receive_loop), spawn(self._process_loop)]
 
-    def _live_ws_callback(ws: websocket.WebSocketApp, message: str) -> None:
+    def stop(self) -> None:
+        """ Stop listening, after processing and saving everything already received """
+        self._stopping.set()
+        # the receive loop (all but the last task) first, so that the end of its covered period is queued before the stop
+        for task in self._tasks[:-1]:
+            task.join()
+        self.events.put(None)
+        for task in self._tasks[-1:]:
+            task.join()
+        self.writer.stop()
+
+    def _receive_loop(self) -> None:
+        backoff = LIVE_RECONNECT_BACKOFF
+        while not self._stopping.is_set():
+            try:
+                ws = websocket.create_connection(self.url, timeout=LIVE_RECV_TIMEOUT)
+            except (websocket.WebSocketException, OSError) as e:
+                print(f"Error connecting to live feed ({e}), retrying in {backoff:.1f}s")
+                self._stopping.wait(backoff)
+                backoff = min(backoff * 2, LIVE_RECONNECT_BACKOFF_MAX)
+                continue
+
+            backoff = LIVE_RECONNECT_BACKOFF
+            # the covered period is only noted here, and recorded by the process loop, as it writes to the database
+            connected = _now()
+            self.events.put({'type': _COVERAGE, 'start': connected, 'end': connected})
+            heartbeat = time.monotonic()
+            try:
+                while not self._stopping.is_set():
+                    if time.monotonic() - heartbeat >= LIVE_COVERAGE_HEARTBEAT:
+                        self.events.put({'type': _COVERAGE, 'start': connected, 'end': _now()})
+                        heartbeat = time.monotonic()
+                    try:
+                        message = ws.recv()
+                    except websocket.WebSocketTimeoutException:
+                        # no events for a while; just check whether we should stop
+                        continue
+                    self._handle(message)
+            except (websocket.WebSocketException, OSError) as e:
+                print(f"Live feed disconnected ({e}), reconnecting")
+                self.reconnects += 1
+            finally:
+                ws.close()
+                self.events.put({'type': _COVERAGE, 'start': connected, 'end': _now()})
+
+    def _handle(self, message: str) -> None:
+        """ Decode and deduplicate a message, and queue it for processing """
         try:
             data = json.loads(json.loads(message))
-        except json.decoder.JSONDecodeError as e:
+        except (json.decoder.JSONDecodeError, TypeError) as e:
             print(f"Error decoding websocket response ({e}): {message[:100]}")
             return
-        if 'type' in data:
-            if data['type'] == 'GAME_BEGIN':
-                beg = database.begin_from_api_begin(data)
-                begin_callback(beg)
-
-            elif data['type'] == 'GAME_RESULT':
-                res = database.result_from_api_result(data)
-                database.add_game_result(res)
-                result_callback(res)
-        else:
-            print(f"no 'type' in {data.keys()}")
-
-    url = WS_BASE + "/live"
-    wsapp = websocket.WebSocketApp(url, on_message=_live_ws_callback)
-    return wsapp
+        if not isinstance(data, dict) or 'type' not in data or 'gameId' not in data:
+            print(f"Unexpected live event: {str(data)[:100]}")
+            return
+
+        self.received += 1
+        key = (data['type'], data['gameId'])
+        if key in self._seen:
+            self.duplicates += 1
+            _LIVE_DUPLICATES.inc()
+            return
+        _LIVE_EVENTS.inc(type=data['type'])
+        self._seen.put(key, True)
+        self.events.put(data)
+
+    def _process_loop(self) -> None:
+        while True:
+            data = self.events.get()
+            if data is None:
+                return
+            if data['type'] == _COVERAGE:
+                self._cover(data['start'], data['end'])
+                continue
+            try:
+                with _LIVE_EVENT_SECONDS.time(type=data['type']):
+                    self._process(data)
+            except Exception as e:
+                # one bad event must not stop the whole feed
+                print(f"Error processing live event {data.get('gameId')}: {e!r}")
+
+    def _process(self, data: dict) -> None:
+        if data['type'] == 'GAME_BEGIN':
+            beg = database.begin_from_api_begin(data)
+            self.on_begin(beg)
+
+        elif data['type'] == 'GAME_RESULT':
+            res = database.result_from_api_result(data)
+            self.writer.submit(res)
+
+    def _cover(self, connected: Timestamp, now: Timestamp) -> None:
+        """ Record the live feed's connection since `connected` as covering the time up to `now` """
+        try:
+            if self._period is None or self._period[0] != connected:
+                self._period = (connected, database.add_coverage(connected, now, "live"))
+            elif self._period[1] is not None:
+                database.extend_coverage(self._period[1], now)
+        except Exception as e:
+            # the gap is left for reconciling to fill
+            print(f"Error recording live feed coverage: {e!r}")
+
+    def _saved(self, game: GameResult) -> None:
+        """ Called by the writer once a result has been committed """
+        _LIVE_RESULT_LAG.observe(max(time.time() - game.t / 1000, 0.0))
+        self.on_result(game)
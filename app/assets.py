@@ -0,0 +1,109 @@
+""" Static assets, fingerprinted and compressed once on startup
+
+Every file in the static folder gets a name with a hash of its contents, e.g. `style.3f2a9c1d04b7.css`, which
+`url_for('static', ...)` then returns. The name changes whenever the contents do, so browsers can cache the files
+forever instead of revalidating them on every page view. The files are kept in memory, along with their gzip and
+(if the `brotli` module is installed) brotli compressed versions, and served in the best encoding the browser accepts.
+"""
+
+import gzip
+import hashlib
+import mimetypes
+import os
+
+from flask import Flask, Response, current_app, request
+from typing import Dict, NamedTuple, Optional
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+ASSET_HASH_LENGTH = 12          # hex digits of the content hash in file names
+ASSET_MAX_AGE = 365 * 24 * 3600 # seconds; fingerprinted files never change, so cache them for a year
+ASSET_GZIP_LEVEL = 9            # compression happens once, so use the best levels
+ASSET_BROTLI_QUALITY = 11
+
+# types worth compressing; images and fonts mostly are already
+COMPRESSIBLE_TYPES = ("text/", "application/javascript", "application/json", "image/svg+xml")
+
+
+class Asset(NamedTuple):
+    data: bytes
+    mimetype: str
+    digest: str
+    encoded: Dict[str, bytes]   # content encoding -> compressed data, best first; only those smaller than `data`
+
+def _compress(data: bytes) -> Dict[str, bytes]:
+    encoded = {}
+    if brotli is not None:
+        encoded['br'] = brotli.compress(data, quality=ASSET_BROTLI_QUALITY)
+    encoded['gzip'] = gzip.compress(data, ASSET_GZIP_LEVEL, mtime=0)
+    return {encoding: body for encoding, body in encoded.items() if len(body) < len(data)}
+
+def _fingerprinted(filename: str, digest: str) -> str:
+    """ e.g. 'css/style.css' -> 'css/style.<digest>.css' """
+    base, ext = os.path.splitext(filename)
+    return f"{base}.{digest}{ext}"
+
+
+class StaticAssets:
+    """ Fingerprinted and precompressed copies of an app's static files
+
+    `init_app` builds them, and takes over the app's static route: fingerprinted names are served from memory
+    with immutable caching headers, anything else (e.g. an old link to `style.css`) falls back to Flask's own
+    handling, with its default caching. Files added or changed after startup are only picked up by that fallback.
+    """
+
+    def __init__(self):
+        self.names: Dict[str, str] = {}     # file name -> fingerprinted name
+        self.files: Dict[str, Asset] = {}   # fingerprinted name -> asset
+
+    def build(self, folder: str) -> None:
+        names, files = {}, {}
+        for root, _, filenames in os.walk(folder):
+            for name in filenames:
+                path = os.path.join(root, name)
+                filename = os.path.relpath(path, folder).replace(os.sep, "/")
+                with open(path, "rb") as f:
+                    data = f.read()
+                digest = hashlib.sha256(data).hexdigest()[:ASSET_HASH_LENGTH]
+                mimetype = mimetypes.guess_type(filename)[0] or "application/octet-stream"
+                encoded = _compress(data) if mimetype.startswith(COMPRESSIBLE_TYPES) else {}
+                names[filename] = _fingerprinted(filename, digest)
+                files[names[filename]] = Asset(data, mimetype, digest, encoded)
+        self.names, self.files = names, files
+
+    def init_app(self, app: Flask) -> None:
+        self.build(app.static_folder)
+        app.url_defaults(self._url_defaults)
+        app.view_functions['static'] = self.serve
+
+    def _url_defaults(self, endpoint: str, values: dict) -> None:
+        if endpoint == 'static':
+            filename = values.get('filename')
+            values['filename'] = self.names.get(filename, filename)
+
+    def _encoding(self, asset: Asset) -> Optional[str]:
+        for encoding in asset.encoded:
+            if request.accept_encodings[encoding]:
+                return encoding
+        return None
+
+    def serve(self, filename: str) -> Response:
+        asset = self.files.get(filename)
+        if asset is None:
+            return current_app.send_static_file(filename)
+
+        encoding = self._encoding(asset)
+        response = Response(asset.encoded[encoding] if encoding else asset.data, mimetype=asset.mimetype)
+        if encoding:
+            response.content_encoding = encoding
+        response.vary.add('Accept-Encoding')
+        # each encoding is a different representation, so needs an ETag of its own
+        response.set_etag(f"{asset.digest}-{encoding}" if encoding else asset.digest)
+        response.cache_control.public = True
+        response.cache_control.max_age = ASSET_MAX_AGE
+        response.cache_control.immutable = True
+        return response.make_conditional(request)
@@ -0,0 +1,85 @@
+""" Coalesced broadcasts of live game events to SocketIO clients """
+
+import threading
+import time
+
+import metrics
+
+from typing import Callable, Dict, Union
+from live import LiveGames, coalesce
+
+
+BROADCAST_TICK = 0.1    # seconds between batched frames
+
+_EMIT_SECONDS = metrics.histogram("rps_broadcast_emit_seconds", "Time taken to send a frame of live game changes to all clients")
+
+
+class Broadcaster:
+    """ Sends the changes to the live games to clients as one frame per tick
+
+    source: the live games to follow
+    emit: called with each frame (see `live.coalesce`), or with a full snapshot if the changes since the
+        previous frame are no longer known
+
+    A game which both begins and finishes within the same tick is left out of the frame altogether,
+    as clients would only add it and remove it again right away.
+    """
+
+    def __init__(self, source: LiveGames, emit: Callable[[dict], None], tick: float = BROADCAST_TICK):
+        self.source = source
+        self.emit = emit
+        self.tick = tick
+        self._sent = source.seq
+        self._lock = threading.Lock()
+        self._stopping = threading.Event()
+        self._task = None
+        # metrics
+        self.started = time.monotonic()
+        self.events = 0         # changes to the live games
+        self.cancelled = 0      # changes left out, as their begin and result fell in the same tick
+        self.frames = 0         # frames sent
+
+    def flush(self) -> None:
+        """ Send everything that changed since the last frame, if anything """
+        with self._lock:
+            deltas = self.source.deltas_since(self._sent)
+            if deltas is None:
+                frame = self.source.snapshot()
+            elif not deltas:
+                return
+            else:
+                frame = coalesce(self.source.epoch, self._sent, deltas)
+                self.events += len(deltas)
+                self.cancelled += len(deltas) - len(frame['begin']) - len(frame['result'])
+            self._sent = frame['to']
+            self.frames += 1
+        with _EMIT_SECONDS.time():
+            self.emit(frame)
+
+    def start(self, spawn: Callable[[Callable[[], None]], object], sleep: Callable[[float], None] = time.sleep) -> None:
+        """ Start sending frames every tick. `spawn` and `sleep` should match the server's async mode,
+        e.g. `socketio.start_background_task` and `socketio.sleep`. """
+        def run():
+            while not self._stopping.is_set():
+                sleep(self.tick)
+                try:
+                    self.flush()
+                except Exception as e:
+                    print(f"Error broadcasting live games: {e!r}")
+        self._task = spawn(run)
+
+    def stop(self) -> None:
+        self._stopping.set()
+        if self._task is not None:
+            self._task.join()
+        self.flush()
+
+    def stats(self) -> Dict[str, Union[int, float]]:
+        elapsed = max(time.monotonic() - self.started, 1e-9)
+        return {
+            'events': self.events,
+            'cancelled': self.cancelled,
+            'frames': self.frames,
+            'events_per_second': self.events / elapsed,
+            'frames_per_second': self.frames / elapsed,
+        }
@@ -0,0 +1,321 @@
+""" Live event bus, from the ingest worker to any number of web workers
+
+A single ingest worker keeps the API connection, saves results, and publishes what happens with `BusPublisher`.
+Web workers follow it with `BusSubscriber`, each keeping its own live games and SocketIO clients up to date.
+The transport is a local TCP socket carrying one JSON object per line:
+
+    {"type": "state", "games": [GameBegin, ...], "row": int}   the live games; always sent first on a connection
+    {"type": "begin", "game": GameBegin}
+    {"type": "result", "game": GameResult, "new": bool, "row": int}
+    {"type": "players", "players": {name: id}}                  players just created
+
+with games in their `as_json` form. `new` is false for results of games that were stored already. "row" is the
+game_rows rowid of a new result, and in "state" the newest one saved (see `database.get_last_game_row`); either
+may be null if unknown.
+
+Since every connection starts with the full state, a web worker which (re)connects, e.g. after the ingest worker
+restarted or dropped it for falling behind, ends up with the same live games without any replay. The results it
+missed meanwhile are read from the database instead, up to the state's row; `AppliedRows` keeps track of which
+results have been applied, so that none is counted twice.
+"""
+
+import functools
+import json
+import queue
+import socket
+import threading
+import time
+
+import metrics
+from apityping import GameBegin, GameId, GameResult, PlayerId, PlayerName, as_json, from_json
+from live import LIVE_GAME_TTL
+
+from typing import Callable, Dict, List, Optional, Set, Tuple
+
+
+BUS_HOST = "127.0.0.1"
+BUS_PORT = 5100
+BUS_SEND_QUEUE = 10_000         # events waiting for a subscriber, at most; one further behind is disconnected
+BUS_RECONNECT_BACKOFF = 0.5     # seconds, doubled after every failed connection attempt...
+BUS_RECONNECT_BACKOFF_MAX = 10.0 # ...up to this
+
+_BUS_EVENTS = metrics.counter("rps_bus_events_total", "Live bus events published or received, by type", ["type"])
+_BUS_SUBSCRIBERS = metrics.counter("rps_bus_subscriber_changes_total",
+    "Subscribers connecting to the live bus, and disconnecting (or dropped for falling behind)", ["change"])
+
+Address = Tuple[str, int]
+
+def parse_address(address: str) -> Address:
+    """ "host:port" -> (host, port) """
+    host, _, port = address.rpartition(":")
+    return host or BUS_HOST, int(port)
+
+def _spawn_thread(target: Callable[[], None]) -> threading.Thread:
+    thread = threading.Thread(target=target, daemon=True)
+    thread.start()
+    return thread
+
+def _encode(event: dict) -> bytes:
+    return json.dumps(event, separators=(',', ':')).encode() + b"\n"
+
+
+class _Subscriber:
+    """ A connected web worker, with the events still to be sent to it """
+
+    def __init__(self, sock: socket.socket, peer):
+        self.sock = sock
+        self.peer = peer
+        self.queue: "queue.Queue[Optional[bytes]]" = queue.Queue(maxsize=BUS_SEND_QUEUE)
+
+    def run(self, remove: Callable[["_Subscriber"], None]) -> None:
+        try:
+            while True:
+                line = self.queue.get()
+                if line is None:
+                    return
+                self.sock.sendall(line)
+        except OSError:
+            pass
+        finally:
+            remove(self)
+            self.sock.close()
+
+    def close(self) -> None:
+        """ Disconnect; the sending thread ends on its next send, or right away if it is waiting for events """
+        self.sock.close()
+        try:
+            self.queue.put_nowait(None)
+        except queue.Full:
+            pass
+
+
+class BusPublisher:
+    """ The ingest worker's end of the bus
+
+    The callbacks `begin`, `result`, `known` and `players` publish the corresponding events, and fit
+    `apiconn.LiveFeed` and `database.on_players_created`. Each subscriber is sent its events by a thread of its
+    own, so a slow one never holds up ingest; one that falls BUS_SEND_QUEUE events behind is disconnected,
+    and gets the current state when it reconnects.
+    """
+
+    def __init__(self, address: Address = (BUS_HOST, BUS_PORT), ttl: float = LIVE_GAME_TTL,
+            mark: Optional[Callable[[], int]] = None):
+        self.address = address
+        self.ttl = ttl
+        # the newest game_rows rowid saved, for new subscribers to catch up to; read while holding the lock, so
+        # that results published before the state are all up to it, and those published after it all beyond it
+        self.mark = mark
+        # live games, as sent to new subscribers: game id -> (as_json, time.monotonic() when it began)
+        self._games: Dict[GameId, Tuple[dict, float]] = {}
+        self._subscribers: List[_Subscriber] = []
+        # held while changing the state and queueing the event, so that subscribers see the two in the same order
+        self._lock = threading.Lock()
+        self._server: Optional[socket.socket] = None
+        self._stopped = False
+        self._spawn: Callable[[Callable[[], None]], object] = _spawn_thread
+
+    def start(self, spawn: Callable[[Callable[[], None]], object] = _spawn_thread) -> None:
+        """ Start accepting subscribers. `spawn` starts a background task. """
+        self._spawn = spawn
+        self._server = socket.create_server(self.address)
+        self.address = self._server.getsockname()[:2]
+        spawn(self._accept_loop)
+
+    def stop(self) -> None:
+        if self._server is not None:
+            try:
+                # closing alone doesn't wake up a blocked accept, which would then take one more subscriber
+                self._server.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            self._server.close()
+        with self._lock:
+            self._stopped = True
+            subscribers, self._subscribers = self._subscribers, []
+        for subscriber in subscribers:
+            subscriber.close()
+
+    def _accept_loop(self) -> None:
+        while True:
+            try:
+                sock, peer = self._server.accept()
+            except OSError:
+                return
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            subscriber = _Subscriber(sock, peer)
+            with self._lock:
+                if self._stopped:
+                    sock.close()
+                    return
+                deadline = time.monotonic() - self.ttl
+                self._games = {gid: entry for gid, entry in self._games.items() if entry[1] > deadline}
+                try:
+                    row = self.mark() if self.mark is not None else None
+                except Exception as e:
+                    print(f"Error reading the saved games mark for a live bus subscriber: {e!r}")
+                    row = None
+                subscriber.queue.put_nowait(_encode({'type': "state", 'games': [game for game, _ in self._games.values()],
+                    'row': row}))
+                self._subscribers.append(subscriber)
+            _BUS_SUBSCRIBERS.inc(change="connected")
+            self._spawn(functools.partial(subscriber.run, self._remove))
+
+    def _remove(self, subscriber: _Subscriber) -> None:
+        with self._lock:
+            if subscriber in self._subscribers:
+                self._subscribers.remove(subscriber)
+                _BUS_SUBSCRIBERS.inc(change="disconnected")
+
+    def _publish(self, event: dict) -> None:
+        """ Queue the event for every subscriber. Must hold the lock. """
+        line = _encode(event)
+        for subscriber in list(self._subscribers):
+            try:
+                subscriber.queue.put_nowait(line)
+            except queue.Full:
+                print(f"Live bus subscriber {subscriber.peer} fell behind, disconnecting it")
+                self._subscribers.remove(subscriber)
+                _BUS_SUBSCRIBERS.inc(change="disconnected")
+                subscriber.close()
+        _BUS_EVENTS.inc(type=event['type'])
+
+    def begin(self, game: GameBegin) -> None:
+        data = as_json(game)
+        with self._lock:
+            self._games[game.gameId] = (data, time.monotonic())
+            self._publish({'type': "begin", 'game': data})
+
+    def result(self, game: GameResult, new: bool = True, row: Optional[int] = None) -> None:
+        with self._lock:
+            self._games.pop(game.gameId, None)
+            self._publish({'type': "result", 'game': as_json(game), 'new': new, 'row': row})
+
+    def known(self, game: GameResult) -> None:
+        """ A result of a game which was stored already """
+        self.result(game, new=False)
+
+    def players(self, players: Dict[PlayerName, PlayerId]) -> None:
+        with self._lock:
+            self._publish({'type': "players", 'players': players})
+
+    def subscribers(self) -> int:
+        return len(self._subscribers)
+
+
+class BusSubscriber:
+    """ A web worker's end of the bus
+
+    on_state: called with the live games and the publisher's saved games mark, on every (re)connection
+    on_begin, on_result: called for each event; on_result also gets whether the game was new, and its row
+    on_players: called with newly created players, {name: id}
+
+    Reconnects with exponential backoff whenever the connection drops.
+    """
+
+    def __init__(self, on_state: Callable[[List[GameBegin], Optional[int]], None], on_begin: Callable[[GameBegin], None],
+            on_result: Callable[[GameResult, bool, Optional[int]], None], on_players: Callable[[Dict[PlayerName, PlayerId]], None],
+            address: Address = (BUS_HOST, BUS_PORT)):
+        self.on_state = on_state
+        self.on_begin = on_begin
+        self.on_result = on_result
+        self.on_players = on_players
+        self.address = address
+        self.connected = threading.Event()
+        self._sock: Optional[socket.socket] = None
+        self._stopping = threading.Event()
+        self._task = None
+        self.received = 0
+        self.reconnects = 0
+
+    def start(self, spawn: Callable[[Callable[[], None]], object] = _spawn_thread) -> None:
+        self._task = spawn(self._run)
+
+    def stop(self) -> None:
+        self._stopping.set()
+        sock = self._sock
+        if sock is not None:
+            try:
+                # wakes up the blocked read
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+        if self._task is not None:
+            self._task.join()
+
+    def _run(self) -> None:
+        backoff = BUS_RECONNECT_BACKOFF
+        while not self._stopping.is_set():
+            try:
+                self._sock = socket.create_connection(self.address)
+            except OSError as e:
+                print(f"Error connecting to live bus at {self.address} ({e}), retrying in {backoff:.1f}s")
+                self._stopping.wait(backoff)
+                backoff = min(backoff * 2, BUS_RECONNECT_BACKOFF_MAX)
+                continue
+
+            backoff = BUS_RECONNECT_BACKOFF
+            try:
+                with self._sock.makefile("rb") as lines:
+                    for line in lines:
+                        self._handle(line)
+            except OSError as e:
+                print(f"Live bus connection lost ({e})")
+            finally:
+                self.connected.clear()
+                self._sock.close()
+            if not self._stopping.is_set():
+                print("Live bus disconnected, reconnecting")
+                self.reconnects += 1
+
+    def _handle(self, line: bytes) -> None:
+        try:
+            event = json.loads(line)
+            kind = event['type']
+            if kind == "state":
+                self.on_state([from_json(game) for game in event['games']], event.get('row'))
+                self.connected.set()
+            elif kind == "begin":
+                self.on_begin(from_json(event['game']))
+            elif kind == "result":
+                self.on_result(from_json(event['game']), event['new'], event.get('row'))
+            elif kind == "players":
+                self.on_players(event['players'])
+            else:
+                print(f"Unexpected live bus event: {line[:100]!r}")
+                return
+        except Exception as e:
+            # one bad event must not stop the whole bus
+            print(f"Error handling live bus event {line[:100]!r}: {e!r}")
+            return
+        self.received += 1
+        _BUS_EVENTS.inc(type=kind)
+
+
+class AppliedRows:
+    """ The game_rows rowids of the saved games a web worker has applied: all up to `mark`, and those in `above`
+
+    Rowids are given out in order, without holes, so `above` only holds the few results published out of order
+    (e.g. by the live feed and the history fetch at the same time), and empties as the mark moves past them.
+    """
+
+    def __init__(self, mark: int):
+        self.mark = mark
+        self.above: Set[int] = set()
+
+    def add(self, row: Optional[int]) -> bool:
+        """ Record the game of `row` as applied. False if it was already; True if it is new, or its row unknown. """
+        if row is None:
+            return True
+        if row <= self.mark or row in self.above:
+            return False
+        self.above.add(row)
+        while self.mark + 1 in self.above:
+            self.mark += 1
+            self.above.remove(self.mark)
+        return True
+
+    def advance(self, mark: int) -> None:
+        """ Everything up to `mark` has been applied, e.g. after catching up with the database """
+        if mark > self.mark:
+            self.mark = mark
+            self.above = {row for row in self.above if row > mark}
@@ -0,0 +1,146 @@
+""" In-memory caches """
+
+import threading
+import time
+from collections import OrderedDict
+
+from typing import Any, Dict, Hashable, Iterable, Optional, Set, Tuple
+
+
+class LRUCache:
+    """ Thread-safe mapping which evicts the least recently used entries once it grows past `maxsize`
+
+    ttl:
+        If given, entries also expire this many seconds after being stored.
+
+    Entries can be stored with a tag, to later drop all entries of that tag at once (see `invalidate_tag`).
+    A value computed while its tag was being invalidated can be kept out by passing the tag's `generation`,
+    read before computing it, to `put`.
+    Keeps hit/miss/eviction counters, see `stats()`.
+    """
+
+    def __init__(self, maxsize: int, ttl: Optional[float] = None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        # key -> (value, expiry time or None, tag)
+        self._data: "OrderedDict[Hashable, Tuple[Any, Optional[float], Hashable]]" = OrderedDict()
+        self._tags: Dict[Hashable, Set[Hashable]] = {}
+        # tag -> number of times it was invalidated; one int per tag ever invalidated
+        self._generations: Dict[Hashable, int] = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def _lookup(self, key: Hashable, now: Optional[float]) -> Tuple[bool, Any]:
+        """ (found, value) of the key, counting a hit or miss. Must hold the lock. """
+        try:
+            value, expires, _ = self._data[key]
+        except KeyError:
+            self.misses += 1
+            return False, None
+        if expires is not None and now is not None and expires <= now:
+            self._remove(key)
+            self.misses += 1
+            return False, None
+        self._data.move_to_end(key)
+        self.hits += 1
+        return True, value
+
+    def _remove(self, key: Hashable) -> None:
+        """ Drop an entry, keeping the tag index in sync. Must hold the lock. """
+        _, _, tag = self._data.pop(key)
+        if tag is not None:
+            keys = self._tags[tag]
+            keys.discard(key)
+            if not keys:
+                del self._tags[tag]
+
+    def _now(self) -> Optional[float]:
+        return time.monotonic() if self.ttl is not None else None
+
+    def get(self, key: Hashable, default: Optional[Any] = None) -> Any:
+        now = self._now()
+        with self._lock:
+            found, value = self._lookup(key, now)
+        return value if found else default
+
+    def get_many(self, keys: Iterable[Hashable]) -> Dict[Hashable, Any]:
+        """ Return the cached subset of `keys` as a dict. Keys not in the cache are left out. """
+        now = self._now()
+        found = {}
+        with self._lock:
+            for key in keys:
+                ok, value = self._lookup(key, now)
+                if ok:
+                    found[key] = value
+        return found
+
+    def generation(self, tag: Hashable) -> int:
+        """ How many times the tag has been invalidated, for `put` """
+        with self._lock:
+            return self._generations.get(tag, 0)
+
+    def put(self, key: Hashable, value: Any, tag: Optional[Hashable] = None, generation: Optional[int] = None) -> bool:
+        return self.update({key: value}, tag, generation)
+
+    def update(self, items: Dict[Hashable, Any], tag: Optional[Hashable] = None,
+            generation: Optional[int] = None) -> bool:
+        """ Store the items. If `generation` is given and the tag has been invalidated since it was read, the
+        items may be out of date, and are not stored: returns False then, else True. """
+        now = self._now()
+        expires = now + self.ttl if now is not None else None
+        with self._lock:
+            if generation is not None and self._generations.get(tag, 0) != generation:
+                return False
+            for key, value in items.items():
+                if key in self._data:
+                    self._remove(key)
+                self._data[key] = (value, expires, tag)
+                if tag is not None:
+                    self._tags.setdefault(tag, set()).add(key)
+            while len(self._data) > self.maxsize:
+                self._remove(next(iter(self._data)))
+                self.evictions += 1
+        return True
+
+    def pop(self, key: Hashable, default: Optional[Any] = None) -> Any:
+        with self._lock:
+            if key not in self._data:
+                return default
+            value = self._data[key][0]
+            self._remove(key)
+            return value
+
+    def invalidate_tag(self, tag: Hashable) -> int:
+        """ Drop all entries stored with the given tag. Returns the number of entries dropped. """
+        with self._lock:
+            self._generations[tag] = self._generations.get(tag, 0) + 1
+            keys = self._tags.pop(tag, ())
+            for key in keys:
+                del self._data[key]
+            self.invalidations += len(keys)
+            return len(keys)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+            self._tags.clear()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def __contains__(self, key: Hashable) -> bool:
+        """ Membership test. Does not count as a hit or miss, nor refresh the entry. """
+        return key in self._data
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            'size': len(self._data),
+            'maxsize': self.maxsize,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'invalidations': self.invalidations,
+        }
@@ -1,25 +1,372 @@
 """ Database abstraction layer """
 
+import atexit
+import base64
+import binascii
+import json
+import os
 import sqlite3
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from urllib.parse import quote
 from uuid import uuid4
 import rps
 import math
+import metrics
+from cache import LRUCache
 
-from typing import Optional, List, Dict, Tuple
-from apityping import APIGameResult, GameResult, APIGameBegin, GameBegin, GameId, Timestamp, Player, PlayerName, PlayerId
+from typing import Callable, Optional, List, Dict, Iterable, NamedTuple, Tuple, Iterator
+from apityping import APIGameResult, GameResult, APIGameBegin, GameBegin, GameId, Timestamp, Player, PlayerPlay, PlayerName, PlayerId
 
 
 DB_FILE = 'results.db'
+MIGRATIONS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'migrations')
 GAMES_PAGE_LENGTH = 20
+SQL_VARIABLE_CHUNK = 500 # max. number of values bound in a single `IN (...)` query
+PLAYER_CACHE_SIZE = 100_000
+RECENT_GAMES_SIZE = 100_000 # ids of recently saved games, remembered to skip duplicates without querying
+
+# Connection tuning. Connections are long-lived, so these are applied once per connection instead of per query.
+POOL_SIZE = 8                   # idle connections kept around for reuse
+STATEMENT_CACHE_SIZE = 256      # prepared statements cached by the sqlite3 module, per connection
+BUSY_TIMEOUT = 5.0              # seconds to wait on a locked database before giving up
+PRAGMAS = (
+    "PRAGMA journal_mode = WAL",    # readers don't block the writer, nor vice versa
+    "PRAGMA synchronous = NORMAL",  # safe with WAL; only the last transactions may be lost on power failure
+    "PRAGMA temp_store = MEMORY",
+    "PRAGMA cache_size = -16000",   # negative means KiB, i.e. 16 MiB page cache per connection
+    "PRAGMA mmap_size = 268435456",
+)
+# for the read-only connections to a read snapshot, see `ReadSnapshot`
+SNAPSHOT_PRAGMAS = (
+    "PRAGMA temp_store = MEMORY",
+    "PRAGMA cache_size = -16000",
+    "PRAGMA mmap_size = 268435456",
+)
+
+
+_QUERY_SECONDS = metrics.histogram("rps_db_query_seconds", "Duration of database functions, by function", ["query"])
+_GAMES_SAVED = metrics.counter("rps_db_games_saved_total", "Finished games saved to the database, by source", ["source"])
+_SNAPSHOT_READS = metrics.counter("rps_db_snapshot_reads_total",
+    "Page reads while a read snapshot is enabled, by what served them: the snapshot, or the primary database "
+    "because the snapshot was too old or lacked the player's newest games", ["source"])
+_GAMES_DUPLICATE = metrics.counter("rps_db_duplicate_games_total",
+    "Finished games skipped as already saved, by source and by whether the recent ids or the database caught them", ["source", "check"])
+# decorator for the public functions below; labels them with their name
+_timed = _QUERY_SECONDS.timed(query=None)
+
+class ConnectionPool:
+    """ Pool of long-lived SQLite connections
+
+    A connection is checked out for the duration of a `connection()` block and returned to the pool afterwards.
+    Nested blocks in the same thread reuse the already checked out connection, so helpers can freely call each other.
+    "Thread" here is whatever `threading.local` tracks, meaning greenlets when running under eventlet's monkey patching.
+    """
+
+    def __init__(self, path: str, size: int = POOL_SIZE, read_only: bool = False):
+        self.path = path
+        self.size = size
+        self.read_only = read_only
+        self._idle: List[sqlite3.Connection] = []
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._closed = False
+
+    def _connect(self) -> sqlite3.Connection:
+        # connections may be handed to a different thread on their next checkout, hence check_same_thread=False;
+        # the pool guarantees that only one thread uses a connection at a time.
+        if self.read_only:
+            # for files that never change while open, so SQLite can skip locking altogether
+            con = sqlite3.connect(f"file:{quote(self.path)}?mode=ro&immutable=1", uri=True,
+                cached_statements=STATEMENT_CACHE_SIZE, check_same_thread=False)
+            pragmas = SNAPSHOT_PRAGMAS
+        else:
+            con = sqlite3.connect(self.path, timeout=BUSY_TIMEOUT,
+                cached_statements=STATEMENT_CACHE_SIZE, check_same_thread=False)
+            pragmas = PRAGMAS
+        for pragma in pragmas:
+            con.execute(pragma)
+        return con
+
+    def _acquire(self) -> sqlite3.Connection:
+        with self._lock:
+            if self._closed:
+                raise sqlite3.ProgrammingError("Connection pool has been closed")
+            if self._idle:
+                return self._idle.pop()
+        return self._connect()
+
+    def _release(self, con: sqlite3.Connection) -> None:
+        if con.in_transaction:
+            # never hand out a connection with someone else's half-finished transaction
+            con.rollback()
+        with self._lock:
+            if not self._closed and len(self._idle) < self.size:
+                self._idle.append(con)
+                return
+        con.close()
 
+    @contextmanager
+    def connection(self) -> Iterator[sqlite3.Connection]:
+        con = getattr(self._local, 'con', None)
+        if con is not None:
+            yield con
+            return
+
+        con = self._acquire()
+        self._local.con = con
+        try:
+            yield con
+        finally:
+            self._local.con = None
+            self._release(con)
+
+    def close(self) -> None:
+        """ Close all idle connections. Connections currently checked out are closed when released. """
+        with self._lock:
+            self._closed = True
+            idle, self._idle = self._idle, []
+        for con in idle:
+            con.close()
+
+
+_pool: Optional[ConnectionPool] = None
+_pool_lock = threading.Lock()
+_write_lock = threading.RLock()
+
+# player name -> id, in front of the players table. Ids never change once created.
+_player_ids = LRUCache(PLAYER_CACHE_SIZE)
+# ids of games known to be saved (the value is unused). Games are never deleted, so these never go stale.
+_saved_games = LRUCache(RECENT_GAMES_SIZE)
+
+def _get_pool() -> ConnectionPool:
+    global _pool
+    # created lazily, so that DB_FILE can still be changed (e.g. by scripts) before first use
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = ConnectionPool(DB_FILE)
+    return _pool
+
+@contextmanager
+def _connection() -> Iterator[sqlite3.Connection]:
+    """ Check out a pooled connection for the duration of the block """
+    with _get_pool().connection() as con:
+        yield con
+
+@contextmanager
+def _transaction() -> Iterator[sqlite3.Cursor]:
+    """ Run the block in a single transaction: committed on success, rolled back on any exception
+
+    Transactions are serialized within the process (SQLite only allows one writer at a time anyway),
+    so a check-then-insert inside one cannot race with another thread doing the same. """
+    with _write_lock, _connection() as con:
+        with con:
+            yield con.cursor()
+
+@atexit.register
+def close() -> None:
+    """ Close all pooled connections, and remove the read snapshot if there is one. Called automatically on interpreter exit. """
+    global _pool, _snapshot
+    with _pool_lock:
+        pool, _pool = _pool, None
+        snapshot, _snapshot = _snapshot, None
+    if pool is not None:
+        pool.close()
+    if snapshot is not None:
+        snapshot.close()
+
+
+class ReadSnapshot:
+    """ A periodically refreshed, read-only copy of the database, so that page reads don't compete with ingest writes
+
+    `refresh()` copies the database with SQLite's backup API into a new file, and swaps in a pool of connections
+    to it. The copy is made in a single step, so it is consistent, and in WAL mode writers carry on meanwhile.
+    The previous copy is kept until the next refresh, for reads that were still using it.
+
+    The snapshot is not used once it is older than `max_age` seconds (e.g. if refreshing fails), nor for the
+    games of players who have had games saved since it was taken: those reads go to the primary database instead.
+    """
+
+    def __init__(self, max_age: float, directory: Optional[str] = None):
+        self.max_age = max_age
+        self._own_directory = directory is None
+        self.directory = directory or tempfile.mkdtemp(prefix="rps-snapshot-")
+        # (pool, path, time.monotonic() when taken), replaced as a whole
+        self._current: Optional[Tuple[ConnectionPool, str, float]] = None
+        self._previous: Optional[Tuple[ConnectionPool, str, float]] = None
+        # players with games saved since the current snapshot was taken -> when
+        self._written: Dict[PlayerId, float] = {}
+        self._lock = threading.Lock()
+        self._generation = 0
+        self.refreshes = 0
+
+    def refresh(self) -> None:
+        with self._lock:
+            self._generation += 1
+            path = os.path.join(self.directory, f"snapshot-{self._generation}.db")
+        taken = time.monotonic()
+        try:
+            target = sqlite3.connect(path)
+            try:
+                with _connection() as con:
+                    con.backup(target)
+                # the copy is in WAL mode like the original, which read-only connections can't open without a -shm file
+                target.execute("PRAGMA journal_mode = DELETE")
+            finally:
+                target.close()
+        except Exception:
+            self._remove(path)
+            raise
+
+        with self._lock:
+            retired, self._previous = self._previous, self._current
+            self._current = (ConnectionPool(path, read_only=True), path, taken)
+            self._written = {pid: t for pid, t in self._written.items() if t >= taken}
+            self.refreshes += 1
+        if retired is not None:
+            retired[0].close()
+            self._remove(retired[1])
+
+    def close(self) -> None:
+        with self._lock:
+            snapshots = [self._current, self._previous]
+            self._current = self._previous = None
+        for snapshot in snapshots:
+            if snapshot is not None:
+                snapshot[0].close()
+                self._remove(snapshot[1])
+        if self._own_directory:
+            try:
+                os.rmdir(self.directory)
+            except OSError:
+                pass
+
+    @staticmethod
+    def _remove(path: str) -> None:
+        # connections still open on the file keep working (on POSIX systems)
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    def written(self, players: Iterable[PlayerId]) -> None:
+        """ Note that games of these players have been committed """
+        now = time.monotonic()
+        with self._lock:
+            for pid in players:
+                self._written[pid] = now
+
+    def age(self) -> float:
+        current = self._current
+        return time.monotonic() - current[2] if current is not None else math.inf
+
+    def pool_for(self, player: Optional[PlayerId] = None) -> Optional[ConnectionPool]:
+        """ The pool to read from, if the snapshot may be used for the read (of `player`'s games); None if not """
+        current = self._current
+        if current is None or time.monotonic() - current[2] > self.max_age:
+            _SNAPSHOT_READS.inc(source="primary_stale")
+            return None
+        if player is not None and player in self._written:
+            _SNAPSHOT_READS.inc(source="primary_new_games")
+            return None
+        _SNAPSHOT_READS.inc(source="snapshot")
+        return current[0]
+
+
+_snapshot: Optional[ReadSnapshot] = None
+
+def enable_snapshot(max_age: float, directory: Optional[str] = None) -> None:
+    """ Serve page reads from a read snapshot, at most `max_age` seconds old (see `ReadSnapshot`)
+
+    The snapshot is taken right away, in `directory` (by default a new temporary directory).
+    `refresh_snapshot` must then be called regularly, more often than every `max_age` seconds.
+    """
+    global _snapshot
+    snapshot = ReadSnapshot(max_age, directory)
+    snapshot.refresh()
+    _snapshot = snapshot
+    metrics.gauge("rps_db_snapshot_age_seconds", "Age of the read snapshot", snapshot.age)
+
+@_timed
+def refresh_snapshot() -> None:
+    if _snapshot is not None:
+        _snapshot.refresh()
+
+@contextmanager
+def _read_connection(player: Optional[PlayerId] = None) -> Iterator[sqlite3.Connection]:
+    """ A connection for page reads (of `player`'s games): to the read snapshot if it can be used, to the primary otherwise """
+    snapshot = _snapshot
+    pool = snapshot.pool_for(player) if snapshot is not None else None
+    with (pool.connection() if pool is not None else _connection()) as con:
+        yield con
+
+
+def _migrations() -> List[Tuple[int, str]]:
+    """ List of (version, path) of the migration scripts, in order """
+    scripts = []
+    for filename in sorted(os.listdir(MIGRATIONS_DIR)):
+        if filename.endswith('.sql'):
+            version = int(filename.split('_', 1)[0])
+            scripts.append((version, os.path.join(MIGRATIONS_DIR, filename)))
+    return scripts
+
+def get_schema_version() -> int:
+    with _connection() as con:
+        (version,) = con.execute("PRAGMA user_version").fetchone()
+    return version
+
+def migrate() -> int:
+    """ Upgrade the database schema in place, by running any migrations newer than the schema version
+
+    The database is expected to have been created with `create-database.sql`, which is version 0.
+    Each migration runs in its own transaction together with the version bump, so an interrupted
+    upgrade can simply be run again. Every process runs this on startup: the version is checked again
+    inside each write transaction, so a migration another process has just run is skipped rather than
+    repeated. Returns the resulting schema version.
+    """
+    with _write_lock, _connection() as con:
+        for target, path in _migrations():
+            con.execute("BEGIN IMMEDIATE")
+            try:
+                (version,) = con.execute("PRAGMA user_version").fetchone()
+                if target <= version:
+                    con.commit()
+                    continue
+                with open(path) as f:
+                    script = f.read()
+                print(f"Migrating database to version {target} ({os.path.basename(path)})")
+                # statement by statement, as executescript would commit the transaction first
+                for statement in _statements(script):
+                    con.execute(statement)
+                con.execute(f"PRAGMA user_version = {target}")
+                con.commit()
+            except BaseException:
+                if con.in_transaction:
+                    con.rollback()
+                raise
+        (version,) = con.execute("PRAGMA user_version").fetchone()
+    return version
+
+def _statements(script: str) -> Iterator[str]:
+    """ The SQL statements of a script """
+    statement = ""
+    for part in script.split(";"):
+        statement += part + ";"
+        # a ';' within a string literal or trigger doesn't end the statement
+        if sqlite3.complete_statement(statement):
+            if statement.strip(" \t\r\n;"):
+                yield statement
+            statement = ""
+
+
+@_timed
 def get_last_history_page() -> Optional[str]:
     """ Returns latest unfetched history page address """
-    con = sqlite3.connect(DB_FILE)
-    cur = con.cursor()
-
-    cur.execute("SELECT page FROM history_page")
-    res = cur.fetchone()
-    con.close()
+    with _connection() as con:
+        res = con.execute("SELECT page FROM history_page").fetchone()
 
     # Query should always return something, as the database is initialized with a NULL page.
     # Nevertheless, check both that a row is returned and that the row has a page.
@@ -30,211 +377,652 @@ def get_last_history_page() -> Optional[str]:
             return page
     return None
 
+@_timed
 def update_history_page(key: str) -> None:
     """ Stores the cursor address for the history API endpoint """
-    con = sqlite3.connect(DB_FILE)
-    cur = con.cursor()
+    try:
+        with _transaction() as cur:
+            cur.execute("UPDATE history_page SET page=?;", (key,))
+    except sqlite3.Error as e:
+        print("Database error: ", e)
+
+class HistoryPage(NamedTuple):
+    """ Time range of the games on a fetched history page """
+    cursor: str                     # the page's own address; '' for the first page
+    min_time: Optional[Timestamp]   # None for an empty page
+    max_time: Optional[Timestamp]
+    games: int
+    fetched_at: Timestamp
+
+def _record_history_pages(cur: sqlite3.Cursor, pages: List[HistoryPage]) -> None:
+    cur.executemany("""INSERT INTO history_pages(cursor, min_time, max_time, games, fetched_at) VALUES (?,?,?,?,?)
+        ON CONFLICT(cursor) DO UPDATE SET
+            min_time = excluded.min_time, max_time = excluded.max_time,
+            games = excluded.games, fetched_at = excluded.fetched_at""", pages)
+
+@_timed
+def get_history_pages_between(start: Timestamp, end: Timestamp) -> List[HistoryPage]:
+    """ The pages with games between `start` and `end`, oldest games first
+
+    The first page is left out: new games keep going to it, so its stored time range doesn't stay valid.
+    """
+    with _connection() as con:
+        rows = con.execute("""SELECT cursor, min_time, max_time, games, fetched_at FROM history_pages
+            WHERE min_time <= ? AND max_time >= ? AND cursor != ''
+            ORDER BY min_time""", (end, start)).fetchall()
+    return [HistoryPage(*row) for row in rows]
+
+@_timed
+def add_coverage(start: Timestamp, end: Timestamp, source: str) -> Optional[int]:
+    """ Record a period during which finished games are known to have been saved ('live' or 'history').
+    Returns its id, for extending an ongoing period with `extend_coverage`, or None on error. """
+    try:
+        with _transaction() as cur:
+            cur.execute("INSERT INTO live_coverage(start_time, end_time, source) VALUES (?,?,?)", (start, end, source))
+            return cur.lastrowid
+    except sqlite3.Error as e:
+        print("Database error: ", e)
+        return None
 
+@_timed
+def extend_coverage(period: int, end: Timestamp) -> None:
     try:
-        cur.execute("UPDATE history_page SET page=?;", (key,))
-        con.commit()
+        with _transaction() as cur:
+            cur.execute("UPDATE live_coverage SET end_time = MAX(end_time, ?) WHERE id = ?", (end, period))
     except sqlite3.Error as e:
         print("Database error: ", e)
-    con.close()
 
-def _get_player_ids_by_name(names: List[PlayerName]) -> Dict[PlayerName, PlayerId]:
+@_timed
+def get_coverage_gaps(until: Timestamp) -> List[Tuple[Timestamp, Timestamp]]:
+    """ (start, end) of the gaps between covered periods, for gaps that ended by `until`, oldest first
+
+    Nothing before the first period counts as a gap (the history fetched on startup covers it),
+    nor does the time since the last one. """
+    with _connection() as con:
+        periods = con.execute("SELECT start_time, end_time FROM live_coverage ORDER BY start_time").fetchall()
+
+    gaps = []
+    covered_until = None
+    for start, end in periods:
+        if covered_until is not None and start > covered_until and start <= until:
+            gaps.append((covered_until, start))
+        covered_until = end if covered_until is None else max(covered_until, end)
+    return gaps
+
+def _chunks(items: List, size: int = SQL_VARIABLE_CHUNK) -> Iterator[List]:
+    """ Split a list into chunks small enough to be bound as `IN (?,?,...)` parameters """
+    for i in range(0, len(items), size):
+        yield items[i:i+size]
+
+def _get_player_ids_by_name(cur: sqlite3.Cursor, names: List[PlayerName]) -> Dict[PlayerName, PlayerId]:
     """ Get ids for players in the given list, assuming they are in the database """
-    con = sqlite3.connect(DB_FILE)
-    cur = con.cursor()
+    ids = {}
+    for chunk in _chunks(names):
+        query = "SELECT name,player_id FROM players WHERE name in ({})".format(','.join("?" for name in chunk))
+        cur.execute(query, chunk)
+        ids.update(cur.fetchall())
+    return ids
 
-    query = "SELECT name,player_id FROM players WHERE name in ({})".format(','.join("?" for name in names))
-    cur.execute(query, names)
+def _create_players(cur: sqlite3.Cursor, players: Dict[PlayerName, PlayerId]) -> None:
+    """ Add new players to the database, as part of the cursor's transaction """
+    cur.executemany("INSERT INTO players(name,player_id) VALUES (?,?)", players.items())
 
-    res = cur.fetchall()
-    con.close()
+def _get_or_create_players(cur: sqlite3.Cursor, names: List[PlayerName],
+        cached: Optional[Dict[PlayerName, PlayerId]] = None) -> Tuple[Dict[PlayerName, PlayerId], Dict[PlayerName, PlayerId]]:
+    """ Resolve player names to ids, creating any missing players in the cursor's transaction
 
-    return {name: id for name,id in res}
+    cached:
+        Result of an earlier lookup of `names` in the player cache, if the caller already did one.
 
-def _create_player(name: PlayerName, uuid: PlayerId) -> bool:
-    """ Add a new player to the database 
-    
-    Returns True if successful, False if player could not be added."""
+    Returns (ids, new), where `new` holds the created players. These must only be added to the
+    player cache (`_player_ids`) once the transaction has been committed.
+    """
+    ids = dict(cached) if cached is not None else _player_ids.get_many(names)
+    missing = [name for name in set(names) if name not in ids]
+    if not missing:
+        return ids, {}
+
+    found = _get_player_ids_by_name(cur, missing)
+    _player_ids.update(found)
+    ids.update(found)
 
-    con = sqlite3.connect(DB_FILE)
-    cur = con.cursor()
+    # If some players aren't in database yet, add them
+    new = {name: str(uuid4()) for name in missing if name not in found}
+    if new:
+        _create_players(cur, new)
+        ids.update(new)
+    return ids, new
+
+# called with {name: id} of newly created players, once they have been committed
+_player_listeners: List[Callable[[Dict[PlayerName, PlayerId]], None]] = []
+
+def on_players_created(callback: Callable[[Dict[PlayerName, PlayerId]], None]) -> None:
+    """ Register a function to be called with the players created from now on, as {name: id} """
+    _player_listeners.append(callback)
+
+def _players_created(new: Dict[PlayerName, PlayerId]) -> None:
+    """ Add newly created players to the player cache and notify listeners. Call only after committing them. """
+    if not new:
+        return
+    _player_ids.update(new)
+    for callback in _player_listeners:
+        try:
+            callback(new)
+        except Exception as e:
+            print(f"Error in new players callback: {e!r}")
+
+@_timed
+def get_or_create_players(names: List[PlayerName]) -> Dict[PlayerName, PlayerId]:
+    # common case: every player has been seen before
+    ids = _player_ids.get_many(names)
+    if len(ids) == len(set(names)):
+        return ids
 
     try:
-        cur.execute("INSERT INTO players(name,player_id) VALUES (?,?)", (name,uuid))
-        con.commit()
-        return True
+        with _transaction() as cur:
+            ids, new = _get_or_create_players(cur, names, ids)
+        _players_created(new)
+        return ids
     except sqlite3.Error as e:
         print("Database error: ", e)
-        return False
-    finally:
-        con.close()
-
-def get_or_create_players(names: List[PlayerName]) -> Dict[PlayerName, PlayerId]:
-    ids = _get_player_ids_by_name(names)
-
-    # If some players aren't in database yet, add them
-    for player in names:
-        if player not in ids:
-            uuid = str(uuid4())
-            if _create_player(player, uuid):
-                ids[player] = uuid
-            else:
-                print(f"Error adding player '{player}' with ID {uuid}.")
-    return ids
-
-
+        print(f"Error adding players {names}.")
+        return {}
+
+def warm_player_cache() -> int:
+    """ Load players into the name -> id cache, up to its size. Returns the number of players loaded. """
+    with _connection() as con:
+        rows = con.execute("SELECT name, player_id FROM players LIMIT ?", (PLAYER_CACHE_SIZE,)).fetchall()
+    _player_ids.update(dict(rows))
+    return len(rows)
+
+@_timed
+def get_players_with_game_counts() -> List[Tuple[PlayerId, PlayerName, int]]:
+    """ Every player, with their number of finished games """
+    with _connection() as con:
+        return _players_with_game_counts(con)
+
+def get_players_and_last_game_row() -> Tuple[List[Tuple[PlayerId, PlayerName, int]], int]:
+    """ `get_players_with_game_counts`, and a mark of the finished games saved so far (for `iter_game_rows`,
+    `iter_games_between_rows` and `get_game_rows`), as of the same moment """
+    with _connection() as con:
+        # one read transaction, so that no games are saved between the two
+        con.execute("BEGIN")
+        try:
+            return _players_with_game_counts(con), _last_game_row(con)
+        finally:
+            con.execute("COMMIT")
+
+def _players_with_game_counts(con: sqlite3.Connection) -> List[Tuple[PlayerId, PlayerName, int]]:
+    return con.execute("""SELECT players.player_id, name, COALESCE(wins + losses + ties, 0)
+        FROM players LEFT JOIN player_stats ON players.player_id = player_stats.player_id""").fetchall()
+
+def player_cache_stats() -> Dict[str, int]:
+    """ Size and hit/miss/eviction counters of the player name -> id cache """
+    return _player_ids.stats()
+
+
+def _insert_games(cur: sqlite3.Cursor, games: List[GameResult]) -> List[GameResult]:
+    """ Insert finished games and their plays (both normalized and into game_rows), as part of the cursor's transaction
+
+    Games already stored (e.g. received from both the live feed and the history), or repeated within `games`,
+    are skipped: each game's row is inserted with OR IGNORE, and only the games whose row went in get their plays
+    and stats added. Returns the games inserted.
+    """
+    result_query = "INSERT OR IGNORE INTO games(game_id,time,p1_id,p2_id,status) VALUES (?,?,?,?,?)"
+    play_query = "INSERT INTO plays(game_id,side,player_id,played,result) VALUES (?,?,?,?,?)"
+    compact_query = "INSERT INTO game_rows(game_id,time,p1_id,p1_name,p2_id,p2_name,packed) VALUES (?,?,?,?,?,?,?)"
+
+    execute = cur.execute
+    inserted = []
+    for game in games:
+        execute(result_query, (game.gameId, game.t, game.player1.pid, game.player2.pid, 1)) # 1 = finished
+        if cur.rowcount == 1:
+            inserted.append(game)
+    games = inserted
+
+    cur.executemany(play_query, (
+        (game.gameId, side, p.pid, p.played.value, p.result.value)
+        for game in games
+        for side, p in (('A', game.player1), ('B', game.player2))
+    ))
+    cur.executemany(compact_query, (
+        (game.gameId, game.t, game.player1.pid, game.player1.name,
+            game.player2.pid, game.player2.name, pack_plays(game))
+        for game in games
+    ))
+    _update_player_stats(cur, games)
+    return games
+
+# column of player_stats for each result and play
+_RESULT_COLUMNS = {rps.Result.WIN: 0, rps.Result.LOSS: 1, rps.Result.TIE: 2}
+_PLAY_COLUMNS = {rps.RPS.ROCK: 3, rps.RPS.PAPER: 4, rps.RPS.SCISSORS: 5}
+
+def _update_player_stats(cur: sqlite3.Cursor, games: List[GameResult]) -> None:
+    """ Add the plays of newly inserted games to player_stats, as part of the cursor's transaction """
+    deltas: Dict[PlayerId, List[int]] = {}
+    for game in games:
+        for p in (game.player1, game.player2):
+            delta = deltas.setdefault(p.pid, [0] * 6)
+            delta[_RESULT_COLUMNS[p.result]] += 1
+            delta[_PLAY_COLUMNS[p.played]] += 1
+
+    cur.executemany("""INSERT INTO player_stats(player_id, wins, losses, ties, rock, paper, scissors)
+        VALUES (?,?,?,?,?,?,?)
+        ON CONFLICT(player_id) DO UPDATE SET
+            wins = wins + excluded.wins, losses = losses + excluded.losses, ties = ties + excluded.ties,
+            rock = rock + excluded.rock, paper = paper + excluded.paper, scissors = scissors + excluded.scissors""",
+        ((pid, *delta) for pid, delta in deltas.items())
+    )
+
+def rebuild_player_stats() -> None:
+    """ Recompute player_stats from scratch, from the plays table """
+    with _transaction() as cur:
+        cur.execute("DELETE FROM player_stats")
+        cur.execute("""INSERT INTO player_stats(player_id, wins, losses, ties, rock, paper, scissors)
+            SELECT player_id,
+                SUM(result = 'W'), SUM(result = 'L'), SUM(result = 'T'),
+                SUM(played = 'R'), SUM(played = 'P'), SUM(played = 'S')
+            FROM plays
+            GROUP BY player_id""")
+
+def _unsaved(ids: List[GameId], source: str) -> List[bool]:
+    """ For each id, whether it may still need saving, i.e. it isn't among the recently saved games """
+    unsaved = [gid not in _saved_games for gid in ids]
+    skipped = len(ids) - sum(unsaved)
+    if skipped:
+        _GAMES_DUPLICATE.inc(skipped, source=source, check="recent")
+    return unsaved
+
+def _saved(ids: List[GameId], games: List[GameResult], source: str) -> None:
+    """ Remember games as saved, once their transaction has been committed, and count them.
+    `ids` are all the games of the transaction, `games` the ones that were new. """
+    _saved_games.update(dict.fromkeys(ids, True))
+    _GAMES_SAVED.inc(len(games), source=source)
+    if len(ids) > len(games):
+        _GAMES_DUPLICATE.inc(len(ids) - len(games), source=source, check="database")
+    games_written(games)
+
+def games_written(games: List[GameResult]) -> None:
+    """ Note that games have been committed, by this or another process, for the read snapshot if there is one """
+    snapshot = _snapshot
+    if snapshot is not None and games:
+        snapshot.written({p.pid for game in games for p in (game.player1, game.player2)})
+
+def warm_saved_games() -> int:
+    """ Load the ids of the newest games into the recently saved games, up to its size. Returns the number loaded. """
+    with _connection() as con:
+        rows = con.execute("SELECT game_id FROM game_rows ORDER BY time DESC, game_id DESC LIMIT ?",
+            (RECENT_GAMES_SIZE,)).fetchall()
+    # oldest first, so that the newest are the last to be evicted
+    _saved_games.update(dict.fromkeys((gid for gid, in reversed(rows)), True))
+    return len(rows)
+
+@_timed
 def add_game_result(game: GameResult) -> bool:
-    """ Add a result to the database
-    
-    Returns True if successful, False if not."""
+    """ Add a result to the database. A game already stored is skipped.
+
+    Returns True if successful (including when already stored), False if not."""
 
-    con = sqlite3.connect(DB_FILE)
-    cur = con.cursor()
+    return add_game_results([game]) is not None
 
-    result_query = "INSERT INTO games(game_id,time,p1_id,p2_id,status) VALUES (?,?,?,?,?)"
-    play_query = "INSERT INTO plays(game_id,player_id,played,result) VALUES (?,?,?,?)"
+@_timed
+def add_game_results(games: List[GameResult]) -> Optional[List[GameResult]]:
+    """ Add several results to the database, in a single transaction. Games already stored are skipped.
 
-    p1 = game['player1']
-    p2 = game['player2']
+    Returns the games that were new, or None if nothing was saved."""
 
+    games = [game for game, unsaved in zip(games, _unsaved([game.gameId for game in games], "live")) if unsaved]
+    if not games:
+        return []
     try:
-        cur.execute(result_query, (game['gameId'], game['t'], p1['pid'], p2['pid'], 1)) # 1 = finished
-        
-        cur.executemany(play_query, (
-            (game['gameId'], p1['pid'], p1['played'].value, p1['result'].value),
-            (game['gameId'], p2['pid'], p2['played'].value, p2['result'].value)
-        ))
-
-        con.commit()
-        return True
+        with _transaction() as cur:
+            inserted = _insert_games(cur, games)
+        _saved([game.gameId for game in games], inserted, "live")
+        return inserted
     except sqlite3.Error as e:
         print("Database error: ", e)
-        return False
-    finally:
-        con.close()
+        return None
 
-def add_history_games(data: List[APIGameResult]) -> None: # TODO: typing
-    """ Add one or more game results to the database """
+@_timed
+def add_history_games(data: List[APIGameResult], page: Optional[str] = None,
+        pages: Optional[List[HistoryPage]] = None) -> Optional[List[GameResult]]:
+    """ Add one or more game results from the history API to the database, in a single transaction
 
-    # Start by getting existing player IDs from database
-    names = set()
-    for game in data:
-        p1_name = game['playerA']['name']
-        p2_name = game['playerB']['name']
-        names |= {p1_name, p2_name}
-    
-    ids = get_or_create_players(list(names))
+    page:
+        If given, the history cursor is updated to this address in the same transaction,
+        so the stored cursor never gets ahead of (or falls behind) the stored games.
+    pages:
+        Time ranges of the pages `data` came from, recorded in the same transaction (see `get_history_pages_between`).
 
-    # Preprocess results into nicer data format and save to database
-    # TODO: consolidate into one bigger operation, instead of separate insert per game?
-    for api_res in data:
-        res = result_from_api_result(api_res)
-        if not add_game_result(res):
-            print("Error adding game: ", game)
+    Games already in the database are skipped. Returns the games that were new, or None if nothing was saved.
+    """
 
+    data = [api_res for api_res, unsaved in zip(data, _unsaved([api_res['gameId'] for api_res in data], "history")) if unsaved]
 
+    # Resolve all player names on the page(s) at once
+    names = set()
+    for game in data:
+        names.add(game['playerA']['name'])
+        names.add(game['playerB']['name'])
+
+    try:
+        with _transaction() as cur:
+            ids, new = _get_or_create_players(cur, list(names))
+
+            # Preprocess results into nicer data format and save to database
+            games = _insert_games(cur, [_result_from_api_result(api_res, ids) for api_res in data])
+
+            if page:
+                cur.execute("UPDATE history_page SET page=?;", (page,))
+            if pages:
+                _record_history_pages(cur, pages)
+        _players_created(new)
+        _saved([api_res['gameId'] for api_res in data], games, "history")
+        return games
+    except sqlite3.Error as e:
+        print("Database error: ", e)
+        print(f"Error adding {len(data)} history games (page {page}).")
+        return None
+
+
+# Game listings are read either from the denormalized game_rows table (one row per game, no joins),
+# or joined together from games, players and plays. Both are always written, so this can be switched at any time.
+COMPACT_READS = True
+
+_GAMES_QUERY = """SELECT games.game_id, games.time, p1_id, p1.name, r1.played, r1.result, p2_id, p2.name, r2.played, r2.result
+    FROM games
+    INNER JOIN players AS p1 ON games.p1_id = p1.player_id
+    INNER JOIN players AS p2 ON games.p2_id = p2.player_id
+    INNER JOIN plays AS r1 ON games.game_id = r1.game_id AND r1.side = 'A'
+    INNER JOIN plays AS r2 ON games.game_id = r2.game_id AND r2.side = 'B'
+    {where}
+    ORDER BY games.time DESC
+    LIMIT :lim OFFSET :off """
+
+_COMPACT_COLUMNS = "game_id, time, p1_id, p1_name, p2_id, p2_name, packed"
+
+_COMPACT_QUERY = """SELECT {columns} FROM game_rows
+    {where}
+    ORDER BY time DESC
+    LIMIT :lim OFFSET :off """
+
+def _games_from_rows(rows: List[tuple], compact: bool) -> List[GameResult]:
+    if compact:
+        return [_result_from_compact_row(*row) for row in rows]
+    return [_result_from_database_query(*row) for row in rows]
+
+def _offset_page(player: Optional[PlayerId], page: int) -> List[GameResult]:
+    compact = COMPACT_READS
+    where = "WHERE p1_id = :pid OR p2_id = :pid" if player is not None else ""
+    if compact:
+        query = _COMPACT_QUERY.format(columns=_COMPACT_COLUMNS, where=where)
+    else:
+        query = _GAMES_QUERY.format(where=where)
+
+    with _read_connection(player) as con:
+        rows = con.execute(query, {'pid': player, 'lim': GAMES_PAGE_LENGTH, 'off': page*GAMES_PAGE_LENGTH}).fetchall()
+
+    return _games_from_rows(rows, compact)
+
+@_timed
 def get_games_by_player(uuid: PlayerId, page: int = 0) -> List[GameResult]:
     """ Get nth page of a player's games. """
-    con = sqlite3.connect(DB_FILE)
-    cur = con.cursor()
-
-    query = """SELECT games.game_id, games.time, p1_id, p1.name, r1.played, r1.result, p2_id, p2.name, r2.played, r2.result
-        FROM games
-        INNER JOIN players AS p1 ON games.p1_id = p1.player_id
-        INNER JOIN players AS p2 ON games.p2_id = p2.player_id
-        INNER JOIN plays AS r1 ON games.game_id = r1.game_id AND games.p1_id = r1.player_id
-        INNER JOIN plays AS r2 ON games.game_id = r2.game_id AND games.p2_id = r2.player_id
-        WHERE games.p1_id = :pid OR games.p2_id = :pid
-        ORDER BY games.time DESC
-        LIMIT :lim OFFSET :off """
-    cur.execute(query, {'pid': uuid, 'lim': GAMES_PAGE_LENGTH, 'off': page*GAMES_PAGE_LENGTH})
-
-    return [
-        _result_from_database_query(gid, t, p1_id, p1_name, p1_play, p1_res, p2_id, p2_name, p2_play, p2_res)
-        for gid, t, p1_id, p1_name, p1_play, p1_res, p2_id, p2_name, p2_play, p2_res in cur.fetchall()
-    ]
+    return _offset_page(uuid, page)
 
+@_timed
 def get_games_history(page: int = 0) -> List[GameResult]:
     """ Get nth page of all played games. """
-    con = sqlite3.connect(DB_FILE)
-    cur = con.cursor()
-
-    query = """SELECT games.game_id, games.time, p1_id, p1.name, r1.played, r1.result, p2_id, p2.name, r2.played, r2.result
-        FROM games
-        INNER JOIN players AS p1 ON games.p1_id = p1.player_id
-        INNER JOIN players AS p2 ON games.p2_id = p2.player_id
-        INNER JOIN plays AS r1 ON games.game_id = r1.game_id AND games.p1_id = r1.player_id
-        INNER JOIN plays AS r2 ON games.game_id = r2.game_id AND games.p2_id = r2.player_id
-        ORDER BY games.time DESC
-        LIMIT :lim OFFSET :off """
-    cur.execute(query, {'lim': GAMES_PAGE_LENGTH, 'off': page*GAMES_PAGE_LENGTH})
-
-    return [
-        _result_from_database_query(gid, t, p1_id, p1_name, p1_play, p1_res, p2_id, p2_name, p2_play, p2_res)
-        for gid, t, p1_id, p1_name, p1_play, p1_res, p2_id, p2_name, p2_play, p2_res in cur.fetchall()
-    ]
+    return _offset_page(None, page)
 
-def get_games_count_by_player(uuid: PlayerId) -> Tuple[int, int]:
-    """ Get count of games and pages for player """
+# Keyset pagination: pages are delimited by the (time, game_id) of their first/last game, instead of an offset.
+# Cursors are opaque to callers: base64 of [direction, time, game_id], where direction is
+# "older" (games after the key in the newest-first listing) or "newer" (games before it).
 
-    con = sqlite3.connect(DB_FILE)
-    cur = con.cursor()
+GameCursor = str
 
-    cur.execute("SELECT COUNT(*) FROM games WHERE p1_id = ? OR p2_id = ?", (uuid, uuid))
+def _encode_cursor(direction: str, t: Timestamp, gid: GameId) -> GameCursor:
+    return base64.urlsafe_b64encode(json.dumps([direction, t, gid]).encode()).decode()
+
+def _decode_cursor(cursor: GameCursor) -> Tuple[str, Timestamp, GameId]:
+    """ Raises ValueError for a malformed cursor """
+    try:
+        direction, t, gid = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except (TypeError, ValueError, binascii.Error) as e:
+        raise ValueError(f"Invalid cursor: {cursor!r}") from e
+    # t must also fit SQLite's signed 64-bit integers, or binding it fails
+    if direction not in ("older", "newer") or not isinstance(t, int) or not -2**63 <= t < 2**63 \
+            or not isinstance(gid, str):
+        raise ValueError(f"Invalid cursor: {cursor!r}")
+    return direction, t, gid
+
+# joins the games of a page (selected by `ids`) together, for the non-compact read mode
+_KEYSET_QUERY = """SELECT games.game_id, games.time, p1_id, p1.name, r1.played, r1.result, p2_id, p2.name, r2.played, r2.result
+    FROM ({ids}) AS page
+    INNER JOIN games ON games.game_id = page.game_id
+    INNER JOIN players AS p1 ON games.p1_id = p1.player_id
+    INNER JOIN players AS p2 ON games.p2_id = p2.player_id
+    INNER JOIN plays AS r1 ON games.game_id = r1.game_id AND r1.side = 'A'
+    INNER JOIN plays AS r2 ON games.game_id = r2.game_id AND r2.side = 'B'
+    ORDER BY games.time {order}, games.game_id {order} """
+
+# games of the page, walking the (time, game_id) index from the key in the given direction
+_KEYSET_ROWS = """SELECT {columns} FROM {table}
+    WHERE {where} (time, game_id) {cmp} (:t, :gid)
+    ORDER BY time {order}, game_id {order}
+    LIMIT :lim"""
+
+# larger than any timestamp, i.e. the key of the first page
+_NEWEST_KEY = (2**63 - 1, "")
+
+def _keyset_page(player: Optional[PlayerId], cursor: Optional[GameCursor]) -> Tuple[List[GameResult], Optional[GameCursor], Optional[GameCursor]]:
+    direction, t, gid = _decode_cursor(cursor) if cursor else ("older", *_NEWEST_KEY)
+    cmp, order = ("<", "DESC") if direction == "older" else (">", "ASC")
+    compact = COMPACT_READS
+    columns, table = (_COMPACT_COLUMNS, "game_rows") if compact else ("game_id, time", "games")
+
+    if player is None:
+        query = _KEYSET_ROWS.format(columns=columns, table=table, where="", cmp=cmp, order=order)
+    else:
+        # one index range scan per side, rather than an OR the planner can't walk in order
+        query = " UNION ".join(
+            "SELECT * FROM ({})".format(_KEYSET_ROWS.format(
+                columns=columns, table=table, where=f"{column} = :pid AND", cmp=cmp, order=order))
+            for column in ("p1_id", "p2_id")
+        ) + f" ORDER BY time {order}, game_id {order} LIMIT :lim"
+
+    if not compact:
+        query = _KEYSET_QUERY.format(ids=query, order=order)
+
+    # fetch one extra game, to know whether there is a page beyond this one
+    params = {'pid': player, 't': t, 'gid': gid, 'lim': GAMES_PAGE_LENGTH + 1}
+    with _read_connection(player) as con:
+        rows = con.execute(query, params).fetchall()
+
+    more = len(rows) > GAMES_PAGE_LENGTH
+    rows = rows[:GAMES_PAGE_LENGTH]
+    if direction == "newer":
+        rows.reverse()
+    games = _games_from_rows(rows, compact)
+    if not games:
+        return games, None, None
+
+    first, last = games[0], games[-1]
+    # coming from an older page there always are newer games, and vice versa
+    has_newer = more if direction == "newer" else cursor is not None
+    has_older = more if direction == "older" else True
+    prev_cursor = _encode_cursor("newer", first.t, first.gameId) if has_newer else None
+    next_cursor = _encode_cursor("older", last.t, last.gameId) if has_older else None
+    return games, next_cursor, prev_cursor
+
+@_timed
+def get_games_by_player_keyset(uuid: PlayerId, cursor: Optional[GameCursor] = None) -> Tuple[List[GameResult], Optional[GameCursor], Optional[GameCursor]]:
+    """ Get a page of a player's games, newest first, using keyset pagination.
+
+    cursor:
+        None for the newest games, or a cursor returned by an earlier call.
+
+    returns (games, next, prev)
+    next, prev:
+        cursors for the page of older/newer games, or None if there are none.
+
+    Unlike `get_games_by_player`, this is equally fast for every page. Raises ValueError for an invalid cursor.
+    """
+    return _keyset_page(uuid, cursor)
+
+@_timed
+def get_games_history_keyset(cursor: Optional[GameCursor] = None) -> Tuple[List[GameResult], Optional[GameCursor], Optional[GameCursor]]:
+    """ Get a page of all played games, newest first, using keyset pagination.
+
+    See `get_games_by_player_keyset` for the arguments and return value.
+    """
+    return _keyset_page(None, cursor)
+
+@_timed
+def get_games_count_by_player(uuid: PlayerId) -> Tuple[int, int]:
+    """ Get count of games and pages for player """
+    with _read_connection(uuid) as con:
+        (n,) = con.execute("SELECT COUNT(*) FROM games WHERE p1_id = ? OR p2_id = ?", (uuid, uuid)).fetchone()
 
-    (n,) = cur.fetchone()
     return n, math.ceil(n / GAMES_PAGE_LENGTH)
 
+@_timed
 def get_games_count_total() -> Tuple[int, int]:
     """ Get total count of games and pages """
+    with _read_connection() as con:
+        (n,) = con.execute("SELECT COUNT(*) FROM games").fetchone()
 
-    con = sqlite3.connect(DB_FILE)
-    cur = con.cursor()
-
-    cur.execute("SELECT COUNT(*) FROM games")
-
-    (n,) = cur.fetchone()
     return n, math.ceil(n / GAMES_PAGE_LENGTH)
 
+@_timed
 def get_player_stats(uuid: PlayerId) -> Tuple[Tuple[int, int, int],Tuple[int, int, int]]:
     """ Return player stats in the format: ((win,loss,tie), (rock,paper,scissors)) """
 
-    con = sqlite3.connect(DB_FILE)
-    cur = con.cursor()
-
-    cur.execute("SELECT result,COUNT(result) FROM plays WHERE player_id=? GROUP BY result", (uuid,))
-    _results = {res: count for res, count in cur.fetchall()}
-
-    cur.execute("SELECT played,COUNT(played) FROM plays WHERE player_id=? GROUP BY played", (uuid,))
-    _plays = {play: count for play, count in cur.fetchall()}
-
-    results = tuple(_results[k] if k in _results else 0 for k in "WLT")
-    plays = tuple(_plays[k] if k in _plays else 0 for k in "RPS")
-
-    return results, plays
-
+    with _read_connection(uuid) as con:
+        row = con.execute("SELECT wins, losses, ties, rock, paper, scissors FROM player_stats WHERE player_id=?",
+            (uuid,)).fetchone()
+
+    # players without any finished games don't have a row
+    w, l, t, r, p, s = row if row else (0,) * 6
+    return (w, l, t), (r, p, s)
+
+def iter_game_rows(
+        fetch_size: int = 10_000,
+        since: Optional[Timestamp] = None, until: Optional[Timestamp] = None,
+        player: Optional[PlayerId] = None, max_row: Optional[int] = None
+    ) -> Iterator[List[Tuple[GameId, Timestamp, PlayerId, PlayerName, PlayerId, PlayerName, str]]]:
+    """ Iterate over finished games, oldest first, in chunks of at most `fetch_size` raw game_rows rows:
+    (game_id, time, p1_id, p1_name, p2_id, p2_name, packed), see migrations/0004_game_rows.sql.
+
+    Optionally only games played at `since` or later, before `until`, and/or by `player`, and/or only those
+    saved by the time `get_players_and_last_game_row` returned `max_row`.
+    The rows are read straight off the indexes in order, so memory use doesn't depend on the number of games.
+
+    Each chunk is a keyset query of its own, continuing after the last (time, game_id) of the one before, with a
+    pooled connection checked out only for that query. So an iteration spread out over time (e.g. a download to
+    a slow client) neither holds up a connection nor keeps a read transaction open, which would stop WAL
+    checkpoints. Games saved meanwhile are included if they sort after the chunks already read.
+    """
+    conditions = []
+    if since is not None:
+        conditions.append("time >= :since")
+    if until is not None:
+        conditions.append("time < :until")
+    if max_row is not None:
+        conditions.append("rowid <= :max_row")
+
+    def query(conditions: List[str]) -> str:
+        if player is None:
+            where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+            return f"SELECT {_COMPACT_COLUMNS} FROM game_rows {where} ORDER BY time, game_id LIMIT :limit"
+        # merges the games from both (p*_id, time, game_id) indexes, instead of sorting them
+        return " UNION ".join(
+            f"SELECT {_COMPACT_COLUMNS} FROM game_rows WHERE {' AND '.join([f'{side}_id = :pid', *conditions])}"
+            for side in ("p1", "p2")
+        ) + " ORDER BY time, game_id LIMIT :limit"
+
+    first, following = query(conditions), query([*conditions, "(time, game_id) > (:after_time, :after_id)"])
+    params = {'since': since, 'until': until, 'pid': player, 'max_row': max_row, 'limit': fetch_size}
+    sql = first
+    while True:
+        with _connection() as con:
+            rows = con.execute(sql, params).fetchall()
+        if rows:
+            yield rows
+        if len(rows) < fetch_size:
+            return
+        params['after_id'], params['after_time'] = rows[-1][0], rows[-1][1]
+        sql = following
+
+@_timed
+def get_last_game_row() -> int:
+    """ A mark of the finished games saved so far, like `get_players_and_last_game_row` gives """
+    with _connection() as con:
+        return _last_game_row(con)
+
+def _last_game_row(con: sqlite3.Connection) -> int:
+    """ A mark of the finished games saved so far: the newest game_rows rowid, which only ever grows """
+    (row,) = con.execute("SELECT COALESCE(MAX(rowid), 0) FROM game_rows").fetchone()
+    return row
+
+def iter_games_between_rows(after_row: int, max_row: int,
+        fetch_size: int = 10_000) -> Iterator[List[Tuple[int, GameResult]]]:
+    """ Iterate over the finished games saved after the `after_row` mark and by the `max_row` one, in the order
+    they were saved, in chunks of at most `fetch_size` (rowid, game) pairs """
+    while after_row < max_row:
+        with _connection() as con:
+            rows = con.execute(f"""SELECT rowid, {_COMPACT_COLUMNS} FROM game_rows
+                WHERE rowid > ? AND rowid <= ? ORDER BY rowid LIMIT ?""", (after_row, max_row, fetch_size)).fetchall()
+        if not rows:
+            return
+        yield [(row[0], _result_from_compact_row(*row[1:])) for row in rows]
+        after_row = rows[-1][0]
+
+@_timed
+def get_game_rows(ids: List[GameId]) -> Dict[GameId, int]:
+    """ The game_rows rowids of the given finished games, to compare with a `get_players_and_last_game_row` mark """
+    rows = {}
+    with _connection() as con:
+        for chunk in _chunks(ids):
+            query = "SELECT game_id, rowid FROM game_rows WHERE game_id IN ({})".format(','.join("?" for gid in chunk))
+            rows.update(con.execute(query, chunk))
+    return rows
+
+@_timed
+def get_player_last_played(uuid: PlayerId) -> Optional[Timestamp]:
+    """ Time of the player's newest finished game, or None if they have none """
+    with _read_connection(uuid) as con:
+        (t,) = con.execute("""SELECT MAX(time) FROM (
+            SELECT MAX(time) AS time FROM games WHERE p1_id = :pid
+            UNION ALL
+            SELECT MAX(time) FROM games WHERE p2_id = :pid)""", {'pid': uuid}).fetchone()
+    return t
+
+@_timed
 def get_player(uuid: PlayerId) -> Player:
-    con = sqlite3.connect(DB_FILE)
-    cur = con.cursor()
-
-    cur.execute("SELECT player_id, name FROM players WHERE player_id=?", (uuid,))
-    pid, name = cur.fetchone()
+    query = "SELECT player_id, name FROM players WHERE player_id=?"
+    with _read_connection(uuid) as con:
+        row = con.execute(query, (uuid,)).fetchone()
+    if row is None and _snapshot is not None:
+        # created since the read snapshot was taken (e.g. on a game beginning), so only on the primary yet
+        with _connection() as con:
+            row = con.execute(query, (uuid,)).fetchone()
+    pid, name = row
 
-    return {'pid': pid, 'name': name}
+    return Player(pid, name)
 
 
 def result_from_api_result(api_res: APIGameResult) -> GameResult:
     """ Construct an internal representation of a finished game from the API JSON format.
-    
+
     Creates players in database if necessary, which means this may have side effects. """
-    
-    p1, p2 = api_res['playerA'], api_res['playerB']
 
-    ids = get_or_create_players([p1['name'], p2['name']])
+    ids = get_or_create_players([api_res['playerA']['name'], api_res['playerB']['name']])
+    return _result_from_api_result(api_res, ids)
+
+def _result_from_api_result(api_res: APIGameResult, ids: Dict[PlayerName, PlayerId]) -> GameResult:
+    """ Construct an internal representation of a finished game, given ids for both players. """
+
+    p1, p2 = api_res['playerA'], api_res['playerB']
 
     p1_id = ids[p1['name']]
     p1_play = rps.rps_from_str(p1['played'])
@@ -248,22 +1036,11 @@ def result_from_api_result(api_res: APIGameResult) -> GameResult:
     p2_res = rps.get_result(p2_play, p1_play)
     assert (p1_res is not None) and (p2_res is not None)
 
-    return {
-        'gameId': api_res['gameId'],
-        't': api_res['t'],
-        'player1': {
-            'pid': p1_id,
-            'name': p1['name'],
-            'played': p1_play,
-            'result': p1_res
-        },
-        'player2': {
-            'pid': p2_id,
-            'name': p2['name'],
-            'played': p2_play,
-            'result': p2_res
-        }
-    }
+    return GameResult(
+        api_res['gameId'], api_res['t'],
+        PlayerPlay(p1_id, p1['name'], p1_play, p1_res),
+        PlayerPlay(p2_id, p2['name'], p2_play, p2_res)
+    )
 
 def begin_from_api_begin(api_beg: APIGameBegin) -> GameBegin:
     """ Construct an internal representation of an unfinished game from the API JSON format.
@@ -273,17 +1050,11 @@ def begin_from_api_begin(api_beg: APIGameBegin) -> GameBegin:
     p1_name, p2_name = api_beg['playerA']['name'], api_beg['playerB']['name']
     ids = get_or_create_players([p1_name, p2_name])
 
-    return {
-        'gameId': api_beg['gameId'],
-        'player1': {
-            'pid': ids[p1_name],
-            'name': p1_name,
-        },
-        'player2': {
-            'pid': ids[p2_name],
-            'name': p2_name,
-        }
-    }
+    return GameBegin(
+        api_beg['gameId'],
+        Player(ids[p1_name], p1_name),
+        Player(ids[p2_name], p2_name)
+    )
 
 def _result_from_database_query(
         gid: GameId, t: Timestamp,
@@ -299,19 +1070,54 @@ def _result_from_database_query(
     p2r = rps.result_from_str(p2_res)
     assert p1r is not None and p2r is not None
 
-    return {
-        'gameId': gid,
-        't': t,
-        'player1': {
-            'pid': p1_id,
-            'name': p1_name,
-            'played': p1p,
-            'result': p1r
-        },
-        'player2': {
-            'pid': p2_id,
-            'name': p2_name,
-            'played': p2p,
-            'result': p2r
-        }
-    }
+    return GameResult(gid, t, PlayerPlay(p1_id, p1_name, p1p, p1r), PlayerPlay(p2_id, p2_name, p2p, p2r))
+
+
+def pack_plays(game: GameResult) -> str:
+    """ Plays and results of a game, in the format of `game_rows.packed` """
+    p1, p2 = game.player1, game.player2
+    return p1.played.value + p2.played.value + p1.result.value + p2.result.value
+
+# every valid `game_rows.packed` value -> (p1 play, p2 play, p1 result, p2 result)
+_UNPACKED_PLAYS = {
+    a.value + b.value + rps.get_result(a, b).value + rps.get_result(b, a).value: (a, b, rps.get_result(a, b), rps.get_result(b, a))
+    for a in rps.RPS for b in rps.RPS
+}
+
+# Creates a named tuple without the argument handling of its constructor; listings build a few of these per row
+_new_tuple = tuple.__new__
+
+def _result_from_compact_row(
+        gid: GameId, t: Timestamp,
+        p1_id: PlayerId, p1_name: PlayerName,
+        p2_id: PlayerId, p2_name: PlayerName,
+        packed: str
+    ) -> GameResult:
+
+    unpacked = _UNPACKED_PLAYS.get(packed)
+    if unpacked is None:
+        # not written by _insert_games; validate it the long way
+        p1_play, p2_play, p1_res, p2_res = packed
+        return _result_from_database_query(gid, t, p1_id, p1_name, p1_play, p1_res, p2_id, p2_name, p2_play, p2_res)
+
+    p1_play, p2_play, p1_res, p2_res = unpacked
+    return _new_tuple(GameResult, (gid, t,
+        _new_tuple(PlayerPlay, (p1_id, p1_name, p1_play, p1_res)),
+        _new_tuple(PlayerPlay, (p2_id, p2_name, p2_play, p2_res))
+    ))
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Database maintenance")
+    parser.add_argument("command", choices=("migrate", "rebuild-stats"))
+    parser.add_argument("--db", default=DB_FILE, help="database file (default: %(default)s)")
+    args = parser.parse_args()
+
+    DB_FILE = args.db
+    if args.command == "migrate":
+        print(f"Database is at version {migrate()}")
+    elif args.command == "rebuild-stats":
+        rebuild_player_stats()
+        print("Player statistics rebuilt")
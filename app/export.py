@@ -0,0 +1,71 @@
+""" Streaming export of the game history, for /history/export
+
+Games are read from `database.iter_game_rows` in chunks and written out one chunk at a time, so an export
+of the whole history needs no more memory than a single chunk does.
+"""
+
+import csv
+import io
+import json
+import zlib
+
+from typing import Iterable, Iterator, List, Tuple
+
+
+EXPORT_FETCH_SIZE = 1000    # games per database round trip, and per chunk of output
+EXPORT_GZIP_LEVEL = 6
+
+Row = Tuple[str, int, str, str, str, str, str]  # a raw game_rows row, see database.iter_game_rows
+
+CSV_COLUMNS = (
+    "game_id", "time",
+    "p1_id", "p1_name", "p1_played", "p1_result",
+    "p2_id", "p2_name", "p2_played", "p2_result",
+)
+
+_encoder = json.JSONEncoder(separators=(',', ':'))
+
+def ndjson(chunks: Iterable[List[Row]]) -> Iterator[str]:
+    """ One JSON object per line and game, in the same format as games sent to SocketIO clients (`apityping.as_json`) """
+    encode = _encoder.encode
+    for rows in chunks:
+        yield "".join(
+            encode({
+                'gameId': gid, 't': t,
+                'player1': {'pid': p1_id, 'name': p1_name, 'played': packed[0], 'result': packed[2]},
+                'player2': {'pid': p2_id, 'name': p2_name, 'played': packed[1], 'result': packed[3]},
+            }) + "\n"
+            for gid, t, p1_id, p1_name, p2_id, p2_name, packed in rows
+        )
+
+def csv_lines(chunks: Iterable[List[Row]]) -> Iterator[str]:
+    """ A header line, then one line per game with the columns of CSV_COLUMNS """
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, lineterminator="\n")
+    writer.writerow(CSV_COLUMNS)
+    for rows in chunks:
+        writer.writerows(
+            (gid, t, p1_id, p1_name, packed[0], packed[2], p2_id, p2_name, packed[1], packed[3])
+            for gid, t, p1_id, p1_name, p2_id, p2_name, packed in rows
+        )
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell():
+        # no games at all; still send the header
+        yield buffer.getvalue()
+
+# format name -> (mimetype, file extension, chunks of rows -> chunks of text)
+FORMATS = {
+    'ndjson': ("application/x-ndjson", "ndjson", ndjson),
+    'csv': ("text/csv", "csv", csv_lines),
+}
+
+def gzipped(chunks: Iterable[str], level: int = EXPORT_GZIP_LEVEL) -> Iterator[bytes]:
+    """ Compress a stream of text into a stream of gzip data """
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        data = compressor.compress(chunk.encode())
+        if data:
+            yield data
+    yield compressor.flush()
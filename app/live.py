@@ -0,0 +1,207 @@
+""" State of the currently ongoing games """
+
+import heapq
+import threading
+import time
+from collections import deque
+from uuid import uuid4
+
+from typing import Callable, Deque, Dict, List, Optional, Tuple, Union
+from apityping import GameBegin, GameId, as_json
+
+
+LIVE_DELTA_HISTORY = 2000   # number of recent changes kept for clients catching up
+LIVE_GAME_TTL = 300.0       # seconds; games whose result never arrives are dropped after this
+LIVE_EXPIRY_INTERVAL = 10.0 # seconds between checks for expired games
+
+
+class LiveGame:
+    """ A game in progress """
+    __slots__ = ('gid', 'game', 'started')
+
+    def __init__(self, game: GameBegin, started: float):
+        self.gid: GameId = game.gameId
+        self.game = game
+        self.started = started
+
+    def as_begin(self) -> dict:
+        """ The game as sent to clients """
+        return as_json(self.game)
+
+
+# A change to the live games: (seq, "begin", LiveGame) or (seq, "result", gameId)
+Delta = Tuple[int, str, Union[LiveGame, GameId]]
+
+
+class LiveGames:
+    """ The currently ongoing games, versioned with a sequence number
+
+    Every change (a game beginning or finishing) increments `seq`, and is kept in a bounded history,
+    so that clients which know the state at some earlier sequence number can catch up with only the changes since.
+    `epoch` identifies this instance: sequence numbers from another epoch (e.g. before a restart) mean nothing.
+
+    Writers replace the state instead of modifying it (there are at most a few hundred live games), so readers
+    always see a consistent (seq, games) pair without taking a lock. Games older than `ttl` seconds are
+    dropped by `expire()`, as if they had finished.
+    """
+
+    def __init__(self, history: int = LIVE_DELTA_HISTORY, ttl: float = LIVE_GAME_TTL,
+            clock: Callable[[], float] = time.monotonic):
+        self.epoch = uuid4().hex[:8]
+        self.ttl = ttl
+        self._clock = clock
+        # (seq, games); replaced as a whole on every change
+        self._state: Tuple[int, Dict[GameId, LiveGame]] = (0, {})
+        self._deltas: Deque[Delta] = deque(maxlen=history)
+        # (start time, game id) of games which may still be live, oldest first
+        self._expiry: List[Tuple[float, GameId]] = []
+        self._lock = threading.Lock()
+        self._stopping = threading.Event()
+        self._task = None
+        # counters
+        self.begun = 0
+        self.finished = 0
+        self.expired = 0
+
+    @property
+    def seq(self) -> int:
+        return self._state[0]
+
+    def _remove(self, gids: List[GameId]) -> Optional[int]:
+        """ Remove live games, recording each as finished. Must hold the lock. """
+        seq, games = self._state
+        gids = [gid for gid in gids if gid in games]
+        if not gids:
+            return None
+        games = dict(games)
+        for gid in gids:
+            del games[gid]
+            seq += 1
+            self._deltas.append((seq, "result", gid))
+        self._state = (seq, games)
+        return seq
+
+    def begin(self, game: GameBegin) -> int:
+        """ Add a new game. Returns the resulting sequence number. """
+        record = LiveGame(game, self._clock())
+        with self._lock:
+            seq, games = self._state
+            seq += 1
+            self._state = (seq, {**games, record.gid: record})
+            self._deltas.append((seq, "begin", record))
+            heapq.heappush(self._expiry, (record.started, record.gid))
+            self.begun += 1
+            return seq
+
+    def finish(self, gid: GameId) -> Optional[int]:
+        """ Remove a finished game. Returns the resulting sequence number, or None if the game wasn't live. """
+        with self._lock:
+            seq = self._remove([gid])
+            if seq is not None:
+                self.finished += 1
+            return seq
+
+    def sync(self, games: List[GameBegin]) -> None:
+        """ Make the live games exactly `games`, e.g. the state of another process after (re)connecting to it.
+        Games not among them finish, and those not yet live begin, so clients get the difference as usual. """
+        gids = {game.gameId for game in games}
+        with self._lock:
+            self._remove([gid for gid in self._state[1] if gid not in gids])
+        for game in games:
+            if game.gameId not in self._state[1]:
+                self.begin(game)
+
+    def expire(self) -> int:
+        """ Drop games which have been live for longer than the TTL. Returns the number of games dropped. """
+        deadline = self._clock() - self.ttl
+        with self._lock:
+            games = self._state[1]
+            stale = []
+            while self._expiry and self._expiry[0][0] <= deadline:
+                started, gid = heapq.heappop(self._expiry)
+                # the heap also holds games that have since finished (or begun again); skip those
+                record = games.get(gid)
+                if record is not None and record.started == started:
+                    stale.append(gid)
+            self._remove(stale)
+            self.expired += len(stale)
+            return len(stale)
+
+    def start(self, spawn: Callable[[Callable[[], None]], object], sleep: Callable[[float], None] = time.sleep,
+            interval: float = LIVE_EXPIRY_INTERVAL) -> None:
+        """ Start expiring stale games periodically in the background """
+        def run():
+            while not self._stopping.is_set():
+                sleep(interval)
+                self.expire()
+        self._task = spawn(run)
+
+    def stop(self) -> None:
+        self._stopping.set()
+        if self._task is not None:
+            self._task.join()
+
+    def values(self) -> List[GameBegin]:
+        return [record.game for record in self._state[1].values()]
+
+    def __len__(self) -> int:
+        return len(self._state[1])
+
+    def snapshot(self) -> dict:
+        """ The full state, as a frame: {'epoch', 'to': seq, 'games': [GameBegin, ...]} """
+        seq, games = self._state
+        return {'epoch': self.epoch, 'to': seq, 'games': [record.as_begin() for record in games.values()]}
+
+    def deltas_since(self, seq: int) -> Optional[List[Delta]]:
+        """ Changes after the given sequence number, oldest first, or None if they are no longer (or never were) known """
+        with self._lock:
+            current = self._state[0]
+            if seq > current:
+                return None
+            if seq == current:
+                return []
+            if not self._deltas or self._deltas[0][0] > seq + 1:
+                return None
+            # deltas are consecutive, so the ones we want are the last (current - seq)
+            return list(self._deltas)[seq - current:]
+
+    def changes_since(self, epoch: Optional[str], seq: int) -> dict:
+        """ A frame bringing a client from (epoch, seq) up to date: the coalesced changes if known, else a snapshot """
+        if epoch == self.epoch:
+            deltas = self.deltas_since(seq)
+            if deltas is not None:
+                return coalesce(self.epoch, seq, deltas)
+        return self.snapshot()
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            'size': len(self),
+            'seq': self.seq,
+            'begun': self.begun,
+            'finished': self.finished,
+            'expired': self.expired,
+            'expiry_heap': len(self._expiry),
+        }
+
+
+def coalesce(epoch: str, seq: int, deltas: List[Delta]) -> dict:
+    """ Combine consecutive changes after `seq` into a single frame:
+    {'epoch', 'from': seq, 'to': newest seq, 'begin': [GameBegin, ...], 'result': [gameId, ...]}
+
+    Games which both begin and finish within `deltas` are left out altogether.
+    """
+    begun: Dict[GameId, LiveGame] = {}
+    finished: List[GameId] = []
+    for _, kind, payload in deltas:
+        if kind == "begin":
+            begun[payload.gid] = payload
+        elif begun.pop(payload, None) is None:
+            finished.append(payload)
+
+    return {
+        'epoch': epoch,
+        'from': seq,
+        'to': deltas[-1][0] if deltas else seq,
+        'begin': [record.as_begin() for record in begun.values()],
+        'result': finished,
+    }
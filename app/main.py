@@ -1,35 +1,147 @@
 #!/usr/bin/env python3
 
-from flask import Flask, render_template
+from flask import Flask, Response, current_app, render_template, request, abort, make_response, jsonify, g
 from flask_socketio import SocketIO
-import apiconn, database
-import threading
+from jinja2 import Template, select_autoescape
+from markupsafe import Markup
+import apiconn, assets, bus, database, analytics, export, search, metrics
+import argparse
+import hashlib
+import os
+import time
+import uuid
+from datetime import datetime, timezone
 
-from apityping import GameBegin, GameResult, is_finished
+from typing import Callable, List, NamedTuple, Optional
+from cache import LRUCache
+from broadcast import Broadcaster
+from live import LiveGames
+from profiler import SlowRequestProfiler
+
+from apityping import GameBegin, GameResult, Player, is_finished
 from rps import is_win, emoji_from_play
 
-live_games = {}
+live_games = LiveGames()
+
+# all finished games, for aggregate statistics; loaded on startup
+game_history = analytics.History()
+
+# player names, for search; loaded on startup and extended as players are created
+player_index = search.PlayerIndex()
+database.on_players_created(player_index.add)
+
+PLAYER_SEARCH_PAGE_LIMIT = 50
+PLAYER_SEARCH_MAX_AGE = 60 # seconds type-ahead results may be cached by browsers
+
+PLAYER_PAGE_CACHE_SIZE = 1024
+PLAYER_PAGE_CACHE_TTL = 300 # seconds
+
+class PlayerPage(NamedTuple):
+    """ The cached, player-specific part of a player page """
+    player: Player
+    info: Markup                # rendered statistics and games
+    etag: str
+    last_modified: Optional[datetime]
+
+# (player id, query string) -> PlayerPage, tagged with the player id.
+# Invalidated whenever a game of the player finishes.
+player_pages = LRUCache(PLAYER_PAGE_CACHE_SIZE, ttl=PLAYER_PAGE_CACHE_TTL)
+
+GAME_FRAGMENT_CACHE_SIZE = 100_000
+
+# game id -> rendered gameresult.j2 of a finished game. Finished games never change, so these are never invalidated.
+game_fragments = LRUCache(GAME_FRAGMENT_CACHE_SIZE)
 
-class ApiListenerThread(threading.Thread):
-    def __init__(self, startup):
-        threading.Thread.__init__(self)
-        self.runnable = startup
+# Opt-in: print where the time went in requests slower than this many milliseconds, e.g. RPS_PROFILE_SLOW_MS=200
+PROFILE_SLOW_REQUESTS_MS = float(os.environ.get("RPS_PROFILE_SLOW_MS", 0))
 
-    def run(self):
-        self.runnable()
+# Opt-in: serve page reads from a copy of the database at most this many seconds old, e.g. RPS_SNAPSHOT_MAX_AGE=10,
+# so that they don't compete with ingest writes. See `database.ReadSnapshot`.
+SNAPSHOT_MAX_AGE = float(os.environ.get("RPS_SNAPSHOT_MAX_AGE", 0))
+
+_REQUEST_SECONDS = metrics.histogram("rps_http_request_seconds", "Duration of HTTP requests, by route and status",
+    ["endpoint", "method", "status"])
+_TEMPLATE_SECONDS = metrics.histogram("rps_template_render_seconds", "Duration of page and fragment renders, by template",
+    ["template"])
+
+def _cache_stats(stat: str):
+    return lambda: {
+        ("player_pages",): player_pages.stats()[stat],
+        ("player_ids",): database.player_cache_stats()[stat],
+        ("game_fragments",): game_fragments.stats()[stat],
+    }
+
+metrics.gauge("rps_cache_entries", "Entries in the in-memory caches", _cache_stats('size'), ["cache"])
+metrics.gauge("rps_cache_hits_total", "Cache hits", _cache_stats('hits'), ["cache"], kind="counter")
+metrics.gauge("rps_cache_misses_total", "Cache misses", _cache_stats('misses'), ["cache"], kind="counter")
+metrics.gauge("rps_cache_evictions_total", "Entries evicted from the caches", _cache_stats('evictions'), ["cache"], kind="counter")
+metrics.gauge("rps_live_games", "Games currently in progress", lambda: len(live_games))
+metrics.gauge("rps_live_seq", "Sequence number of the live games", lambda: live_games.seq, kind="counter")
+metrics.gauge("rps_live_games_changes_total", "Live games begun, finished, and dropped after outliving the TTL",
+    lambda: {(change,): live_games.stats()[change] for change in ("begun", "finished", "expired")}, ["change"], kind="counter")
+metrics.gauge("rps_history_games", "Finished games in the in-memory analytics", lambda: len(game_history))
+metrics.gauge("rps_indexed_players", "Players in the search index", lambda: len(player_index))
+
+class _TimedTemplate(Template):
+    """ Records the render time of each page (or separately rendered fragment); includes count towards their parent """
+    def render(self, *args, **kwargs):
+        with _TEMPLATE_SECONDS.time(template=self.name):
+            return super().render(*args, **kwargs)
 
 def get_live_games():
-    return live_games.values()
+    """ Snapshot of the live games, see `LiveGames.snapshot` """
+    return live_games.snapshot()
+
+def render_game(game) -> Markup:
+    """ gameresult.j2 for a game; cached for finished games """
+    if not is_finished(game):
+        return Markup(current_app.jinja_env.get_template("gameresult.j2").render(game=game))
+    html = game_fragments.get(game.gameId)
+    if html is None:
+        html = Markup(current_app.jinja_env.get_template("gameresult.j2").render(game=game))
+        game_fragments.put(game.gameId, html)
+    return html
 
 def create_app():
     app = Flask(__name__)
+    app.jinja_env.template_class = _TimedTemplate
+    # Flask only escapes .html (and the like) by default; the .j2 fragments show player names from the API too
+    app.jinja_env.autoescape = select_autoescape(("html", "htm", "xml", "xhtml", "j2"))
+    assets.StaticAssets().init_app(app)
+    profiler = SlowRequestProfiler(PROFILE_SLOW_REQUESTS_MS / 1000) if PROFILE_SLOW_REQUESTS_MS > 0 else None
+
+    @app.before_request
+    def start_timer():
+        g.request_start = time.perf_counter()
+        if profiler is not None:
+            g.profile = profiler.begin()
+
+    @app.after_request
+    def record_time(response):
+        # for streamed responses, this is the time until the response starts
+        _REQUEST_SECONDS.observe(time.perf_counter() - g.request_start,
+            endpoint=request.endpoint or "none", method=request.method, status=response.status_code)
+        return response
+
+    @app.teardown_request
+    def end_profile(exc):
+        if profiler is not None and 'profile' in g:
+            profiler.end(g.profile, f"{request.method} {request.full_path}")
+
+    @app.route("/metrics")
+    def prometheus_metrics():
+        return Response(metrics.render(), content_type=metrics.CONTENT_TYPE)
 
     app.jinja_env.globals.update(
         live_games = get_live_games,
+        render_game = render_game,
         is_finished = is_finished,
         is_win = is_win,
         emoji = emoji_from_play
     )
+    # compile all templates now, rather than on the first request that uses each one
+    for name in app.jinja_env.list_templates():
+        app.jinja_env.get_template(name)
 
     @app.route("/")
     def live():
@@ -38,62 +150,349 @@ def create_app():
 
     @app.route("/history")
     def history():
-        # TODO
-        return "history"
+        games, next_cursor, prev_cursor = _games_page(database.get_games_history, database.get_games_history_keyset)
+
+        return render_template("history.html",
+            past_games = games, next_cursor = next_cursor, prev_cursor = prev_cursor
+        )
+
+    @app.route("/history/export")
+    def history_export():
+        # ?format=ndjson|csv, and optionally ?since=&until= (timestamps, in ms) and ?player=<player id>
+        fmt = request.args.get('format', 'ndjson')
+        if fmt not in export.FORMATS:
+            abort(400)
+        since, until = _int_arg('since'), _int_arg('until')
+        player = request.args.get('player')
+        if player is not None:
+            try:
+                player = str(uuid.UUID(player))
+            except ValueError:
+                abort(400)
+
+        mimetype, extension, to_text = export.FORMATS[fmt]
+        body = to_text(database.iter_game_rows(export.EXPORT_FETCH_SIZE, since, until, player))
+        compress = bool(request.accept_encodings['gzip'])
+        if compress:
+            body = export.gzipped(body)
+
+        # no Content-Length, so the response is sent in chunks as it is generated
+        response = Response(body, mimetype=mimetype)
+        if compress:
+            response.content_encoding = 'gzip'
+        response.vary.add('Accept-Encoding')
+        response.headers['Content-Disposition'] = f'attachment; filename="history.{extension}"'
+        return response
+
+    @app.route("/stats/top")
+    def top_players():
+        n = max(0, min(request.args.get('n', 10, type=int), 100))
+        by = request.args.get('by', 'wins')
+        if by not in ('wins', 'win_rate'):
+            abort(400)
+        min_games = request.args.get('min_games', 0, type=int)
+        return jsonify(game_history.top_players(n, by, min_games))
+
+    @app.route("/stats/h2h/<uuid:a>/<uuid:b>")
+    def head_to_head(a: str, b: str):
+        record = game_history.head_to_head(str(a), str(b))
+        if record is None:
+            abort(404)
+        return jsonify(record)
 
     @app.route("/player/")
     def player_search():
-        # TODO
-        return "player_search"
+        query = request.args.get('q', '')
+        return render_template("search.html",
+            query = query, players = player_index.search(query, PLAYER_SEARCH_PAGE_LIMIT)
+        )
+
+    @app.route("/player/search")
+    def player_typeahead():
+        # for type-ahead, so called on every keystroke
+        n = min(request.args.get('n', search.PLAYER_SEARCH_LIMIT, type=int), PLAYER_SEARCH_PAGE_LIMIT)
+        response = jsonify(player_index.search(request.args.get('q', ''), n))
+        response.cache_control.max_age = PLAYER_SEARCH_MAX_AGE
+        return response
 
     @app.route("/player/<uuid:pid>")
     def player(pid: str):
         pid = str(pid)
-        _player = database.get_player(pid)
+        key = (pid, request.query_string)
+        page = player_pages.get(key)
+        if page is None:
+            # a game saved while rendering invalidates the pid; the page is then left out of the cache
+            generation = player_pages.generation(pid)
+            page = _render_player_page(pid)
+            player_pages.put(key, page, tag=pid, generation=generation)
+
+        response = make_response(render_template("player.html", player = page.player, player_info = page.info))
+        # weak, as the live games part of the page isn't covered
+        response.set_etag(page.etag, weak=True)
+        response.last_modified = page.last_modified
+        response.cache_control.no_cache = True
+        return response.make_conditional(request)
 
-        ((w,l,t), plays) = database.get_player_stats(pid)
+    return app
 
-        most_played_count = max(plays)
-        most_played = ("Rock", "Paper", "Scissors")[plays.index(most_played_count)]
+def _render_player_page(pid: str) -> PlayerPage:
+    _player = database.get_player(pid)
 
-        past_games = database.get_games_by_player(pid)
+    ((w,l,t), plays) = database.get_player_stats(pid)
 
-        return render_template("player.html",
-            player = _player,
-            wins = w, losses = l, ties = t, games = (w+l+t),
-            most_played = most_played, most_played_count = most_played_count,
-            past_games = past_games
-        )
-    return app
+    most_played_count = max(plays)
+    most_played = ("Rock", "Paper", "Scissors")[plays.index(most_played_count)]
+
+    past_games, next_cursor, prev_cursor = _games_page(
+        lambda page: database.get_games_by_player(pid, page),
+        lambda cursor: database.get_games_by_player_keyset(pid, cursor)
+    )
+
+    info = render_template("playerinfo.j2",
+        wins = w, losses = l, ties = t, games = (w+l+t),
+        most_played = most_played, most_played_count = most_played_count,
+        past_games = past_games, next_cursor = next_cursor, prev_cursor = prev_cursor
+    )
+
+    last_played = database.get_player_last_played(pid)
+    return PlayerPage(
+        player = _player,
+        info = Markup(info),
+        etag = hashlib.sha1(f"{_player.name}\0{info}".encode()).hexdigest(),
+        last_modified = datetime.fromtimestamp(last_played / 1000, timezone.utc) if last_played else None
+    )
+
+def _int_arg(name: str) -> Optional[int]:
+    """ An optional integer query parameter; aborts with 400 if it is given but isn't an integer """
+    if name not in request.args:
+        return None
+    value = request.args.get(name, type=int)
+    if value is None:
+        abort(400)
+    return value
+
+def _games_page(by_page, by_cursor):
+    """ Get a page of games for a listing, based on the request's query parameters
+
+    Either `?page=n` (offset-based, no cursors returned) or `?cursor=...` (keyset-based).
+    The latter is used by default, and by the links on the pages themselves.
+
+    returns (games, next_cursor, prev_cursor)
+    """
+    if 'page' in request.args:
+        page = request.args.get('page', type=int)
+        if page is None or page < 0:
+            abort(400)
+        return by_page(page), None, None
+
+    try:
+        return by_cursor(request.args.get('cursor'))
+    except ValueError:
+        abort(400)
+
+def games_saved(games: List[GameResult]) -> None:
+    """ Bring the in-memory views up to date with newly saved games """
+    for game in games:
+        # the players' pages are now out of date
+        player_pages.invalidate_tag(game.player1.pid)
+        player_pages.invalidate_tag(game.player2.pid)
+    game_history.add(games)
+    player_index.played([p.pid for game in games for p in (game.player1, game.player2)])
+
+def on_api_gamebegin(game: GameBegin) -> None:
+    # new game, add to live games (to be broadcast by the broadcaster)
+    live_games.begin(game)
+
+def on_api_gameresult(game: GameResult) -> None:
+    # game finished, remove from live games (if it is there)
+    live_games.finish(game.gameId)
+    games_saved([game])
+
+def on_api_known_gameresult(game: GameResult) -> None:
+    # already saved from the history, so only the live games need updating
+    live_games.finish(game.gameId)
 
 def socketio_app(app):
     socketio = SocketIO(app, logging=True)
 
-    def on_api_gamebegin(game: GameBegin) -> None:
-        # new game, add to live games and broadcast
-        live_games[game['gameId']] = game
+    broadcaster = Broadcaster(live_games, lambda frame: socketio.emit('games', frame, namespace='/livefeed'))
+    # changes before coalescing and frames after it; their rates are the message rates without and with coalescing
+    metrics.gauge("rps_broadcast_events_total", "Live game changes picked up by the broadcaster",
+        lambda: broadcaster.events, kind="counter")
+    metrics.gauge("rps_broadcast_frames_total", "Frames emitted to SocketIO clients by the broadcaster",
+        lambda: broadcaster.frames, kind="counter")
+    metrics.gauge("rps_broadcast_cancelled_total", "Live game changes left out, as a begin and its result fell in the same frame",
+        lambda: broadcaster.cancelled, kind="counter")
 
-        socketio.emit('game begin', {'gameInfo': game}, namespace='/livefeed')
+    @socketio.on('sync', namespace='/livefeed')
+    def on_sync(data):
+        # a (re)connecting client asks for the changes since the state it has; replied to as an acknowledgement
+        try:
+            epoch, seq = data.get('epoch'), int(data.get('seq', 0))
+        except (AttributeError, TypeError, ValueError):
+            epoch, seq = None, 0
+        return live_games.changes_since(epoch, seq)
 
-    def on_api_gameresult(game: GameResult) -> None:
-        # game finished, remove from live games (if it is there)
-        live_games.pop(game['gameId'], None)
+    return socketio, broadcaster
 
-        socketio.emit('game result', {'gameId': game['gameId']}, namespace='/livefeed')
+def live_feed(on_result, on_begin, on_known) -> apiconn.LiveFeed:
+    """ The API live feed, with its queues exposed as metrics """
+    feed = apiconn.LiveFeed(on_result, on_begin, on_known=on_known)
+    metrics.gauge("rps_queue_depth", "Items waiting in the live feed's queues", lambda: {
+        ("live_events",): feed.events.qsize(),
+        ("writer",): feed.writer.stats()['queue_depth'],
+    }, ["queue"])
+    return feed
 
-    api_listener = apiconn.create_websocket_listener(on_api_gameresult, on_api_gamebegin)
+def prepare_database() -> None:
+    """ Bring the database schema up to date, and warm its caches """
+    database.migrate()
+    database.warm_player_cache()
+    database.warm_saved_games()
 
-    return socketio, api_listener
+def fetch_missed_history(on_saved: Optional[Callable[[List[GameResult]], None]] = None) -> None:
+    """ Fetch the history missed while not running """
+    # whatever finishes between this and the live feed connecting is filled in by reconciling
+    history_time = int(time.time() * 1000)
+    if apiconn.fetch_new_history(on_saved=on_saved):
+        database.add_coverage(history_time, history_time, "history")
 
-if __name__ == "__main__":
+def load_views() -> int:
+    """ Load the in-memory views of the stored games, and take the read snapshot if enabled.
+    Returns the `database.get_players_and_last_game_row` mark of the games loaded. """
+    players, mark = database.get_players_and_last_game_row()
+    game_history.load(mark)
+    player_index.load(players)
+    if SNAPSHOT_MAX_AGE > 0:
+        database.enable_snapshot(SNAPSHOT_MAX_AGE)
+    return mark
+
+def reconcile_history_forever(sleep, on_saved) -> None:
+    while True:
+        sleep(apiconn.RECONCILE_INTERVAL)
+        try:
+            apiconn.reconcile_history(on_saved=on_saved)
+        except Exception as e:
+            print(f"Error reconciling history: {e!r}")
+
+def refresh_snapshot_forever(sleep) -> None:
+    while True:
+        # twice per allowed age, so that one slow or failed refresh doesn't make it too old
+        sleep(SNAPSHOT_MAX_AGE / 2)
+        try:
+            database.refresh_snapshot()
+        except Exception as e:
+            print(f"Error refreshing read snapshot: {e!r}")
 
-    # update missing history
-    apiconn.fetch_new_history()
+def run_all(port: int) -> None:
+    """ A single process doing everything: ingest, and serving pages and SocketIO clients """
+    prepare_database()
+    fetch_missed_history()
+    load_views()
 
     app = create_app()
-    socketio, api_ws = socketio_app(app)
+    socketio, broadcaster = socketio_app(app)
+    feed = live_feed(on_api_gameresult, on_api_gamebegin, on_api_known_gameresult)
 
-    api_thread = ApiListenerThread(api_ws.run_forever)
-    api_thread.start()
+    # run the listener and broadcaster as SocketIO background tasks, so that they use the same async mode as the server
+    feed.start(socketio.start_background_task)
+    broadcaster.start(socketio.start_background_task, socketio.sleep)
+    live_games.start(socketio.start_background_task, socketio.sleep)
+    socketio.start_background_task(reconcile_history_forever, socketio.sleep, games_saved)
+    if SNAPSHOT_MAX_AGE > 0:
+        socketio.start_background_task(refresh_snapshot_forever, socketio.sleep)
+
+    try:
+        socketio.run(app, port=port)
+    finally:
+        feed.stop()
+        broadcaster.stop()
+        live_games.stop()
+
+def run_ingest(bus_address: bus.Address) -> None:
+    """ The ingest worker: the only process connected to the API and writing to the database.
+    Publishes live events for the web workers. """
+    prepare_database()
+
+    # started before anything is saved, so that web workers which are already running hear of all of it
+    publisher = bus.BusPublisher(bus_address, mark=database.get_last_game_row)
+    database.on_players_created(publisher.players)
+    publisher.start()
+    print(f"Publishing live events at {publisher.address[0]}:{publisher.address[1]}")
+
+    def publish_saved(games: List[GameResult]) -> None:
+        rows = database.get_game_rows([game.gameId for game in games])
+        for game in games:
+            publisher.result(game, row=rows.get(game.gameId))
+
+    fetch_missed_history(publish_saved)
+    feed = live_feed(lambda game: publish_saved([game]), publisher.begin, publisher.known)
+    feed.start()
+
+    try:
+        reconcile_history_forever(time.sleep, publish_saved)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        feed.stop()
+        publisher.stop()
+
+def followed_games_saved(games: List[GameResult]) -> None:
+    """ Bring the in-memory views up to date with games saved by the ingest worker """
+    database.games_written(games)
+    player_index.add({p.name: p.pid for game in games for p in (game.player1, game.player2)})
+    games_saved(games)
+
+def run_web(bus_address: bus.Address, port: int) -> None:
+    """ A web worker: serves pages and SocketIO clients, following the ingest worker's live events """
+    # whichever worker starts first migrates; the others find the schema up to date, or wait for it
+    database.migrate()
+    applied = bus.AppliedRows(load_views())
+
+    def on_bus_state(games: List[GameBegin], row: Optional[int]) -> None:
+        live_games.sync(games)
+        if row is None:
+            return
+        # catch up with what was saved while not connected (or since loading), up to where the bus takes over
+        for chunk in database.iter_games_between_rows(applied.mark, row):
+            followed_games_saved([game for game_row, game in chunk if applied.add(game_row)])
+        applied.advance(row)
+
+    def on_bus_gameresult(game: GameResult, new: bool, row: Optional[int]) -> None:
+        live_games.finish(game.gameId)
+        if new and applied.add(row):
+            followed_games_saved([game])
+
+    app = create_app()
+    socketio, broadcaster = socketio_app(app)
+    subscriber = bus.BusSubscriber(on_bus_state, on_api_gamebegin, on_bus_gameresult, player_index.add, bus_address)
+
+    subscriber.start(socketio.start_background_task)
+    broadcaster.start(socketio.start_background_task, socketio.sleep)
+    live_games.start(socketio.start_background_task, socketio.sleep)
+    if SNAPSHOT_MAX_AGE > 0:
+        socketio.start_background_task(refresh_snapshot_forever, socketio.sleep)
+
+    try:
+        socketio.run(app, port=port)
+    finally:
+        subscriber.stop()
+        broadcaster.stop()
+        live_games.stop()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="RPSchive server")
+    parser.add_argument("--role", choices=("all", "ingest", "web"), default="all",
+        help="all: a single process doing everything (the default); "
+             "ingest: only keep the database up to date, publishing live events to web workers; "
+             "web: only serve pages, following an ingest worker's live events")
+    parser.add_argument("--bus", default=f"{bus.BUS_HOST}:{bus.BUS_PORT}", help="host:port of the live event bus")
+    parser.add_argument("--port", type=int, default=5000, help="HTTP port, for the all and web roles")
+    args = parser.parse_args()
 
-    socketio.run(app)
\ No newline at end of file
+    if args.role == "ingest":
+        run_ingest(bus.parse_address(args.bus))
+    elif args.role == "web":
+        run_web(bus.parse_address(args.bus), args.port)
+    else:
+        run_all(args.port)
@@ -0,0 +1,193 @@
+""" Instrumentation: counters, gauges and latency histograms, exposed at /metrics in the Prometheus text format
+
+Modules define their metrics at import time, with `counter()`, `gauge()` and `histogram()`, and all of them are
+rendered together by `render()`. Updates take a lock per metric, and are cheap enough to be done on every
+query and request.
+"""
+
+import bisect
+import functools
+import math
+import threading
+import time
+from contextlib import contextmanager
+
+from typing import Callable, Dict, Iterator, List, Sequence, Tuple, Union
+
+
+# seconds; from half a millisecond (a cached page) to ten seconds (a history download)
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+LabelValues = Tuple[str, ...]
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+def _format_labels(names: Sequence[str], values: Sequence[str]) -> str:
+    if not names:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in zip(names, values)) + "}"
+
+def _format_value(value: float) -> str:
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+class Metric:
+    kind = "untyped"
+
+    def __init__(self, name: str, documentation: str, labels: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self._lock = threading.Lock()
+
+    def _key(self, labels: Dict[str, object]) -> LabelValues:
+        if len(labels) != len(self.labels):
+            raise ValueError(f"{self.name} takes labels {self.labels}, got {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labels)
+
+    def samples(self) -> Iterator[Tuple[str, Sequence[str], LabelValues, float]]:
+        """ (suffix, label names, label values, value) of each sample """
+        return iter(())
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        for suffix, names, values, value in self.samples():
+            lines.append(f"{self.name}{suffix}{_format_labels(names, values)} {_format_value(value)}")
+        return lines
+
+
+class Counter(Metric):
+    """ A count that only goes up, e.g. games saved """
+    kind = "counter"
+
+    def __init__(self, name: str, documentation: str, labels: Sequence[str] = ()):
+        super().__init__(name, documentation, labels)
+        self._values: Dict[LabelValues, float] = {}
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            values = dict(self._values)
+        for key, value in sorted(values.items()):
+            yield "", self.labels, key, value
+
+
+class Gauge(Metric):
+    """ A value read when the metrics are rendered, e.g. a queue length
+
+    `read` returns the value, or for a gauge with labels, {label values: value}.
+    Counts kept elsewhere (e.g. in a `stats()` dict) can be exposed the same way, with kind="counter".
+    """
+
+    def __init__(self, name: str, documentation: str, read: Callable[[], Union[float, Dict[LabelValues, float]]],
+            labels: Sequence[str] = (), kind: str = "gauge"):
+        super().__init__(name, documentation, labels)
+        self.read = read
+        self.kind = kind
+
+    def samples(self):
+        try:
+            value = self.read()
+        except Exception as e:
+            print(f"Error reading gauge {self.name}: {e!r}")
+            return
+        if isinstance(value, dict):
+            for key, v in sorted(value.items()):
+                yield "", self.labels, key if isinstance(key, tuple) else (str(key),), v
+        else:
+            yield "", self.labels, (), value
+
+
+class Histogram(Metric):
+    """ Distribution of durations (or other values), counted into cumulative buckets """
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labels: Sequence[str] = (), buckets: Sequence[float] = LATENCY_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(sorted(buckets))
+        # label values -> [count per bucket (the last one for values above all buckets), sum]
+        self._values: Dict[LabelValues, list] = {}
+
+    def observe(self, value: float, **labels) -> None:
+        key = self._key(labels)
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            entry[0][i] += 1
+            entry[1] += value
+
+    @contextmanager
+    def time(self, **labels) -> Iterator[None]:
+        """ Observe the duration of the block, in seconds """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def timed(self, **labels) -> Callable[[Callable], Callable]:
+        """ Decorator observing the duration of each call. A label given as None is set to the function's name. """
+        def decorator(f: Callable) -> Callable:
+            values = {name: f.__name__ if value is None else value for name, value in labels.items()}
+            @functools.wraps(f)
+            def wrapper(*args, **kwargs):
+                with self.time(**values):
+                    return f(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def samples(self):
+        with self._lock:
+            values = {key: (list(counts), total) for key, (counts, total) in self._values.items()}
+        names = self.labels + ("le",)
+        for key, (counts, total) in sorted(values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (math.inf,), counts):
+                cumulative += count
+                yield "_bucket", names, key + (_format_value(bound),), cumulative
+            yield "_sum", self.labels, key, total
+            yield "_count", self.labels, key, cumulative
+
+
+class Registry:
+    def __init__(self):
+        self._metrics: Dict[str, Metric] = {}
+        self._lock = threading.Lock()
+
+    def register(self, metric: Metric) -> Metric:
+        """ Add a metric; one registered again under the same name (e.g. by a new app instance) replaces the old one """
+        with self._lock:
+            self._metrics[metric.name] = metric
+        return metric
+
+    def render(self) -> str:
+        with self._lock:
+            metrics = list(self._metrics.values())
+        return "\n".join(line for metric in metrics for line in metric.render()) + "\n"
+
+
+REGISTRY = Registry()
+
+def counter(name: str, documentation: str, labels: Sequence[str] = ()) -> Counter:
+    return REGISTRY.register(Counter(name, documentation, labels))
+
+def gauge(name: str, documentation: str, read: Callable, labels: Sequence[str] = (), kind: str = "gauge") -> Gauge:
+    return REGISTRY.register(Gauge(name, documentation, read, labels, kind))
+
+def histogram(name: str, documentation: str, labels: Sequence[str] = (), buckets: Sequence[float] = LATENCY_BUCKETS) -> Histogram:
+    return REGISTRY.register(Histogram(name, documentation, labels, buckets))
+
+def render() -> str:
+    return REGISTRY.render()
@@ -0,0 +1,40 @@
+-- Indexes for the hot read paths, and a proper key for plays.
+--
+-- plays gets a `side` column ('A' for player1, 'B' for player2), so that a game where a player plays
+-- against themself joins to exactly one play per side, instead of four rows.
+
+CREATE TABLE plays_new (
+    game_id     TEXT        NOT NULL,
+    side        CHAR(1)     NOT NULL CHECK(side IN ('A', 'B')),
+    player_id   TEXT        NOT NULL,
+    played      CHAR(1)     NOT NULL,
+    result      CHAR(1)     NOT NULL,
+    PRIMARY KEY (game_id, side),
+    FOREIGN KEY (played) REFERENCES play_enum(type),
+    FOREIGN KEY (result) REFERENCES result_enum(type)
+) WITHOUT ROWID;
+
+-- The first stored play of player1 is side A, the other play of the game is side B.
+-- For games against oneself both plays were stored identically, so either one will do.
+INSERT OR IGNORE INTO plays_new(game_id, side, player_id, played, result)
+SELECT plays.game_id,
+    CASE WHEN plays.rowid = (
+        SELECT MIN(first.rowid) FROM plays AS first
+        WHERE first.game_id = plays.game_id AND first.player_id = games.p1_id
+    ) THEN 'A' ELSE 'B' END,
+    plays.player_id, plays.played, plays.result
+FROM plays
+INNER JOIN games ON games.game_id = plays.game_id
+ORDER BY plays.rowid;
+
+DROP TABLE plays;
+ALTER TABLE plays_new RENAME TO plays;
+
+-- player pages: a player's games, newest first
+CREATE INDEX IF NOT EXISTS games_p1_time ON games(p1_id, time);
+CREATE INDEX IF NOT EXISTS games_p2_time ON games(p2_id, time);
+-- history: all games, newest first
+CREATE INDEX IF NOT EXISTS games_time ON games(time);
+-- player statistics
+CREATE INDEX IF NOT EXISTS plays_player_result ON plays(player_id, result);
+CREATE INDEX IF NOT EXISTS plays_player_played ON plays(player_id, played);
@@ -0,0 +1,20 @@
+-- Per-player statistics, kept up to date as games are added, so player pages don't have to scan plays.
+-- Can be rebuilt from plays with `python database.py rebuild-stats`.
+
+CREATE TABLE player_stats (
+    player_id   TEXT        PRIMARY KEY NOT NULL,
+    wins        INTEGER     NOT NULL DEFAULT 0,
+    losses      INTEGER     NOT NULL DEFAULT 0,
+    ties        INTEGER     NOT NULL DEFAULT 0,
+    rock        INTEGER     NOT NULL DEFAULT 0,
+    paper       INTEGER     NOT NULL DEFAULT 0,
+    scissors    INTEGER     NOT NULL DEFAULT 0,
+    FOREIGN KEY (player_id) REFERENCES players(player_id)
+) WITHOUT ROWID;
+
+INSERT INTO player_stats(player_id, wins, losses, ties, rock, paper, scissors)
+SELECT player_id,
+    SUM(result = 'W'), SUM(result = 'L'), SUM(result = 'T'),
+    SUM(played = 'R'), SUM(played = 'P'), SUM(played = 'S')
+FROM plays
+GROUP BY player_id;
@@ -0,0 +1,9 @@
+-- Indexes matching the (time, game_id) order used by keyset pagination, replacing the time-only ones.
+
+DROP INDEX IF EXISTS games_p1_time;
+DROP INDEX IF EXISTS games_p2_time;
+DROP INDEX IF EXISTS games_time;
+
+CREATE INDEX IF NOT EXISTS games_p1_time_id ON games(p1_id, time, game_id);
+CREATE INDEX IF NOT EXISTS games_p2_time_id ON games(p2_id, time, game_id);
+CREATE INDEX IF NOT EXISTS games_time_id ON games(time, game_id);
@@ -0,0 +1,24 @@
+-- Denormalized copy of finished games, one row per game, so listings can be read without joins.
+-- `packed` holds player1's play, player2's play, player1's result and player2's result, e.g. 'RSWL'.
+
+CREATE TABLE game_rows (
+    game_id     TEXT        PRIMARY KEY NOT NULL,
+    time        INTEGER     NOT NULL,
+    p1_id       TEXT        NOT NULL,
+    p1_name     TEXT        NOT NULL,
+    p2_id       TEXT        NOT NULL,
+    p2_name     TEXT        NOT NULL,
+    packed      CHAR(4)     NOT NULL
+);
+
+INSERT INTO game_rows(game_id, time, p1_id, p1_name, p2_id, p2_name, packed)
+SELECT games.game_id, games.time, p1_id, p1.name, p2_id, p2.name, r1.played || r2.played || r1.result || r2.result
+FROM games
+INNER JOIN players AS p1 ON games.p1_id = p1.player_id
+INNER JOIN players AS p2 ON games.p2_id = p2.player_id
+INNER JOIN plays AS r1 ON games.game_id = r1.game_id AND r1.side = 'A'
+INNER JOIN plays AS r2 ON games.game_id = r2.game_id AND r2.side = 'B';
+
+CREATE INDEX IF NOT EXISTS game_rows_p1_time_id ON game_rows(p1_id, time, game_id);
+CREATE INDEX IF NOT EXISTS game_rows_p2_time_id ON game_rows(p2_id, time, game_id);
+CREATE INDEX IF NOT EXISTS game_rows_time_id ON game_rows(time, game_id);
@@ -0,0 +1,25 @@
+-- Bookkeeping for filling gaps in the live feed from the history API.
+-- Times are in milliseconds since the epoch, like games.time.
+
+-- Time range of the games on each fetched history page, so that games missed by the live feed can be fetched
+-- again from just the pages that may hold them. The first page's cursor is ''.
+CREATE TABLE history_pages (
+    cursor      TEXT        PRIMARY KEY NOT NULL,
+    min_time    INTEGER,                -- NULL for an empty page
+    max_time    INTEGER,
+    games       INTEGER     NOT NULL,
+    fetched_at  INTEGER     NOT NULL
+);
+
+CREATE INDEX IF NOT EXISTS history_pages_time ON history_pages(min_time, max_time);
+
+-- Periods during which finished games are known to have been saved: while connected to the live feed,
+-- or filled in afterwards from the history API. Whatever lies between two periods is a gap.
+CREATE TABLE live_coverage (
+    id          INTEGER     PRIMARY KEY,
+    start_time  INTEGER     NOT NULL,
+    end_time    INTEGER     NOT NULL,   -- moved forward while the period is ongoing
+    source      TEXT        NOT NULL    -- 'live' or 'history'
+);
+
+CREATE INDEX IF NOT EXISTS live_coverage_start ON live_coverage(start_time);
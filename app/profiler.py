@@ -0,0 +1,88 @@
+""" Sampling profiler for slow requests
+
+While a request is being handled, a background thread samples the stack of the thread handling it every few
+milliseconds. If the request turns out slower than the threshold, the samples are printed, most frequent
+stack first, as "outermost;...;innermost count" lines (the folded format of flame graph tools).
+Requests that finish in time cost little more than registering and unregistering the thread.
+
+Relies on each request having a thread of its own, as with the threading async mode.
+"""
+
+import collections
+import os
+import sys
+import threading
+import time
+
+from typing import Callable, Dict, Optional, Tuple
+
+
+PROFILE_INTERVAL = 0.005    # seconds between samples
+PROFILE_TOP_STACKS = 10     # stacks printed per slow request
+PROFILE_STACK_DEPTH = 40    # innermost frames kept per sample
+
+
+def _stack(frame) -> str:
+    """ A frame and its callers, outermost first, as "function (file:line)" separated with ";" """
+    entries = []
+    while frame is not None and len(entries) < PROFILE_STACK_DEPTH:
+        code = frame.f_code
+        entries.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+        frame = frame.f_back
+    return ";".join(reversed(entries))
+
+
+class SlowRequestProfiler:
+    """ Profiles requests (or any other unit of work) taking longer than `threshold` seconds
+
+    Call `begin()` at the start of a request, and `end()` with its return value and a description at the end,
+    in the same thread.
+    """
+
+    def __init__(self, threshold: float, interval: float = PROFILE_INTERVAL, top: int = PROFILE_TOP_STACKS,
+            out: Callable[[str], None] = print):
+        self.threshold = threshold
+        self.interval = interval
+        self.top = top
+        self.out = out
+        # thread id -> stack counts of the request it is handling
+        self._active: Dict[int, collections.Counter] = {}
+        self._lock = threading.Lock()
+        self._sampler: Optional[threading.Thread] = None
+        self.profiled = 0
+
+    def _run(self) -> None:
+        while True:
+            time.sleep(self.interval)
+            with self._lock:
+                if not self._active:
+                    continue
+                frames = sys._current_frames()
+                for ident, counts in self._active.items():
+                    frame = frames.get(ident)
+                    if frame is not None:
+                        counts[_stack(frame)] += 1
+
+    def begin(self) -> Tuple[int, float]:
+        ident = threading.get_ident()
+        with self._lock:
+            self._active[ident] = collections.Counter()
+            if self._sampler is None:
+                self._sampler = threading.Thread(target=self._run, name="slow-request-profiler", daemon=True)
+                self._sampler.start()
+        return ident, time.perf_counter()
+
+    def end(self, token: Tuple[int, float], description: str) -> None:
+        ident, start = token
+        elapsed = time.perf_counter() - start
+        with self._lock:
+            counts = self._active.pop(ident, None)
+        if counts is None or elapsed < self.threshold:
+            return
+
+        self.profiled += 1
+        total = sum(counts.values())
+        lines = [f"Slow request: {description} took {elapsed * 1000:.0f} ms, {total} samples every {self.interval * 1000:.0f} ms"]
+        for stack, count in counts.most_common(self.top):
+            lines.append(f"  {stack} {count}")
+        self.out("\n".join(lines))
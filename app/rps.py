@@ -1,7 +1,9 @@
 """ Handle rock-paper-scissors logic """
 
 from enum import Enum
-from typing import Optional
+from typing import Optional, Sequence, Union
+
+import numpy as np
 
 class RPS(Enum):
     ROCK = "R"
@@ -13,58 +15,76 @@ class Result(Enum):
     LOSS = "L"
     TIE = "T"
 
+# Small integer codes for plays and results (their index here), e.g. for compact arrays
+RPS_ORDER = (RPS.ROCK, RPS.PAPER, RPS.SCISSORS)
+RESULT_ORDER = (Result.WIN, Result.LOSS, Result.TIE)
+
+# what each play beats
+_BEATS = {RPS.ROCK: RPS.SCISSORS, RPS.PAPER: RPS.ROCK, RPS.SCISSORS: RPS.PAPER}
+
+# A's result for every (A, B) pair of plays
+_RESULTS = {
+    a: {b: Result.TIE if a is b else Result.WIN if _BEATS[a] is b else Result.LOSS for b in RPS}
+    for a in RPS
+}
+
+# The same as a 3x3 matrix of result codes, indexed by play codes: OUTCOMES[a, b]
+OUTCOMES = np.array([
+    [RESULT_ORDER.index(_RESULTS[a][b]) for b in RPS_ORDER]
+    for a in RPS_ORDER
+], dtype=np.int8)
+
 def get_result(a: RPS, b: RPS) -> Optional[Result]:
-    """ Return result of game from A's perspective 
-    
+    """ Return result of game from A's perspective
+
     That is, if A plays ROCK and B plays SCISSORS, this function returns WIN.
-    
+
     If given one or more invalid plays, returns None"""
 
-    if a == b:
-        return Result.TIE
-    elif a == RPS.ROCK:
-        if b == RPS.PAPER:
-            return Result.LOSS
-        elif b == RPS.SCISSORS:
-            return Result.WIN
-    elif a == RPS.PAPER:
-        if b == RPS.ROCK:
-            return Result.WIN
-        elif b == RPS.SCISSORS:
-            return Result.LOSS
-    elif a == RPS.SCISSORS:
-        if b == RPS.ROCK:
-            return Result.LOSS
-        if b == RPS.PAPER:
-            return Result.WIN
-
-    # unreachable if typing is adhered to
-    print(f"Unknown play in match: {a} vs {b}")
-    return None
+    try:
+        return _RESULTS[a][b]
+    except (KeyError, TypeError):
+        # unreachable if typing is adhered to
+        print(f"Unknown play in match: {a} vs {b}")
+        return None
+
+def get_results(a: Union[np.ndarray, Sequence[int]], b: Union[np.ndarray, Sequence[int]]) -> np.ndarray:
+    """ Results of many games at once, from A's perspective
+
+    Takes arrays of play codes (indices into RPS_ORDER) for A and B, returns an int8 array of
+    result codes (indices into RESULT_ORDER)."""
+    return OUTCOMES[np.asarray(a, dtype=np.intp), np.asarray(b, dtype=np.intp)]
+
+def _spellings(words: dict) -> dict:
+    """ Lookup table with each accepted word in lower case, upper case (as the API has it) and capitalized """
+    return {form: value for word, value in words.items() for form in (word, word.upper(), word.capitalize())}
+
+_RPS_BY_STR = _spellings({
+    'r': RPS.ROCK, 'rock': RPS.ROCK, 'kivi': RPS.ROCK,
+    's': RPS.SCISSORS, 'scissors': RPS.SCISSORS, 'sakset': RPS.SCISSORS,
+    'p': RPS.PAPER, 'paper': RPS.PAPER, 'paperi': RPS.PAPER,
+})
+
+_RESULT_BY_STR = _spellings({
+    'w': Result.WIN, 'win': Result.WIN,
+    'l': Result.LOSS, 'loss': Result.LOSS,
+    't': Result.TIE, 'tie': Result.TIE,
+})
 
 def rps_from_str(s: str) -> Optional[RPS]:
     """ Validates a string into an acceptable rock-paper-scissors play. """
-    s = s.lower()
-    if s in ('r', 'rock', 'kivi'):
-        return RPS.ROCK
-    elif s in ('s', 'scissors', 'sakset'):
-        return RPS.SCISSORS
-    elif s in ('p', 'paper', 'paperi'):
-        return RPS.PAPER
-    else:
-        return None
+    play = _RPS_BY_STR.get(s)
+    if play is None:
+        # any other mix of upper and lower case
+        play = _RPS_BY_STR.get(s.lower())
+    return play
 
 def result_from_str(s: str) -> Optional[Result]:
     """ Validates a string into an acceptable result. """
-    s = s.lower()
-    if s in ('w', 'win'):
-        return Result.WIN
-    elif s in ('l', 'loss'):
-        return Result.LOSS
-    elif s in ('t', 'tie'):
-        return Result.TIE
-    else:
-        return None
+    result = _RESULT_BY_STR.get(s)
+    if result is None:
+        result = _RESULT_BY_STR.get(s.lower())
+    return result
 
 # stuff for frontend templates
 
@@ -80,4 +100,4 @@ def emoji_from_play(p: RPS) -> str:
     elif p == RPS.SCISSORS:
         return "✌️"
     else:
-        return ""
\ No newline at end of file
+        return ""
@@ -0,0 +1,112 @@
+""" Prefix search over player names
+
+There is no index on players.name, so instead of `LIKE 'prefix%'` scans, names are kept in memory as a sorted list
+of case-folded keys. All names starting with a prefix are then a contiguous slice, found with two binary searches.
+"""
+
+import bisect
+import threading
+import numpy as np
+
+from typing import Dict, Iterable, List, Tuple
+from apityping import PlayerId, PlayerName
+
+
+PLAYER_SEARCH_LIMIT = 10
+PLAYER_INDEX_INITIAL_CAPACITY = 1 << 12
+
+# sorts after any character, so (prefix + _LAST) is after every string starting with prefix
+_LAST = chr(0x10FFFF)
+
+
+class PlayerIndex:
+    """ Player names in case-insensitive order, ranked by number of games played
+
+    Built with `load()` from the database, then kept up to date with `add()` as players are created,
+    and `played()` as their games finish.
+
+    Each player has a slot, in order of addition; numbers of games are kept in an array by slot, so that
+    the most active of thousands of matches (e.g. for a single letter) can be picked without a Python loop.
+    """
+
+    def __init__(self):
+        self._keys: List[str] = []                          # case-folded names, sorted
+        self._order = np.empty(0, dtype=np.int32)           # slot of each player, in the same order as _keys
+        self._players: List[Tuple[PlayerId, PlayerName]] = []   # by slot
+        self._slots: Dict[PlayerId, int] = {}
+        self._games = np.zeros(PLAYER_INDEX_INITIAL_CAPACITY, dtype=np.int64)   # by slot
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._keys)
+
+    def _reserve(self, count: int) -> None:
+        """ Make room for `count` more players in the games array. Must hold the lock. """
+        needed = len(self._players) + count
+        if needed > len(self._games):
+            grown = np.zeros(max(needed, 2 * len(self._games)), dtype=np.int64)
+            grown[:len(self._players)] = self._games[:len(self._players)]
+            self._games = grown
+
+    def load(self, players: Iterable[Tuple[PlayerId, PlayerName, int]]) -> int:
+        """ Replace the contents with (id, name, number of games) of each player. Returns the number of players. """
+        players = list(players)
+        order = sorted(range(len(players)), key=lambda slot: players[slot][1].casefold())
+        with self._lock:
+            self._players = [(pid, name) for pid, name, _ in players]
+            self._slots = {pid: slot for slot, (pid, _, _) in enumerate(players)}
+            self._games = np.zeros(max(len(players), PLAYER_INDEX_INITIAL_CAPACITY), dtype=np.int64)
+            self._games[:len(players)] = [games for _, _, games in players]
+            self._keys = [players[slot][1].casefold() for slot in order]
+            self._order = np.array(order, dtype=np.int32)
+        return len(players)
+
+    def add(self, players: Dict[PlayerName, PlayerId]) -> None:
+        """ Add new players, given as {name: id} """
+        with self._lock:
+            new = [(name, pid) for name, pid in players.items() if pid not in self._slots]
+            if not new:
+                return
+            self._reserve(len(new))
+            new.sort(key=lambda player: player[0].casefold())
+            # np.insert takes positions in the array before any insertions, so find them all first
+            positions = [bisect.bisect_right(self._keys, name.casefold()) for name, _ in new]
+            slots = []
+            for name, pid in new:
+                slot = len(self._players)
+                self._players.append((pid, name))
+                self._slots[pid] = slot
+                slots.append(slot)
+                key = name.casefold()
+                self._keys.insert(bisect.bisect_right(self._keys, key), key)
+            self._order = np.insert(self._order, positions, slots)
+
+    def played(self, pids: Iterable[PlayerId]) -> None:
+        """ Count a finished game for each of the given players """
+        with self._lock:
+            for pid in pids:
+                slot = self._slots.get(pid)
+                if slot is not None:
+                    self._games[slot] += 1
+
+    def search(self, prefix: str, limit: int = PLAYER_SEARCH_LIMIT) -> List[dict]:
+        """ Up to `limit` players whose name starts with `prefix`, ignoring case, most games played first:
+        [{'pid', 'name', 'games'}, ...] """
+        key = prefix.casefold()
+        if not key or limit <= 0:
+            return []
+        with self._lock:
+            start = bisect.bisect_left(self._keys, key)
+            end = bisect.bisect_left(self._keys, key + _LAST, start)
+            slots = self._order[start:end]
+            games = self._games[slots]
+            if len(slots) > limit:
+                best = np.argpartition(-games, limit - 1)[:limit]
+            else:
+                best = np.arange(len(slots))
+            # most games first; ties in alphabetical order
+            best = best[np.lexsort((best, -games[best]))]
+            return [
+                {'pid': self._players[slot][0], 'name': self._players[slot][1], 'games': int(count)}
+                for slot, count in zip(slots[best].tolist(), games[best].tolist())
+            ]
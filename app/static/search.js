@@ -0,0 +1,39 @@
+'use strict';
+
+// Type-ahead for the player search: results are fetched on every keystroke,
+// and only the response to the newest query is shown.
+$(function() {
+    var input = $("#search");
+    if (input.length === 0) {
+        return;
+    }
+    var url = input.attr("data-url");
+    var latest = 0;
+
+    input.on('input', function() {
+        var query = input.val();
+        var request = ++latest;
+        if (query === "") {
+            show_players([], query);
+            return;
+        }
+        $.getJSON(url, {q: query}, function(players) {
+            if (request === latest) {
+                show_players(players, query);
+            }
+        });
+    });
+});
+
+function show_players(players, query) {
+    var list = $("#players").empty();
+    for (var i = 0; i < players.length; i++) {
+        var link = $("<a>", {href: '/player/'+players[i].pid}).text(players[i].name);
+        var games = $("<span>", {class: 'games'}).text(players[i].games + " games");
+        list.append($("<li>").append(link).append(" ").append(games));
+    }
+    $("#noplayers").remove();
+    if (query !== "" && players.length === 0) {
+        list.after($("<p>", {id: 'noplayers'}).text("No players found."));
+    }
+}
@@ -1,41 +1,99 @@
 'use strict';
-var socket = io("/livefeed");
 
-socket.on('connect', function(data) {
-    console.debug("connected!")
-});
+// State of the live games list, as of sequence number `live_seq` of the server's `live_epoch`.
+// Both start out as rendered into the page; see livelist.j2.
+var live_epoch = null;
+var live_seq = 0;
+var syncing = false;
 
-socket.on('game begin', function(data) {
-    console.debug("begin!");
-    var gameInfo = data.gameInfo;
-    console.debug(gameInfo);
-    add_live(gameInfo);
-});
+$(function() {
+    var live = $("#live");
+    if (live.length === 0) {
+        return;
+    }
+    live_epoch = live.attr("data-epoch");
+    live_seq = Number(live.attr("data-seq"));
+
+    var socket = io("/livefeed");
+
+    socket.on('connect', function(data) {
+        console.debug("connected!")
+        // catch up with anything missed while loading the page, or while disconnected
+        sync(socket);
+    });
 
-socket.on('game result', function(data) {
-    console.debug("result!");
-    var gameId = data.gameId;
-    console.debug(gameId);
-    remove_finished(gameId)
+    // live game events arrive in batches, see apply_frame
+    socket.on('games', function(frame) {
+        apply_frame(socket, frame);
+    });
 });
 
-function add_live(gameInfo) {
+function sync(socket) {
+    if (syncing) {
+        return;
+    }
+    syncing = true;
+    socket.emit('sync', {epoch: live_epoch, seq: live_seq}, function(frame) {
+        syncing = false;
+        apply_frame(socket, frame);
+    });
+}
+
+// A frame is either a snapshot, {epoch, to, games: [gameInfo, ...]}, replacing the whole list,
+// or the changes between two sequence numbers: {epoch, from, to, begin: [gameInfo, ...], result: [gameId, ...]}
+function apply_frame(socket, frame) {
+    if (frame.games !== undefined) {
+        console.debug("snapshot", frame.to);
+        $("#live").empty();
+        update_live(frame.games, []);
+    } else if (frame.epoch !== live_epoch || frame.from > live_seq) {
+        // missed something in between; ask for what we don't have
+        console.debug("out of sync", frame.from, live_seq);
+        sync(socket);
+        return;
+    } else if (frame.to <= live_seq) {
+        // nothing we don't already have
+        return;
+    } else if (frame.from < live_seq) {
+        // partly applied already (after a sync); can't apply just the rest of it
+        sync(socket);
+        return;
+    } else {
+        console.debug("games", frame.begin.length, frame.result.length);
+        update_live(frame.begin, frame.result);
+    }
+    live_epoch = frame.epoch;
+    live_seq = frame.to;
+}
+
+function live_game_element(gameInfo) {
     var left_link = $("<a>", {href: '/player/'+gameInfo.player1.pid}).text(gameInfo.player1.name)
     var left = $("<div>", {class: 'player left'}).append(left_link);
 
     var right_link = $("<a>", {href: '/player/'+gameInfo.player2.pid}).text(gameInfo.player2.name)
     var right = $("<div>", {class: 'player right'}).append(right_link);
-    
-    var middle = $("<span>", {class: 'middle'}).text("vs.");
-    var game_li = $("<li>", {class: 'result', 'id': gameInfo.gameId}).append(left).append(middle).append(right);
 
-    $("#live").prepend(game_li);
-    $("#nolive").hide();
+    var middle = $("<span>", {class: 'middle'}).text("vs.");
+    return $("<li>", {class: 'result', 'id': gameInfo.gameId}).append(left).append(middle).append(right);
 }
 
-function remove_finished(gameId) {
-    $("#live > li#"+gameId).remove();
-    if ($("#live > li").length === 0) {
-        $("#nolive").show();
+function update_live(begun, finished) {
+    var live = $("#live");
+
+    if (finished.length > 0) {
+        // game ids aren't necessarily valid CSS identifiers, so look them up by attribute instead of '#id'
+        var ids = new Set(finished);
+        live.children("li").filter(function() { return ids.has(this.id); }).remove();
     }
-}
\ No newline at end of file
+
+    if (begun.length > 0) {
+        // newest first, as one insertion
+        var fragment = document.createDocumentFragment();
+        for (var i = begun.length - 1; i >= 0; i--) {
+            fragment.appendChild(live_game_element(begun[i])[0]);
+        }
+        live.prepend(fragment);
+    }
+
+    $("#nolive").toggle(live.children("li").length === 0);
+}
@@ -0,0 +1,131 @@
+""" Batched database writes for live game results """
+
+import database
+import metrics
+import queue
+import time
+
+from typing import Callable, Dict, List, Optional, Union
+from apityping import GameResult, ResultCallback
+
+
+WRITER_FLUSH_INTERVAL = 0.2     # seconds; longest a result waits for others to share its transaction
+WRITER_MAX_BATCH = 500          # games per transaction at most
+
+_COMMIT_SECONDS = metrics.histogram("rps_writer_commit_seconds", "Duration of the live result writer's transactions")
+_BATCH_SIZE = metrics.histogram("rps_writer_batch_games", "Games per live result writer transaction",
+    buckets=(1, 2, 5, 10, 20, 50, 100, 200, 500))
+
+
+class BatchWriter:
+    """ Saves finished games to the database in batches (group commit)
+
+    Games submitted within `flush_interval` of each other, up to `max_batch` of them, are committed in one
+    transaction. `on_saved` is called for every game once its batch has been committed: clients are only told
+    about results from there, so nothing they have seen can be lost. Games that turn out to have been stored
+    already (e.g. from the history) are passed to `on_known` instead, if given.
+    `stop()` flushes whatever is still queued.
+    """
+
+    def __init__(self, on_saved: ResultCallback,
+            flush_interval: float = WRITER_FLUSH_INTERVAL, max_batch: int = WRITER_MAX_BATCH,
+            on_known: Optional[ResultCallback] = None):
+        self.on_saved = on_saved
+        self.on_known = on_known
+        self.flush_interval = flush_interval
+        self.max_batch = max_batch
+        self._queue: "queue.Queue[Optional[GameResult]]" = queue.Queue()
+        self._task = None
+        # metrics
+        self.batches = 0
+        self.games = 0
+        self.errors = 0
+        self.last_commit_time = 0.0
+        self.max_commit_time = 0.0
+        self.total_commit_time = 0.0
+
+    def start(self, spawn: Callable[[Callable[[], None]], object]) -> None:
+        """ Start the writer task, using `spawn` to start it in the background """
+        self._task = spawn(self._run)
+
+    def stop(self) -> None:
+        """ Commit everything submitted so far, and stop the writer """
+        self._queue.put(None)
+        if self._task is not None:
+            self._task.join()
+
+    def submit(self, game: GameResult) -> None:
+        self._queue.put(game)
+
+    def _run(self) -> None:
+        stopping = False
+        while not stopping:
+            game = self._queue.get()
+            if game is None:
+                break
+
+            # collect whatever else arrives within the flush interval
+            batch = [game]
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.max_batch:
+                remaining = deadline - time.monotonic()
+                try:
+                    game = self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if game is None:
+                    stopping = True
+                    break
+                batch.append(game)
+
+            self._flush(batch)
+
+    def _flush(self, batch: List[GameResult]) -> None:
+        start = time.perf_counter()
+        saved = database.add_game_results(batch)
+        failed = []
+        if saved is None:
+            # don't let one bad game take the whole batch down with it
+            saved = []
+            for game in batch:
+                new = database.add_game_results([game])
+                if new is None:
+                    failed.append(game)
+                else:
+                    saved += new
+            self.errors += len(failed)
+        # games that were stored already are reported separately, so that e.g. statistics don't count them twice
+        reported = {game.gameId for game in saved + failed}
+        known = [game for game in batch if game.gameId not in reported]
+        elapsed = time.perf_counter() - start
+        _COMMIT_SECONDS.observe(elapsed)
+        _BATCH_SIZE.observe(len(batch))
+
+        self.batches += 1
+        self.games += len(saved)
+        self.last_commit_time = elapsed
+        self.max_commit_time = max(self.max_commit_time, elapsed)
+        self.total_commit_time += elapsed
+
+        for game in saved:
+            try:
+                self.on_saved(game)
+            except Exception as e:
+                print(f"Error in result callback for {game.gameId}: {e!r}")
+        if self.on_known is not None:
+            for game in known:
+                try:
+                    self.on_known(game)
+                except Exception as e:
+                    print(f"Error in result callback for {game.gameId}: {e!r}")
+
+    def stats(self) -> Dict[str, Union[int, float]]:
+        return {
+            'queue_depth': self._queue.qsize(),
+            'batches': self.batches,
+            'games': self.games,
+            'errors': self.errors,
+            'last_commit_seconds': self.last_commit_time,
+            'max_commit_seconds': self.max_commit_time,
+            'avg_commit_seconds': self.total_commit_time / self.batches if self.batches else 0.0,
+        }
@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+""" Read latency of the player and history listings, with and without the compact (game_rows) read mode.
+
+Usage: python benchmarks/bench_reads.py [--db app/results.db] [--repeat 50]
+"""
+
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'app'))
+import database
+
+
+def timed(f, repeat: int) -> float:
+    """ Median duration of f() in milliseconds """
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        f()
+        times.append((time.perf_counter() - start) * 1000)
+    times.sort()
+    return times[len(times) // 2]
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--db", default=os.path.join("app", database.DB_FILE))
+    parser.add_argument("--repeat", type=int, default=50)
+    args = parser.parse_args()
+
+    database.DB_FILE = args.db
+    database.migrate()
+
+    with database._connection() as con:
+        players = [pid for pid, in con.execute(
+            "SELECT player_id FROM player_stats ORDER BY wins + losses + ties DESC LIMIT 10")]
+    total, pages = database.get_games_count_total()
+    pid = random.Random(0).choice(players)
+    _, player_pages = database.get_games_count_by_player(pid)
+    deep = pages - 1
+    deep_player = player_pages - 1
+
+    cases = {
+        "player page 0": lambda: database.get_games_by_player(pid, 0),
+        f"player page {deep_player}": lambda: database.get_games_by_player(pid, deep_player),
+        "player keyset": lambda: database.get_games_by_player_keyset(pid),
+        "history page 0": lambda: database.get_games_history(0),
+        f"history page {deep}": lambda: database.get_games_history(deep),
+        "history keyset": lambda: database.get_games_history_keyset(),
+    }
+
+    print(f"{total} games; median of {args.repeat} runs, in ms")
+    print(f"{'query':<24} {'joined':>10} {'compact':>10}")
+    for name, f in cases.items():
+        database.COMPACT_READS = False
+        joined = timed(f, args.repeat)
+        database.COMPACT_READS = True
+        compact = timed(f, args.repeat)
+        print(f"{name:<24} {joined:>10.3f} {compact:>10.3f}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+""" Memory use and construction time of game results read from game_rows, as named tuples against the original nested dicts.
+
+Usage: python benchmarks/bench_rows.py [--games 100000]
+"""
+
+import argparse
+import os
+import random
+import sys
+import time
+import tracemalloc
+import uuid
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'app'))
+import database
+import rps
+
+
+# The original conversion, for comparison
+
+def result_dict(gid, t, p1_id, p1_name, p2_id, p2_name, packed):
+    p1_play, p2_play, p1_res, p2_res = packed
+    return {
+        'gameId': gid,
+        't': t,
+        'player1': {'pid': p1_id, 'name': p1_name, 'played': rps.rps_from_str(p1_play), 'result': rps.result_from_str(p1_res)},
+        'player2': {'pid': p2_id, 'name': p2_name, 'played': rps.rps_from_str(p2_play), 'result': rps.result_from_str(p2_res)},
+    }
+
+
+def measure(name: str, make, rows) -> float:
+    """ Build a game from each row, printing the time taken and memory held by the games (excluding the rows) """
+    start = time.perf_counter()
+    games = [make(*row) for row in rows]
+    elapsed = time.perf_counter() - start
+    del games
+
+    # tracing slows allocation down, so measure memory separately
+    tracemalloc.start()
+    games = [make(*row) for row in rows]
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(f"{name:<20} {elapsed:8.3f} s  {len(rows) / elapsed / 1e6:6.2f} M/s  {size / len(games):8.1f} B/game")
+    del games
+    return elapsed, size
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--games", type=int, default=100_000)
+    args = parser.parse_args()
+
+    r = random.Random(0)
+    players = [(str(uuid.UUID(int=r.getrandbits(128))), f"Player {i}") for i in range(1000)]
+    rows = []
+    for i in range(args.games):
+        (p1_id, p1_name), (p2_id, p2_name) = r.sample(players, 2)
+        a, b = r.choice(rps.RPS_ORDER), r.choice(rps.RPS_ORDER)
+        packed = a.value + b.value + rps.get_result(a, b).value + rps.get_result(b, a).value
+        rows.append((uuid.UUID(int=r.getrandbits(128)).hex, 1_640_000_000_000 + i, p1_id, p1_name, p2_id, p2_name, packed))
+
+    print(f"{args.games} games")
+    old_time, old_size = measure("nested dicts", result_dict, rows)
+    new_time, new_size = measure("named tuples", database._result_from_compact_row, rows)
+    print(f"{'':<20} {old_time / new_time:8.2f} x faster, {old_size / new_size:.2f} x smaller")
+
+    old, new = result_dict(*rows[0]), database._result_from_compact_row(*rows[0])
+    assert old['player1']['result'] is new.player1.result and old['player2']['played'] is new.player2.played
+
+if __name__ == "__main__":
+    main()
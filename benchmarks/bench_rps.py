@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+""" Micro-benchmark of the rock-paper-scissors helpers in rps.py, against their original implementations.
+
+Usage: python benchmarks/bench_rps.py [--games 1000000]
+"""
+
+import argparse
+import os
+import random
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'app'))
+import rps
+from rps import RPS, Result
+
+
+# The original implementations, for comparison
+
+def get_result_chain(a: RPS, b: RPS):
+    if a == b:
+        return Result.TIE
+    elif a == RPS.ROCK:
+        if b == RPS.PAPER:
+            return Result.LOSS
+        elif b == RPS.SCISSORS:
+            return Result.WIN
+    elif a == RPS.PAPER:
+        if b == RPS.ROCK:
+            return Result.WIN
+        elif b == RPS.SCISSORS:
+            return Result.LOSS
+    elif a == RPS.SCISSORS:
+        if b == RPS.ROCK:
+            return Result.LOSS
+        if b == RPS.PAPER:
+            return Result.WIN
+    return None
+
+def rps_from_str_lower(s: str):
+    s = s.lower()
+    if s in ('r', 'rock', 'kivi'):
+        return RPS.ROCK
+    elif s in ('s', 'scissors', 'sakset'):
+        return RPS.SCISSORS
+    elif s in ('p', 'paper', 'paperi'):
+        return RPS.PAPER
+    else:
+        return None
+
+
+def timed(name: str, f, n: int) -> float:
+    start = time.perf_counter()
+    f()
+    elapsed = time.perf_counter() - start
+    print(f"{name:<36} {elapsed:8.3f} s  {n / elapsed / 1e6:8.2f} M/s")
+    return elapsed
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--games", type=int, default=1_000_000)
+    args = parser.parse_args()
+    n = args.games
+
+    r = random.Random(0)
+    texts = [r.choice(("ROCK", "PAPER", "SCISSORS")) for _ in range(n)]
+    a = [r.choice(rps.RPS_ORDER) for _ in range(n)]
+    b = [r.choice(rps.RPS_ORDER) for _ in range(n)]
+    a_codes = np.array([rps.RPS_ORDER.index(p) for p in a], dtype=np.int8)
+    b_codes = np.array([rps.RPS_ORDER.index(p) for p in b], dtype=np.int8)
+
+    print(f"{n} games")
+    old = timed("rps_from_str (lower + tuple search)", lambda: [rps_from_str_lower(s) for s in texts], n)
+    new = timed("rps_from_str (dict)", lambda: [rps.rps_from_str(s) for s in texts], n)
+    print(f"{'':<36} {old / new:8.2f} x")
+
+    old = timed("get_result (if/elif chain)", lambda: [get_result_chain(x, y) for x, y in zip(a, b)], n)
+    new = timed("get_result (table)", lambda: [rps.get_result(x, y) for x, y in zip(a, b)], n)
+    print(f"{'':<36} {old / new:8.2f} x")
+    batch = timed("get_results (batch, NumPy)", lambda: rps.get_results(a_codes, b_codes), n)
+    print(f"{'':<36} {old / batch:8.2f} x")
+
+    assert [get_result_chain(x, y) for x, y in zip(a[:1000], b[:1000])] == [rps.get_result(x, y) for x, y in zip(a[:1000], b[:1000])]
+    assert all(rps.RESULT_ORDER[c] is rps.get_result(x, y) for x, y, c in zip(a[:1000], b[:1000], rps.get_results(a_codes[:1000], b_codes[:1000])))
+
+if __name__ == "__main__":
+    main()
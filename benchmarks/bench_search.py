@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+""" Latency of player name prefix search with search.PlayerIndex, against a LIKE query on the players table.
+
+Usage: python benchmarks/bench_search.py [--players 100000]
+"""
+
+import argparse
+import os
+import random
+import sqlite3
+import string
+import sys
+import time
+import uuid
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'app'))
+from search import PlayerIndex
+
+
+def timed(name: str, f, queries) -> None:
+    start = time.perf_counter()
+    for q in queries:
+        f(q)
+    elapsed = time.perf_counter() - start
+    print(f"{name:<28} {elapsed / len(queries) * 1000:8.3f} ms/query")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--players", type=int, default=100_000)
+    args = parser.parse_args()
+
+    r = random.Random(0)
+    players = [
+        (str(uuid.UUID(int=r.getrandbits(128))), "".join(r.choices(string.ascii_letters, k=r.randint(4, 12))), r.randint(0, 500))
+        for _ in range(args.players)
+    ]
+
+    # the players and player_stats tables, as created by create-database.sql and the migrations
+    con = sqlite3.connect(":memory:")
+    con.execute("CREATE TABLE players (player_id TEXT PRIMARY KEY NOT NULL, name TEXT UNIQUE NOT NULL)")
+    con.execute("CREATE TABLE player_stats (player_id TEXT PRIMARY KEY NOT NULL, games INTEGER NOT NULL)")
+    con.executemany("INSERT OR IGNORE INTO players VALUES (?,?)", ((pid, name) for pid, name, _ in players))
+    con.executemany("INSERT INTO player_stats VALUES (?,?)", ((pid, games) for pid, _, games in players))
+
+    def like(prefix):
+        return con.execute("""SELECT players.player_id, name, games FROM players
+            JOIN player_stats ON players.player_id = player_stats.player_id
+            WHERE name LIKE ? ORDER BY games DESC LIMIT 10""", (prefix + "%",)).fetchall()
+
+    index = PlayerIndex()
+    start = time.perf_counter()
+    index.load(players)
+    print(f"{args.players} players, index built in {(time.perf_counter() - start) * 1000:.0f} ms")
+
+    for length in (1, 2, 3, 5):
+        queries = ["".join(r.choices(string.ascii_lowercase, k=length)) for _ in range(200)]
+        print(f"prefix of {length}, {sum(len(index.search(q, args.players)) for q in queries) / len(queries):.0f} matches on average")
+        timed("LIKE query", like, queries)
+        timed("PlayerIndex.search", index.search, queries)
+
+    name = players[0][1]
+    assert like(name[:3])[0][2] == index.search(name[:3])[0]['games']
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,337 @@
+#!/usr/bin/env python3
+""" A local cluster: one ingest worker and several web workers, as they would run behind a load balancer.
+
+Usage:
+    python benchmarks/cluster.py [--web 3] [--port 5001] [--bus 127.0.0.1:5100] [--history 5000] [--live 500] [--rate 20] [--check [--outage 5]]
+
+Starts a stand-in for the API, serving synthetic games (`--history` of them as history pages, then a live feed of
+`--live` more, beginning at `--rate` per second), and a fresh database in a temporary directory. Then starts
+`main.py --role ingest`, and once its bus is up, `--web` workers on consecutive ports from `--port`. The live feed
+ends with some games still going, so that there is something to see on the front page afterwards.
+
+Without `--check`, the cluster runs until interrupted. With it, the ingest worker is stopped a third of the way
+into the live feed and restarted `--outage` seconds later, so that the games finished meanwhile only reach the
+database from the history. Once the live feed has ended and every game has been saved, one more web worker is
+started, loading everything from the database. Its live games, top players and player search are compared with
+every other web worker's, and the exit status is 1 if any differ.
+Each worker's output is written to a log file in the temporary directory.
+"""
+
+import argparse
+import base64
+import hashlib
+import json
+import os
+import queue
+import re
+import shutil
+import socket
+import sqlite3
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional, Tuple
+
+ROOT = os.path.normpath(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+sys.path.insert(0, os.path.join(ROOT, 'app'))
+import bus
+
+import synthetic
+
+WEBSOCKET_GUID = "258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+STARTUP_TIMEOUT = 120.0     # seconds a worker may take to come up
+CHECK_SETTLE = 2.0          # seconds after the live feed ends before comparing workers
+CHECK_ATTEMPTS = 5          # comparisons tried, CHECK_SETTLE apart, before reporting a difference
+RECONCILE_INTERVAL = 2.0    # seconds between the ingest worker's history checks, shortened for --check
+RECONCILE_SETTLE = 3000     # ms the history is given to settle, likewise
+RECONCILE_TIMEOUT = 60.0    # seconds after the live feed ends for the ingest worker to have saved every game
+
+LIVE_IDS = re.compile(r'<li class="result" id="([^"]+)"')
+
+
+class FakeAPI:
+    """ The API's history and live websocket, on one local HTTP port
+
+    The history lists the newest games first, `page_size` to a page. Pages are numbered from the oldest, so that
+    the cursors of full pages stay valid as new games arrive, as with the real API. The live feed is played from
+    the first websocket connection on, to whichever clients are connected at the time. Each result gets the
+    current time, and goes to the history too, so that the results a client misses can be found there.
+    """
+
+    def __init__(self, history: List[dict], live: List[Tuple[float, dict]], page_size: int = 1000):
+        self.history = list(history)
+        self.live = live
+        self.page_size = page_size
+        self.live_started = threading.Event()
+        self.live_done = threading.Event()
+        self._clients: List[queue.Queue] = []
+        self._lock = threading.Lock()
+        api = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                if self.path.startswith("/rps/live"):
+                    api._live(self)
+                elif self.path.startswith("/rps/history"):
+                    api._history(self)
+                else:
+                    self.send_error(404)
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.server.daemon_threads = True
+        self.base = f"127.0.0.1:{self.server.server_address[1]}/rps"
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def games(self) -> int:
+        with self._lock:
+            return len(self.history)
+
+    def _history(self, handler: BaseHTTPRequestHandler) -> None:
+        _, _, cursor = handler.path.partition("?cursor=")
+        with self._lock:
+            page = int(cursor) if cursor else (len(self.history) - 1) // self.page_size
+            data = self.history[page * self.page_size:(page + 1) * self.page_size][::-1] if page >= 0 else []
+        # like the real API, the last page is an empty one without a cursor
+        body = json.dumps({'cursor': f"/rps/history?cursor={page - 1}" if page >= 0 else None, 'data': data}).encode()
+        handler.send_response(200)
+        handler.send_header("Content-Type", "application/json")
+        handler.send_header("Content-Length", str(len(body)))
+        handler.end_headers()
+        handler.wfile.write(body)
+
+    def _live(self, handler: BaseHTTPRequestHandler) -> None:
+        key = handler.headers.get("Sec-WebSocket-Key", "")
+        accept = base64.b64encode(hashlib.sha1((key + WEBSOCKET_GUID).encode()).digest()).decode()
+        handler.send_response(101)
+        handler.send_header("Upgrade", "websocket")
+        handler.send_header("Connection", "Upgrade")
+        handler.send_header("Sec-WebSocket-Accept", accept)
+        handler.end_headers()
+        handler.wfile.flush()
+        handler.close_connection = True
+
+        frames: queue.Queue = queue.Queue()
+        with self._lock:
+            self._clients.append(frames)
+            if not self.live_started.is_set():
+                self.live_started.set()
+                threading.Thread(target=self._play, daemon=True).start()
+        try:
+            # the connection stays open after the feed ends, as the real one would
+            while True:
+                handler.wfile.write(frames.get())
+                handler.wfile.flush()
+        except OSError:
+            pass
+        finally:
+            with self._lock:
+                self._clients.remove(frames)
+
+    def _play(self) -> None:
+        start = time.monotonic()
+        for t, event in self.live:
+            delay = start + t - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            with self._lock:
+                if event['type'] == "GAME_RESULT":
+                    event = dict(event, t=int(time.time() * 1000))
+                    self.history.append(event)
+                clients = list(self._clients)
+            # the live websocket sends each event as a JSON string, itself JSON encoded
+            frame = _text_frame(json.dumps(json.dumps(event)))
+            for frames in clients:
+                frames.put(frame)
+        self.live_done.set()
+
+    def close(self) -> None:
+        self.server.shutdown()
+
+def _text_frame(text: str) -> bytes:
+    """ An unmasked websocket text frame, as sent by servers """
+    data = text.encode()
+    if len(data) < 126:
+        header = struct.pack("!BB", 0x81, len(data))
+    elif len(data) < 65536:
+        header = struct.pack("!BBH", 0x81, 126, len(data))
+    else:
+        header = struct.pack("!BBQ", 0x81, 127, len(data))
+    return header + data
+
+def _unfinished_tail(trace: List[Tuple[float, dict]]) -> List[Tuple[float, dict]]:
+    """ The trace up to its last game beginning, so that the games still going then never finish """
+    last_begin = max(t for t, event in trace if event['type'] == "GAME_BEGIN")
+    return [(t, event) for t, event in trace if t <= last_begin]
+
+
+def _create_database(path: str) -> None:
+    with open(os.path.join(ROOT, 'create-database.sql')) as f:
+        script = f.read()
+    con = sqlite3.connect(path)
+    con.executescript(script)
+    con.close()
+
+def _start(name: str, args: List[str], workdir: str, env: Dict[str, str], append: bool = False) -> subprocess.Popen:
+    log = open(os.path.join(workdir, f"{name}.log"), "a" if append else "w")
+    print(f"Starting {name}: {' '.join(args)}")
+    return subprocess.Popen([sys.executable, os.path.join(ROOT, 'app', 'main.py'), *args],
+        cwd=workdir, env=env, stdout=log, stderr=subprocess.STDOUT)
+
+def _wait(name: str, process: subprocess.Popen, ready, timeout: float = STARTUP_TIMEOUT,
+        failure: str = f"didn't start in {STARTUP_TIMEOUT:.0f}s") -> None:
+    deadline = time.monotonic() + timeout
+    while not ready():
+        if process.poll() is not None:
+            raise RuntimeError(f"{name} exited with status {process.returncode}")
+        if time.monotonic() > deadline:
+            raise RuntimeError(f"{name} {failure}")
+        time.sleep(0.2)
+
+def _saved_games(path: str) -> int:
+    con = sqlite3.connect(path)
+    try:
+        return con.execute("SELECT COUNT(*) FROM game_rows").fetchone()[0]
+    finally:
+        con.close()
+
+def _accepts(address: Tuple[str, int]) -> bool:
+    try:
+        socket.create_connection(address, timeout=1).close()
+        return True
+    except OSError:
+        return False
+
+def _get(url: str) -> Optional[bytes]:
+    try:
+        with urllib.request.urlopen(url, timeout=10) as response:
+            return response.read()
+    except (urllib.error.URLError, OSError):
+        return None
+
+
+def _view(port: int) -> dict:
+    """ What a web worker shows of the state kept in its memory """
+    base = f"http://127.0.0.1:{port}"
+    page = (_get(base + "/") or b"").decode()
+    return {
+        'live games': sorted(LIVE_IDS.findall(page)),
+        'top players': json.loads(_get(base + "/stats/top?n=100") or "null"),
+        'player search': json.loads(_get(base + "/player/search?q=a&n=50") or "null"),
+    }
+
+def check(ports: List[int]) -> bool:
+    for attempt in range(CHECK_ATTEMPTS):
+        time.sleep(CHECK_SETTLE)
+        views = {port: _view(port) for port in ports}
+        first = views[ports[0]]
+        different = {port: [key for key in first if view[key] != first[key]] for port, view in views.items()}
+        different = {port: keys for port, keys in different.items() if keys}
+        if not different:
+            print(f"All {len(ports)} web workers agree: {len(first['live games'])} live games, "
+                f"{len(first['top players'] or [])} top players")
+            return True
+        print(f"Attempt {attempt + 1}: web workers differing from the one at port {ports[0]}: {different}")
+    return False
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--web", type=int, default=3, help="number of web workers")
+    parser.add_argument("--port", type=int, default=5001, help="HTTP port of the first web worker")
+    parser.add_argument("--bus", default=f"{bus.BUS_HOST}:{bus.BUS_PORT}", help="host:port of the live event bus")
+    parser.add_argument("--history", type=int, default=5000, help="games in the history")
+    parser.add_argument("--live", type=int, default=500, help="games in the live feed")
+    parser.add_argument("--rate", type=float, default=20.0, help="games beginning per second in the live feed")
+    parser.add_argument("--players", type=int, default=2000)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--check", action="store_true", help="compare the web workers once the live feed ends")
+    parser.add_argument("--outage", type=float, default=5.0, help="seconds the ingest worker is stopped for with --check")
+    parser.add_argument("--keep", action="store_true", help="keep the temporary directory, with the database and logs")
+    args = parser.parse_args()
+
+    games = synthetic.Games(args.players, seed=args.seed)
+    history = [game for page in games.history(args.history) for game in page]
+    trace = [(t, json.loads(json.loads(message))) for t, message in games.live_trace(args.live, args.rate, duplicates=0.0)]
+    live = _unfinished_tail(trace)
+    api = FakeAPI(history, live)
+
+    workdir = tempfile.mkdtemp(prefix="rps-cluster-")
+    database = os.path.join(workdir, "results.db")
+    _create_database(database)
+    env = dict(os.environ, RPS_API_BASE=f"http://{api.base}", RPS_WS_BASE=f"ws://{api.base}",
+        RPS_RECONCILE_INTERVAL=str(RECONCILE_INTERVAL), RPS_RECONCILE_SETTLE=str(RECONCILE_SETTLE))
+    processes: List[subprocess.Popen] = []
+    ok = True
+    try:
+        ingest = _start("ingest", ["--role", "ingest", "--bus", args.bus], workdir, env)
+        processes.append(ingest)
+        _wait("ingest", ingest, lambda: _accepts(bus.parse_address(args.bus)))
+
+        def start_web(ports: List[int]) -> None:
+            started = [_start(f"web-{port}", ["--role", "web", "--bus", args.bus, "--port", str(port)], workdir, env)
+                for port in ports]
+            processes.extend(started)
+            for port, process in zip(ports, started):
+                _wait(f"web-{port}", process, lambda: _get(f"http://127.0.0.1:{port}/metrics") is not None)
+
+        ports = [args.port + i for i in range(args.web)]
+        start_web(ports)
+        print(f"Web workers at {', '.join(f'http://127.0.0.1:{port}/' for port in ports)}; logs in {workdir}")
+
+        if args.check:
+            # restart the ingest worker a third of the way into the live feed: the results it misses meanwhile
+            # are only in the history, and the web workers have to catch up with them once it is back
+            api.live_started.wait()
+            time.sleep(live[-1][0] / 3)
+            print(f"Stopping ingest for {args.outage:.0f}s")
+            ingest.terminate()
+            ingest.wait()
+            time.sleep(args.outage)
+            ingest = _start("ingest", ["--role", "ingest", "--bus", args.bus], workdir, env, append=True)
+            processes.append(ingest)
+            _wait("ingest", ingest, lambda: _accepts(bus.parse_address(args.bus)))
+
+            api.live_done.wait()
+            _wait("ingest", ingest, lambda: _saved_games(database) == api.games(), RECONCILE_TIMEOUT,
+                f"didn't save all {api.games()} games in {RECONCILE_TIMEOUT:.0f}s")
+            # one more, which loads everything from the database, for the others to be compared with
+            reference = args.port + args.web
+            start_web([reference])
+            ok = check([reference, *ports])
+        else:
+            while all(process.poll() is None for process in processes):
+                time.sleep(1)
+            print("A worker exited, stopping")
+            ok = False
+    except KeyboardInterrupt:
+        pass
+    except RuntimeError as e:
+        print(e)
+        ok = False
+    finally:
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            try:
+                process.wait(10)
+            except subprocess.TimeoutExpired:
+                process.kill()
+        api.close()
+        if args.keep or not ok:
+            print(f"Database and logs kept in {workdir}")
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+    return 0 if ok else 1
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,307 @@
+#!/usr/bin/env python3
+""" Benchmark suite: ingest, reads and live feed processing against synthetic databases of several sizes.
+
+Usage:
+    python benchmarks/suite.py run [--sizes 10000,100000] [--players 2000] [--skew 1.0] [--trace trace.jsonl] [--out results.json]
+    python benchmarks/suite.py record [--seconds 60] [--out trace.jsonl]
+    python benchmarks/suite.py compare old.json new.json [--threshold 0.1]
+
+`run` builds a fresh database in a temporary directory. It grows the database to each size in turn with synthetic
+history pages through `database.add_history_games` (the history ingest path), and times the page and JSON reads at
+each size through the Flask app. It then replays a live feed trace through `apiconn.LiveFeed`'s processing,
+the group-commit writer and the live games/broadcast path. Without `--trace`, a synthetic trace is used.
+
+Results are written as JSON (by default to benchmarks/results/<commit>.json), and `compare` shows the
+change between two such files, exiting with status 1 if anything got slower by more than the threshold.
+"""
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+
+from typing import Callable, Dict, List, Optional, Tuple
+
+ROOT = os.path.normpath(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+sys.path.insert(0, os.path.join(ROOT, 'app'))
+import websocket
+
+import analytics
+import apiconn
+import database
+import main as server
+from broadcast import Broadcaster
+
+import synthetic
+
+
+RESULTS_DIR = os.path.join(ROOT, 'benchmarks', 'results')
+
+Result = Dict[str, object]
+
+
+def _summary(name: str, size: int, samples: List[float], unit: str = "ms") -> Result:
+    """ A result entry for a latency: its median (the value compared between runs), 95th percentile and maximum """
+    samples = sorted(samples)
+    return {
+        'name': name, 'size': size, 'unit': unit, 'better': "lower",
+        'value': samples[len(samples) // 2],
+        'p95': samples[min(len(samples) - 1, int(len(samples) * 0.95))],
+        'max': samples[-1],
+        'n': len(samples),
+    }
+
+def _rate(name: str, size: int, count: int, seconds: float, unit: str = "games/s") -> Result:
+    return {'name': name, 'size': size, 'unit': unit, 'better': "higher", 'value': count / seconds, 'seconds': seconds}
+
+def _timed(f: Callable[[], object], repeat: int, before: Optional[Callable[[], None]] = None) -> List[float]:
+    """ Durations of `repeat` calls of f(), in milliseconds; `before` is called (untimed) before each one """
+    times = []
+    for _ in range(repeat):
+        if before is not None:
+            before()
+        start = time.perf_counter()
+        f()
+        times.append((time.perf_counter() - start) * 1000)
+    return times
+
+def _create_database(path: str) -> None:
+    with open(os.path.join(ROOT, 'create-database.sql')) as f:
+        script = f.read()
+    con = sqlite3.connect(path)
+    con.executescript(script)
+    con.close()
+    database.close()
+    database.DB_FILE = path
+    database.migrate()
+
+
+def bench_ingest(games: synthetic.Games, count: int, size: int, page_size: int) -> List[Result]:
+    """ Add `count` games as history pages, growing the database to `size` games """
+    pages = list(games.history(count, page_size))
+    start = time.perf_counter()
+    for i, page in enumerate(pages):
+        database.add_history_games(page, f"page{size}-{i}")
+    return [_rate("ingest history", size, count, time.perf_counter() - start)]
+
+def bench_reads(client, size: int, repeat: int) -> List[Result]:
+    """ Time the listings and lookups a visitor would hit """
+    with database._connection() as con:
+        (busiest,) = con.execute("SELECT player_id FROM player_stats ORDER BY wins + losses + ties DESC LIMIT 1").fetchone()
+    _, pages = database.get_games_count_total()
+    _, player_pages = database.get_games_count_by_player(busiest)
+    older = database.get_games_history_keyset()[1]
+
+    def get(url: str) -> Callable[[], None]:
+        def f():
+            response = client.get(url)
+            assert response.status_code == 200, (url, response.status_code)
+        return f
+
+    cases = {
+        "player page": (get(f"/player/{busiest}"), server.player_pages.clear),
+        "player page (cached)": (get(f"/player/{busiest}"), None),
+        "player page, last offset page": (get(f"/player/{busiest}?page={player_pages - 1}"), server.player_pages.clear),
+        "history": (get("/history"), None),
+        "history, second keyset page": (get(f"/history?cursor={older}"), None),
+        "history, last offset page": (get(f"/history?page={pages - 1}"), None),
+        "player search": (get("/player/search?q=a"), None),
+        "top players": (get("/stats/top"), None),
+    }
+    results = []
+    for name, (f, before) in cases.items():
+        f()     # warm up
+        results.append(_summary(name, size, _timed(f, repeat, before)))
+    return results
+
+def bench_live(trace: List[Tuple[float, str]], size: int, speed: float) -> List[Result]:
+    """ Replay a live feed trace through LiveFeed's processing, the group-commit writer and the broadcaster
+
+    Measures the time from a message arriving to its game being shown as begun, or saved and reported as finished.
+    `speed` is relative to the trace's own timing; 0 replays as fast as possible.
+    """
+    received: Dict[Tuple[str, str], float] = {}
+    begin_lag: List[float] = []
+    result_lag: List[float] = []
+
+    def on_begin(game):
+        server.live_games.begin(game)
+        begin_lag.append((time.perf_counter() - received[("GAME_BEGIN", game.gameId)]) * 1000)
+
+    def on_result(game):
+        server.live_games.finish(game.gameId)
+        server.game_history.add([game])
+        server.player_index.played([game.player1.pid, game.player2.pid])
+        result_lag.append((time.perf_counter() - received[("GAME_RESULT", game.gameId)]) * 1000)
+
+    broadcaster = Broadcaster(server.live_games, lambda frame: None)
+    feed = apiconn.LiveFeed(on_result, on_begin)
+    # everything but the websocket connection: messages are handed to the feed directly
+    feed.writer.start(apiconn._spawn_thread)
+    feed._tasks = [apiconn._spawn_thread(feed._process_loop)]
+    broadcaster.start(apiconn._spawn_thread)
+
+    keys = []
+    for _, message in trace:
+        event = json.loads(json.loads(message))
+        keys.append((event['type'], event['gameId']))
+
+    start = time.perf_counter()
+    for (offset, message), key in zip(trace, keys):
+        if speed > 0:
+            delay = start + offset / speed - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+        received.setdefault(key, time.perf_counter())
+        feed._handle(message)
+    feed.stop()
+    elapsed = time.perf_counter() - start
+    broadcaster.stop()
+
+    return [
+        _summary("live begin lag", size, begin_lag),
+        _summary("live result lag", size, result_lag),
+        _rate("live events", size, len(trace), elapsed, unit="events/s"),
+    ]
+
+
+def _git(*args: str) -> str:
+    try:
+        return subprocess.run(["git", *args], cwd=ROOT, capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ""
+
+def _load_trace(path: str) -> List[Tuple[float, str]]:
+    """ Read a trace written by `record`: one {"t": seconds from start, "message": websocket message} per line """
+    with open(path) as f:
+        return [(line['t'], line['message']) for line in map(json.loads, filter(str.strip, f))]
+
+def run(args) -> None:
+    sizes = sorted(int(size) for size in args.sizes.split(","))
+    games = synthetic.Games(args.players, args.skew, args.seed)
+    workdir = tempfile.mkdtemp(prefix="rps-bench-")
+    results: List[Result] = []
+    try:
+        _create_database(os.path.join(workdir, "results.db"))
+        client = server.create_app().test_client()
+
+        current = 0
+        for size in sizes:
+            print(f"Growing the database to {size} games")
+            results += bench_ingest(games, size - current, size, args.page_size)
+            current = size
+
+            print(f"Reading at {size} games")
+            start = time.perf_counter()
+            server.game_history = analytics.History()
+            server.game_history.load()
+            results.append(_summary("analytics load", size, [(time.perf_counter() - start) * 1000]))
+            server.player_index.load(database.get_players_with_game_counts())
+            results += bench_reads(client, size, args.repeat)
+
+        trace = _load_trace(args.trace) if args.trace else games.live_trace(args.live_games, args.live_rate)
+        print(f"Replaying {len(trace)} live events at {args.speed or 'full'} speed")
+        results += bench_live(trace, current, args.speed)
+    finally:
+        database.close()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    commit = _git("rev-parse", "--short", "HEAD")
+    report = {
+        'commit': commit,
+        'dirty': bool(_git("status", "--porcelain", "--untracked-files=no")),
+        'time': time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        'python': platform.python_version(),
+        'sqlite': sqlite3.sqlite_version,
+        'platform': platform.platform(),
+        'params': {key: value for key, value in vars(args).items() if key not in ('command', 'func', 'out')},
+        'results': results,
+    }
+    out = args.out or os.path.join(RESULTS_DIR, f"{commit or 'results'}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(out)), exist_ok=True)
+    with open(out, "w") as f:
+        json.dump(report, f, indent=1)
+
+    for r in results:
+        print(f"{r['name']:<32} {r['size']:>9} {r['value']:>12.3f} {r['unit']}")
+    print(f"Results written to {out}")
+
+def record(args) -> None:
+    """ Record the API live feed into a trace file, for `run --trace` """
+    ws = websocket.create_connection(args.url, timeout=1.0)
+    start = time.perf_counter()
+    count = 0
+    with open(args.out, "w") as f:
+        try:
+            while time.perf_counter() - start < args.seconds:
+                try:
+                    message = ws.recv()
+                except websocket.WebSocketTimeoutException:
+                    continue
+                f.write(json.dumps({'t': time.perf_counter() - start, 'message': message}) + "\n")
+                count += 1
+        finally:
+            ws.close()
+    print(f"Recorded {count} messages to {args.out}")
+
+def compare(args) -> None:
+    with open(args.old) as f:
+        old = json.load(f)
+    with open(args.new) as f:
+        new = json.load(f)
+    before = {(r['name'], r['size']): r for r in old['results']}
+
+    print(f"{old['commit']} -> {new['commit']}")
+    regressions = 0
+    for r in new['results']:
+        o = before.get((r['name'], r['size']))
+        if o is None or not o['value']:
+            continue
+        change = r['value'] / o['value'] - 1
+        worse = change > args.threshold if r['better'] == "lower" else change < -args.threshold
+        regressions += worse
+        print(f"{r['name']:<32} {r['size']:>9} {o['value']:>12.3f} {r['value']:>12.3f} {r['unit']:<9} {change:+7.1%}"
+            + ("  REGRESSION" if worse else ""))
+    sys.exit(1 if regressions else 0)
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    p = commands.add_parser("run", help="run the benchmarks")
+    p.add_argument("--sizes", default="10000,100000", help="database sizes in games, comma separated")
+    p.add_argument("--players", type=int, default=2000)
+    p.add_argument("--skew", type=float, default=1.0, help="Zipf exponent of player popularity; 0 is uniform")
+    p.add_argument("--seed", type=int, default=0)
+    p.add_argument("--page-size", type=int, default=1000, help="games per history page")
+    p.add_argument("--repeat", type=int, default=50, help="runs of each read")
+    p.add_argument("--trace", help="live feed trace to replay, see `record`; synthetic by default")
+    p.add_argument("--live-games", type=int, default=2000, help="games in the synthetic trace")
+    p.add_argument("--live-rate", type=float, default=50.0, help="games per second in the synthetic trace")
+    p.add_argument("--speed", type=float, default=10.0, help="replay speed relative to the trace; 0 for as fast as possible")
+    p.add_argument("--out", help="results file; benchmarks/results/<commit>.json by default")
+    p.set_defaults(func=run)
+
+    p = commands.add_parser("record", help="record the live feed into a trace file")
+    p.add_argument("--url", default=apiconn.WS_BASE + "/live")
+    p.add_argument("--seconds", type=float, default=60.0)
+    p.add_argument("--out", default="trace.jsonl")
+    p.set_defaults(func=record)
+
+    p = commands.add_parser("compare", help="compare two results files")
+    p.add_argument("old")
+    p.add_argument("new")
+    p.add_argument("--threshold", type=float, default=0.1, help="relative change counted as a regression")
+    p.set_defaults(func=compare)
+
+    args = parser.parse_args()
+    args.func(args)
+
+if __name__ == "__main__":
+    main()
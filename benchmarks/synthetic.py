@@ -0,0 +1,79 @@
+""" Synthetic game data for benchmarks, in the formats of the bad-api history endpoint and live websocket
+
+Everything is generated from a seed, so the same parameters always give the same games. Player popularity follows
+a Zipf-like distribution: with `skew` 0 every player is equally likely to be in a game, and with higher values a
+few players play most games (as in the real API data).
+"""
+
+import itertools
+import json
+import random
+
+from typing import Iterator, List, Tuple
+
+PLAYS = ("ROCK", "PAPER", "SCISSORS")
+START_TIME = 1_640_000_000_000  # ms
+
+
+def player_names(count: int) -> List[str]:
+    first = ("Aino", "Eino", "Helmi", "Juhani", "Kaarina", "Lauri", "Marja", "Olavi", "Pirkko", "Tapio")
+    last = ("Heikkinen", "Korhonen", "Laine", "Mäkinen", "Nieminen", "Virtanen")
+    # names are unique, with a number once the combinations run out
+    names = [f"{f} {l}" for f, l in itertools.product(first, last)]
+    return [names[i] if i < len(names) else f"{names[i % len(names)]} {i // len(names)}" for i in range(count)]
+
+class Games:
+    """ A reproducible stream of games between `players` players """
+
+    def __init__(self, players: int = 2000, skew: float = 1.0, seed: int = 0):
+        self.names = player_names(players)
+        self._rng = random.Random(seed)
+        self._cum_weights = list(itertools.accumulate(1 / (rank + 1) ** skew for rank in range(players)))
+        self._time = START_TIME
+
+    def _pair(self) -> Tuple[str, str]:
+        while True:
+            a, b = self._rng.choices(self.names, cum_weights=self._cum_weights, k=2)
+            if a != b:
+                return a, b
+
+    def _game_id(self) -> str:
+        return f"{self._rng.getrandbits(64):016x}"
+
+    def result(self) -> dict:
+        """ One finished game, as an APIGameResult """
+        a, b = self._pair()
+        self._time += self._rng.randint(1, 2000)
+        return {
+            'type': "GAME_RESULT", 'gameId': self._game_id(), 't': self._time,
+            'playerA': {'name': a, 'played': self._rng.choice(PLAYS)},
+            'playerB': {'name': b, 'played': self._rng.choice(PLAYS)},
+        }
+
+    def history(self, games: int, page_size: int = 1000) -> Iterator[List[dict]]:
+        """ `games` finished games, in pages of `page_size` """
+        for start in range(0, games, page_size):
+            yield [self.result() for _ in range(min(page_size, games - start))]
+
+    def live_trace(self, games: int, rate: float = 50.0, duration: Tuple[float, float] = (1.0, 5.0),
+            duplicates: float = 0.05) -> List[Tuple[float, str]]:
+        """ A live feed where `games` games begin at an average of `rate` per second, and each finishes within
+        `duration` seconds. Returns (seconds from start, websocket message) pairs in order.
+
+        A fraction `duplicates` of the events are sent twice, as the real API sometimes does.
+        """
+        events = []
+        now = 0.0
+        for _ in range(games):
+            now += self._rng.expovariate(rate)
+            result = self.result()
+            begin = {'type': "GAME_BEGIN", 'gameId': result['gameId'],
+                'playerA': {'name': result['playerA']['name']}, 'playerB': {'name': result['playerB']['name']}}
+            end = now + self._rng.uniform(*duration)
+            for t, event in ((now, begin), (end, result)):
+                events.append((t, event))
+                if self._rng.random() < duplicates:
+                    events.append((t + 0.001, event))
+        events.sort(key=lambda e: e[0])
+        # the live websocket sends each event as a JSON string, itself JSON encoded
+        return [(t, json.dumps(json.dumps(event))) for t, event in events]